@@ -1,10 +1,22 @@
 import streamlit as st
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Settings
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Settings, StorageContext, load_index_from_storage
 from llama_index.embeddings.ollama import OllamaEmbedding
 from llama_index.llms.ollama import Ollama
 from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.chat_engine import ContextChatEngine
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.vector_stores import MetadataFilters, MetadataFilter, FilterOperator
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+import asyncio
 import os
+import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import hashlib
 
 # OLLAMA_NUM_PARALLEL：同时处理单个模型的多个请求
@@ -15,28 +27,270 @@ os.environ['OLLAMA_MAX_LOADED_MODELS'] = '2'
 if not os.environ.get("OLLAMA_BASE_URL"):
   os.environ["OLLAMA_BASE_URL"] = 'http://localhost:11434'
 
+# 向量索引持久化目录：重启后直接加载，不再调用 embedding；文件变化时只对新增 / 修改的文件做 embedding
+STORAGE_DIR = os.environ.get("RAG_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage"))
+INDEX_DIR = os.path.join(STORAGE_DIR, "index")
+# 索引里所有会话的文件共用一份，每个文件的文档带上它的 hash，会话只检索自己的文件
+FILE_HASH_KEY = "file_hash"
+# embedding 缓存：同样的文本（按 模型 + 文本 hash）只 embedding 一次，跨文件、跨重启复用
+EMBED_CACHE_PATH = os.path.join(STORAGE_DIR, "embeddings.sqlite")
+# 上传的文件按内容 hash 存放，相同的文件只写一次；超过 RAG_STAGING_TTL_HOURS 没用到的文件会被删除
+STAGING_DIR = os.path.join(STORAGE_DIR, "uploads")
+STAGING_TTL = float(os.environ.get("RAG_STAGING_TTL_HOURS", "24")) * 3600
+CHUNK_SIZE = 1 << 20
 
-# Function to handle file upload
+
+# Ollama embedding with a SQLite cache keyed on (model, chunk hash); the misses are sent in batches,
+# at most num_parallel requests at a time (the parallel slots of the Ollama server)
+# Only document chunks are cached, the chat queries of the users are not kept
+class CachedOllamaEmbedding(OllamaEmbedding):
+    cache_path: str = Field(description="Path of the SQLite embedding cache.")
+    num_parallel: int = Field(default=2, description="Concurrent embedding requests.")
+    request_batch_size: int = Field(default=16, description="Texts per embedding request.")
+
+    _db: sqlite3.Connection = PrivateAttr()
+    _db_lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, cache_path, **kwargs):
+        super().__init__(cache_path=cache_path, **kwargs)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self._db = sqlite3.connect(cache_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                         "(model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))")
+        self._db_lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls):
+        return "CachedOllamaEmbedding"
+
+    def lookup(self, keys):
+        found = {}
+        with self._db_lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    [self.model_name, *chunk])
+                found.update((key, array('f', vector).tolist()) for key, vector in rows)
+        return found
+
+    def store(self, embeddings):
+        with self._db_lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                 [(self.model_name, key, array('f', vector).tobytes()) for key, vector in embeddings.items()])
+
+    # Cached vectors of keys, and the batches of (key, text) to embed: each text once, request_batch_size per request
+    def misses(self, keys, texts):
+        found = self.lookup(list(set(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        items = list(missing.items())
+        batches = [items[i:i + self.request_batch_size] for i in range(0, len(items), self.request_batch_size)]
+        return found, batches
+
+    def merge(self, found, batches, results):
+        embedded = {key: vector for batch, vectors in zip(batches, results) for (key, _), vector in zip(batch, vectors)}
+        if embedded:
+            self.store(embedded)
+        found.update(embedded)
+        return found
+
+    def embed_batch(self, batch):
+        return super()._get_text_embeddings([text for _, text in batch])
+
+    async def aembed_batch(self, batch, semaphore):
+        async with semaphore:
+            return await super()._aget_text_embeddings([text for _, text in batch])
+
+    def _get_text_embeddings(self, texts):
+        keys = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+        found, batches = self.misses(keys, texts)
+        with ThreadPoolExecutor(max_workers=self.num_parallel) as pool:
+            results = list(pool.map(self.embed_batch, batches))
+        found = self.merge(found, batches, results)
+        return [found[key] for key in keys]
+
+    async def _aget_text_embeddings(self, texts):
+        keys = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+        found, batches = self.misses(keys, texts)
+        semaphore = asyncio.Semaphore(self.num_parallel)
+        results = await asyncio.gather(*(self.aembed_batch(batch, semaphore) for batch in batches))
+        found = self.merge(found, batches, results)
+        return [found[key] for key in keys]
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text):
+        return (await self._aget_text_embeddings([text]))[0]
+
+
+# Function to stage an uploaded file: hashed in chunks while it is streamed to disk, stored as <hash>/<name>
+def stage_file(uploaded_file):
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    hash_md5 = hashlib.md5()
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(dir=STAGING_DIR, prefix=".tmp-", delete=False) as f:
+        while chunk := uploaded_file.read(CHUNK_SIZE):
+            hash_md5.update(chunk)
+            f.write(chunk)
+    uploaded_file.seek(0)
+    file_hash = hash_md5.hexdigest()
+
+    file_dir = os.path.join(STAGING_DIR, file_hash)
+    if os.path.isdir(file_dir) and os.listdir(file_dir):
+        # Already staged (maybe under another name), the content is the same
+        os.remove(f.name)
+        file_path = os.path.join(file_dir, os.listdir(file_dir)[0])
+    else:
+        os.makedirs(file_dir, exist_ok=True)
+        file_path = os.path.join(file_dir, os.path.basename(uploaded_file.name))
+        os.replace(f.name, file_path)
+    # The time of the last use, for gc_staging
+    os.utime(file_dir)
+    return file_hash, file_path
+
+
+# Function to handle file upload, returns {file hash: path}
 def handle_file_upload(uploaded_files):
-    if uploaded_files:
-        temp_dir = tempfile.mkdtemp()
-        for uploaded_file in uploaded_files:
-            file_path = os.path.join(temp_dir, uploaded_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getvalue())
-        return temp_dir
-    return None
+    staged = dict(stage_file(uploaded_file) for uploaded_file in uploaded_files)
+    gc_staging()
+    return staged
+
+
+# Function to remove the staged files not used for STAGING_TTL, and what a crash left behind
+def gc_staging():
+    deadline = time.time() - STAGING_TTL
+    for directory in (STAGING_DIR, STORAGE_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.stat().st_mtime < deadline and (directory == STAGING_DIR or entry.name.startswith(".tmp-")):
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
 
 
-# Function to calculate a hash for the uploaded files
-def get_files_hash(files):
+# Function to calculate a hash for the uploaded files, independent of their names and order
+def get_files_hash(staged):
     hash_md5 = hashlib.md5()
-    for file in files:
-        file_bytes = file.read()
-        hash_md5.update(file_bytes)
+    for file_hash in sorted(staged):
+        hash_md5.update(file_hash.encode())
     return hash_md5.hexdigest()
 
 
+# Function to load the persisted index, or create an empty one
+def load_index():
+    if os.path.isdir(INDEX_DIR):
+        storage_context = StorageContext.from_defaults(persist_dir=INDEX_DIR)
+        return load_index_from_storage(storage_context)
+    return VectorStoreIndex([])
+
+
+# Function to persist the index, written to a temporary directory first so that a crash never leaves a half-written index
+def persist_index(index):
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=STORAGE_DIR, prefix=".tmp-")
+    index.storage_context.persist(persist_dir=tmp_dir)
+    old_dir = tmp_dir + "-old"
+    try:
+        if os.path.isdir(INDEX_DIR):
+            os.rename(INDEX_DIR, old_dir)
+        os.rename(tmp_dir, INDEX_DIR)
+    except OSError as e:
+        # Another process swapped the index meanwhile: keep its copy, the next update adds what is missing
+        print(f"Index not persisted: {e}")
+        if os.path.isdir(old_dir) and not os.path.isdir(INDEX_DIR):
+            os.rename(old_dir, INDEX_DIR)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+# Function to get the lock around load / update / persist of the index, one per process
+# (the script is re-run for every interaction, a module-level lock would not be shared)
+@st.cache_resource
+def index_lock():
+    return threading.Lock()
+
+
+# Function to get the index shared by every session of the process, loaded once
+@st.cache_resource
+def shared_index():
+    with index_lock():
+        return load_index()
+
+
+# Function to group the documents of the index by file hash (documents indexed without one are under None)
+def indexed_files(index):
+    indexed = {}
+    for doc_id, info in index.ref_doc_info.items():
+        indexed.setdefault(info.metadata.get(FILE_HASH_KEY), []).append(doc_id)
+    return indexed
+
+
+# Function to read, split and embed files into nodes, done without the index lock (the embedding is the slow part)
+def embed_files(files):
+    documents = []
+    for file_hash, file_path in files.items():
+        # Documents are named <file hash>-<n> (a pdf is one document per page)
+        for i, document in enumerate(SimpleDirectoryReader(input_files=[file_path]).load_data()):
+            document.id_ = f"{file_hash}-{i}"
+            # Only used to filter, neither embedded (the cache stays keyed on the text) nor shown to the LLM
+            document.metadata[FILE_HASH_KEY] = file_hash
+            document.excluded_embed_metadata_keys.append(FILE_HASH_KEY)
+            document.excluded_llm_metadata_keys.append(FILE_HASH_KEY)
+            documents.append(document)
+    # The chunks of all new files are embedded together, the embedder batches them
+    return run_transformations(documents, [*Settings.transformations, Settings.embed_model])
+
+
+# Function to bring the index to the staged files: only new or changed files are embedded
+# The index holds the files of every session, a session only retrieves its own (see build_chat_engine)
+def update_index(index, staged):
+    with index_lock():
+        indexed = indexed_files(index)
+    added = {file_hash: path for file_hash, path in staged.items() if file_hash not in indexed}
+    nodes = embed_files(added) if added else []
+
+    with index_lock():
+        indexed = indexed_files(index)
+        # Files no session uses any more: their staged copy was garbage collected (gc_staging)
+        still_staged = set(os.listdir(STAGING_DIR)) if os.path.isdir(STAGING_DIR) else set()
+        removed = [file_hash for file_hash in indexed if file_hash not in staged and file_hash not in still_staged]
+        for file_hash in removed:
+            for doc_id in indexed[file_hash]:
+                index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        # Another session may have indexed the same file meanwhile
+        nodes = [node for node in nodes if node.metadata[FILE_HASH_KEY] not in indexed]
+        if nodes:
+            index.insert_nodes(nodes)
+        if nodes or removed:
+            persist_index(index)
+    return list(added), removed
+
+
+# Retriever of a session: reads the shared index under the index lock, the query is embedded before taking it
+class LockedRetriever(BaseRetriever):
+    def __init__(self, retriever):
+        super().__init__()
+        self._retriever = retriever
+
+    def _retrieve(self, query_bundle):
+        if query_bundle.embedding is None:
+            query_bundle.embedding = Settings.embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+        with index_lock():
+            return self._retriever.retrieve(query_bundle)
+
+
+# Function to get the retriever of the files of a session, by file hash (the vector store ignores doc_ids)
+def session_retriever(index, staged):
+    filters = MetadataFilters(filters=[MetadataFilter(key=FILE_HASH_KEY, value=sorted(staged), operator=FilterOperator.IN)])
+    return LockedRetriever(index.as_retriever(filters=filters))
+
+
 # Function to prepare generation configuration
 def prepare_generation_config():
     with st.sidebar:
@@ -55,6 +309,7 @@ def prepare_generation_config():
 # Function to clear chat history
 def clear_chat_history():
     st.session_state.messages = [{"role": "assistant", "content": "你好，我是你的助手，你需要什么帮助吗？"}]
+    st.session_state['memory'] = ChatMemoryBuffer.from_defaults(token_limit=4000)
 
 
 # File upload in the sidebar
@@ -65,66 +320,76 @@ uploaded_files = st.sidebar.file_uploader("Upload your data files:", type=["txt"
 generation_config = prepare_generation_config()
 
 
-# Function to initialize models
+# Function to initialize the embedding model, shared by every session for the life of the process
 @st.cache_resource
-def init_models():
-    embed_model = OllamaEmbedding(model_name="nomic-embed-text", 
-                                  base_url = os.environ["OLLAMA_BASE_URL"])
-    Settings.embed_model = embed_model
+def init_embed_model():
+    return CachedOllamaEmbedding(model_name="nomic-embed-text",
+                                 base_url = os.environ["OLLAMA_BASE_URL"],
+                                 cache_path=EMBED_CACHE_PATH,
+                                 num_parallel=int(os.environ['OLLAMA_NUM_PARALLEL']),
+                                 request_batch_size=16,
+                                 embed_batch_size=256)
+
 
+# Function to build the chat engine of a request: the LLM client is cheap, it follows the current sliders
+def build_chat_engine(index, staged, generation_config, memory):
     llm = Ollama(model="llama3.2", request_timeout=360.0,
-                 num_ctx=generation_config['num_ctx'], 
+                 num_ctx=generation_config['num_ctx'],
                  base_url = os.environ["OLLAMA_BASE_URL"],
                  temperature=generation_config['temperature'])
-    Settings.llm = llm
-
-    documents = SimpleDirectoryReader(st.session_state['temp_dir']).load_data()
-    index = VectorStoreIndex.from_documents(documents)
 
-    memory = ChatMemoryBuffer.from_defaults(token_limit=4000)
-    chat_engine = index.as_chat_engine(
-        chat_mode="context",
+    # Only the documents of the files of this session are retrieved
+    return ContextChatEngine.from_defaults(
+        retriever=session_retriever(index, staged),
+        llm=llm,
         memory=memory,
         system_prompt="You are a chatbot, able to have normal interactions.",
     )
 
-    return chat_engine
 
+Settings.embed_model = init_embed_model()
 
 # Streamlit application
 st.title("💻 Local RAG Chatbot 🤖")
 st.caption("🚀 A RAG chatbot powered by LlamaIndex and Ollama 🦙.")
 
-# Initialize hash for the current uploaded files
-current_files_hash = get_files_hash(uploaded_files) if uploaded_files else None
+# Stage the uploaded files when they change (not on every rerun of the script), then hash the set
+upload_key = [uploaded_file.file_id for uploaded_file in uploaded_files] if uploaded_files else None
+if st.session_state.get('upload_key') != upload_key:
+    st.session_state['upload_key'] = upload_key
+    st.session_state['staged_files'] = handle_file_upload(uploaded_files) if uploaded_files else {}
+current_files_hash = get_files_hash(st.session_state['staged_files']) if uploaded_files else None
 
-# Detect if files have changed and init models
+# Detect if files have changed and init the index
 if 'files_hash' in st.session_state:
     if st.session_state['files_hash'] != current_files_hash:
         st.session_state['files_hash'] = current_files_hash
-        if 'chat_engine' in st.session_state:
-            del st.session_state['chat_engine']
-            st.cache_resource.clear()
+        if 'index' in st.session_state:
+            del st.session_state['index']
+            st.session_state['memory'] = ChatMemoryBuffer.from_defaults(token_limit=4000)
         if uploaded_files:
-            st.session_state['temp_dir'] = handle_file_upload(uploaded_files)
             st.sidebar.success("Files uploaded successfully.")
-            if 'chat_engine' not in st.session_state:
-                st.session_state['chat_engine'] = init_models()
+            if 'index' not in st.session_state:
+                st.session_state['index'] = shared_index()
+                update_index(st.session_state['index'], st.session_state['staged_files'])
         else:
             st.sidebar.error("No uploaded files.")
 else:
     if uploaded_files:
         st.session_state['files_hash'] = current_files_hash
-        st.session_state['temp_dir'] = handle_file_upload(uploaded_files)
         st.sidebar.success("Files uploaded successfully.")
-        if 'chat_engine' not in st.session_state:
-            st.session_state['chat_engine'] = init_models()
+        if 'index' not in st.session_state:
+            st.session_state['index'] = shared_index()
+            update_index(st.session_state['index'], st.session_state['staged_files'])
     else:
         st.sidebar.error("No uploaded files.")
 
 # Initialize chat history
 if 'messages' not in st.session_state:
     st.session_state.messages = [{"role": "assistant", "content": "你好，我是你的助手，你需要什么帮助吗？"}]
+# The chat memory belongs to the session, not to the index or the LLM
+if 'memory' not in st.session_state:
+    st.session_state['memory'] = ChatMemoryBuffer.from_defaults(token_limit=4000)
 
 # Display chat messages from history
 for message in st.session_state.messages:
@@ -138,7 +403,9 @@ if prompt := st.chat_input("Ask a question about Datawhale:"):
         st.markdown(prompt)
 
     # Generate response
-    response = st.session_state['chat_engine'].stream_chat(prompt)
+    chat_engine = build_chat_engine(st.session_state['index'], st.session_state['staged_files'], generation_config,
+                                    st.session_state['memory'])
+    response = chat_engine.stream_chat(prompt)
     with st.chat_message('assistant'):
         message_placeholder = st.empty()
         res = ''
@@ -0,0 +1,79 @@
+import io
+import os
+import tempfile
+
+# The app reads its storage directory when it is imported
+os.environ.setdefault("RAG_STORAGE_DIR", tempfile.mkdtemp())
+
+import pytest
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+
+import ollama_llamaindex_rga as rag
+
+
+def upload(name, text):
+    uploaded_file = io.BytesIO(text.encode())
+    uploaded_file.name = name
+    return uploaded_file
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag, "STORAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(rag, "INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(rag, "STAGING_DIR", str(tmp_path / "uploads"))
+    # Every chunk gets the same vector: only the filter decides what is retrieved
+    monkeypatch.setattr(Settings, "embed_model", MockEmbedding(embed_dim=8))
+    return tmp_path
+
+
+def retrieved_files(index, staged):
+    return {node.metadata[rag.FILE_HASH_KEY] for node in rag.session_retriever(index, staged).retrieve("route grades")}
+
+
+def test_session_does_not_retrieve_files_of_another_session(storage):
+    index = VectorStoreIndex([])
+    staged_a = rag.handle_file_upload([upload("a.txt", "Session A: the red route is graded 6a.")])
+    staged_b = rag.handle_file_upload([upload("b.txt", "Session B: the blue route is graded 7c.")])
+    rag.update_index(index, staged_a)
+    rag.update_index(index, staged_b)
+
+    assert retrieved_files(index, staged_a) == set(staged_a)
+    assert retrieved_files(index, staged_b) == set(staged_b)
+
+
+def test_changed_file_replaces_its_old_chunks(storage):
+    index = VectorStoreIndex([])
+    old = rag.handle_file_upload([upload("a.txt", "The red route is graded 6a.")])
+    rag.update_index(index, old)
+    new = rag.handle_file_upload([upload("a.txt", "The red route was regraded 6b.")])
+    rag.update_index(index, new)
+
+    # The old version is still staged (another session may use it), but this session only sees the new one
+    assert set(rag.indexed_files(index)) == set(old) | set(new)
+    assert retrieved_files(index, new) == set(new)
+
+
+def test_index_persists_file_hashes(storage):
+    staged = rag.handle_file_upload([upload("a.txt", "The red route is graded 6a.")])
+    rag.update_index(VectorStoreIndex([]), staged)
+
+    assert retrieved_files(rag.load_index(), staged) == set(staged)
+
+
+def test_embedding_cache_keeps_chunks_not_queries(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(rag.CachedOllamaEmbedding, "get_general_text_embeddings",
+                        lambda self, texts: calls.extend(texts) or [[float(len(text))] for text in texts])
+    monkeypatch.setattr(rag.CachedOllamaEmbedding, "get_general_text_embedding",
+                        lambda self, text: calls.append(text) or [float(len(text))])
+    embed_model = rag.CachedOllamaEmbedding(model_name="nomic-embed-text", cache_path=str(tmp_path / "cache.sqlite"))
+
+    assert embed_model.get_text_embedding_batch(["red", "blue", "red"]) == [[3.0], [4.0], [3.0]]
+    assert embed_model.get_text_embedding_batch(["blue"]) == [[4.0]]
+    embed_model.get_query_embedding("which route is red?")
+    embed_model.get_query_embedding("which route is red?")
+
+    assert calls == ["red", "blue", "which route is red?", "which route is red?"]
+    assert embed_model._db.execute("SELECT COUNT(*) FROM embeddings").fetchone() == (2,)
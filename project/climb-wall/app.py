@@ -1,32 +1,41 @@
-from flask import Flask,render_template,request, jsonify
+from flask import Flask,render_template,request, jsonify, g, Response
 from flask_cors import CORS
 import os
 import cv2
 import numpy as np
-import torch
-import torchvision
-from collections import deque
 import base64
+import json
+import time
 
-
-from segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator
+# torch, torchvision and segment_anything are imported by loadModel() on the
+# inference worker, so that the server is up before they are loaded
 
 from arg_parse import parser
-
-print("PyTorch version:", torch.__version__)
-print("Torchvision version:", torchvision.__version__)
-print("CUDA is available:", torch.cuda.is_available())
+from decoder_backend import TorchDecoder, load_decoder
+from embedding_cache import EmbeddingCache, image_key
+from history import pack_record, unpack_record
+from hold_index import hold_info
+from image_codec import encode_image, negotiate
+from inference_worker import InferenceWorker, Job
+import mask_render
+import rle
+import rpc
+from metrics import CONTENT_TYPE, Metrics, server_timing
+from object_prompts import group_prompts, predict_objects
+from session_store import SessionStore, new_token, valid_token
+from tiles import TileGrid, prompt_bbox, shift_record, tile_key, to_tile, union_records
 
 class Mode:
     def __init__(self) -> None:
         self.IAMGE = 1
         self.MASKS = 2
         self.CLEAR = 3
-        self.P_POINT = 4
-        self.N_POINT = 5
+        self.P_POINT = "p_point"
+        self.N_POINT = "n_point"
         self.BOXES = "box"
         self.INFERENCE = "inference"
-        self.UNDO = 8
+        self.UNDO = "undo"
+        self.REDO = "redo"
         self.COLOR_MASKS = 9
 
 MODE = Mode()
@@ -35,26 +44,32 @@ class Web_App:
     def __init__(self, args):
         self.args = args
         self.app = Flask(__name__)
-        CORS(self.app)
-        self.loadModel()
-        
-        # Store the image globally on the server
-        self.origin_image_rgba = None
-        self.processed_img_rgba = None
-        self.masked_img = None
-        self.colorMasks = None
-        self.imgSize = None
-        self.imgIsSet = False           # To run self.predictor.set_image() or not
-
-        self.mode = "box"           # p_point / n_point / box
-        self.curr_view = "image"
-        self.queue = deque(maxlen=1000)  # For undo list
-        self.prev_inputs = deque(maxlen=500)
-
-        self.points = []
-        self.points_label = []
-        self.boxes = []
-        self.masks = []
+        CORS(self.app, expose_headers=self.FRAME_HEADERS)
+        self.embedding_cache = EmbeddingCache(
+            cache_dir=args.embedding_cache_dir or None,
+            max_items=args.embedding_cache_items,
+            max_disk_bytes=args.embedding_cache_mb << 20,
+        )
+        self.metrics = Metrics()
+        # The model is shared by every session and only used on the worker thread,
+        # the image state lives in self.sessions
+        self.worker = InferenceWorker(metrics=self.metrics)
+        self.predictor = None
+        self.decoder = TorchDecoder()   # prompt encoder + mask decoder backend, see loadModel()
+        self.predictor_key = None       # image_key of the features currently held by self.predictor
+        # The first job of the worker, everything submitted meanwhile waits behind it
+        self.model_job = self.worker.submit(None, "load", self.loadModel)
+        self.sessions = SessionStore(
+            spill_dir=args.session_dir or None,
+            max_sessions=args.max_sessions,
+            idle_seconds=args.session_idle_minutes * 60,
+            expire_seconds=args.session_expire_hours * 3600,
+            history_bytes=args.history_mb << 20,
+            display_size=args.display_size,
+            on_restore=self.restore_session,
+            in_use=self.worker.has_jobs,
+        )
+        self.add_metrics()
         
         home_dir = os.path.expanduser("~")
         self.save_path = os.path.join(home_dir, "Downloads")
@@ -63,22 +78,127 @@ class Web_App:
         
         
     def loadModel(self):
-        # load model
+        # load model, on the worker thread while the server already answers (see /ready)
+        import torch
+        import torchvision
+        from segment_anything import SamPredictor
+        from model_loader import build_sam
+
+        print("PyTorch version:", torch.__version__)
+        print("Torchvision version:", torchvision.__version__)
+        print("CUDA is available:", torch.cuda.is_available())
         print("Loading model...", end="")
-        device = args.device
+        device = self.args.device
         print(f"using {device}...", end="")
-        sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
-        sam.to(device=device)
+        sam = build_sam(self.args.model_type, self.args.checkpoint, device, mmap=self.args.checkpoint_mmap)
 
         self.predictor = SamPredictor(sam)
+        # The image encoder stays in torch, the decoder runs on every click and may be an exported model
+        self.decoder = load_decoder(self.args.decoder_onnx, self.args.decoder_threads)
         print("Done")
+        return {}
+
+    def add_metrics(self):
+        m = self.metrics
+        self.request_seconds = m.histogram("request_seconds", "Latency of HTTP requests.", ["endpoint"])
+        self.requests_total = m.counter("requests_total", "HTTP requests by status code.", ["endpoint", "code"])
+        m.gauge("model_loaded", "1 once the model is loaded.", lambda: int(self.model_job.status == Job.DONE))
+        m.gauge("sessions", "Sessions held in memory.", lambda: len(self.sessions))
+        m.gauge("session_memory_bytes", "Bytes held by the sessions in memory.",
+                lambda: {(kind,): v for kind, v in self.sessions.memory_usage().items()}, ["kind"])
+        m.gauge("embedding_cache_items", "Image embeddings held in memory.", lambda: len(self.embedding_cache.memory))
+        m.gauge("embedding_cache_bytes", "Bytes of the image embedding cache.",
+                lambda: {("memory",): self.embedding_cache.memory_bytes(), ("disk",): self.embedding_cache.disk_bytes()},
+                ["store"])
+
+    def metrics_text(self):
+        """ GET /metrics, Prometheus text format """
+        return Response(self.metrics.render(), content_type=CONTENT_TYPE)
+
+    def ready(self):
+        """ 200 once the model is loaded, 503 while it is loading (or if it failed to load) """
+        job = self.model_job
+        body = {'ready': job.status == Job.DONE, 'status': job.status, 'queue': self.worker.queue_length()}
+        if job.error is not None:
+            body['error'] = job.error
+        return jsonify(body), 200 if body['ready'] else 503
     
+    SESSION_COOKIE = "climb_session"
+    SESSION_HEADER = "X-Session-Id"
+    FRAME_HEADERS = ["X-Frame-Version", "X-Image-Size", "X-Full-Size", "X-Patch-Rect", "X-Session-Id", "X-Job-Id",
+                     "Server-Timing", "X-Deleted-Holds"]
+
     def route(self):
+        self.app.before_request(self.start_spans)
+        self.app.before_request(self.bind_session)
+        self.app.after_request(self.save_session_cookie)
+        self.app.after_request(self.finish_spans)
+        self.app.teardown_request(self.stop_spans)
         self.app.route('/', methods=['GET'])(self.home)
+        self.app.route('/ready', methods=['GET'])(self.ready)
+        self.app.route('/metrics', methods=['GET'])(self.metrics_text)
         self.app.route('/upload_image', methods=['POST'])(self.upload_image)
         self.app.route('/button_click', methods=['POST'])(self.button_click)
         self.app.route('/box_receive', methods=['POST'])(self.box_receive)
+        self.app.route('/p_point_receive', methods=['POST'])(self.p_point_receive)
+        self.app.route('/n_point_receive', methods=['POST'])(self.n_point_receive)
+        self.app.route('/export', methods=['POST'])(self.export)
+        self.app.route('/masks/export', methods=['POST'])(self.export_masks)
+        self.app.route('/masks/import', methods=['POST'])(self.import_masks)
+        self.app.route('/holds', methods=['GET'])(self.list_holds)
+        self.app.route('/holds/hit', methods=['POST'])(self.hit_hold)
+        self.app.route('/holds/select', methods=['POST'])(self.select_hold)
+        self.app.route('/holds/delete', methods=['POST'])(self.delete_hold)
+        self.app.route('/frame', methods=['POST'])(self.frame)
+        self.app.route('/jobs/<job_id>', methods=['GET'])(self.job_status)
+        self.app.route('/rpc', methods=['POST'])(self.rpc_call)
     
+    def start_spans(self):
+        # Stages timed by this request thread are collected in g.spans, see metrics.py
+        g.request_start = time.perf_counter()
+        g.spans = self.metrics.bind_spans([])
+
+    def finish_spans(self, response):
+        if g.spans:
+            response.headers["Server-Timing"] = server_timing(g.spans)
+        endpoint = request.endpoint or "unknown"
+        self.request_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+        self.requests_total.inc(endpoint=endpoint, code=response.status_code)
+        return response
+
+    def stop_spans(self, exc=None):
+        self.metrics.bind_spans(None)
+
+    def job_spans(self, job):
+        """ Add the spans of a job this request waited for to the request's Server-Timing """
+        if job.started is not None:
+            g.spans.append(("queue", job.started - job.created))
+        g.spans.extend(job.spans)
+
+    def bind_session(self):
+        # 每个浏览器一个 session, token 放在 cookie 里 (或者 X-Session-Id 头)
+        token = request.headers.get(self.SESSION_HEADER) or request.cookies.get(self.SESSION_COOKIE)
+        g.new_session = not valid_token(token)
+        g.session_token = new_token() if g.new_session else token
+
+    def save_session_cookie(self, response):
+        if g.get("new_session"):
+            response.set_cookie(self.SESSION_COOKIE, g.session_token, httponly=True, samesite="Lax")
+        response.headers[self.SESSION_HEADER] = g.get("session_token", "")
+        if g.get("job_id"):
+            response.headers["X-Job-Id"] = g.job_id
+        return response
+
+    def session(self):
+        return self.sessions.get(g.session_token)
+
+    def restore_session(self, session):
+        # Rebuild the overlay of a session that was spilled to disk
+        if session.origin_image_rgba is None:
+            return
+        session.processed_img_rgba, session.masked_img = self.updateMaskImg(session)
+        self.get_colored_masks_image(session)
+
     def home(self):
         return render_template('index.html', default_save_path=self.save_path)
 
@@ -87,284 +207,900 @@ class Web_App:
             return jsonify({'error': 'No image in the request'}), 400
         
         file = request.files['image']
+        session = self.session()
+        
+        with self.metrics.span("decode"):
+            image, image_rgb = self.decode_image(file.read())
         
+        key = image_key(image_rgb, prefix=self.args.model_type) # 同一张图片的 embedding 只算一次
+
+        with session.lock:
+            # Store the image in the session of this client, SAM uses a view of its color channels
+            session.image_key = key
+            session.set_image(image)
+            session.bump_frame()
+            
+            # Reset inputs and masks
+            session.reset_inputs()
+            session.reset_masks()
+            session.history.clear()
+        # Compute (or restore) the image embedding now so that the first inference is fast,
+        # on the worker thread: the upload returns right away
+        token = session.token
+        job = self.worker.submit(token, "embed", lambda: self.embed_job(token, key))
+
+        return jsonify({'message': "Uploaded image, successfully initialized", 'job_id': job.id})
+    
+    def decode_image(self, data):
+        """ Uploaded file bytes -> (RGBA image, RGB view of it for SAM)
+
+        The 4 channel image is the only full-resolution copy kept, what SAM sees
+        are its first three channels, as with a COLOR_RGBA2RGB copy.
+        """
         # file.read() 读取上传的文件内容，返回一个字节流
         # np.frombuffer 使用NumPy将字节流转换为uint8类型的数组
         # cv2.imdecode 使用OpenCV解码图像数据
         # cv2.IMREAD_COLOR标志表示以彩色模式加载图像（3通道BGR格式）
         # image = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
-        image = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_UNCHANGED)
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
         
-        print("image IMREAD_COLOR ", image.shape[-1])
-        if image.shape[-1] == 3:  # 如果是RGB图像, 转换为RGBA
+        if image.ndim == 2:  # 灰度图
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGBA)
+        elif image.shape[-1] == 3:  # 如果是RGB图像, 转换为RGBA
             image = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
-            print("image IMREAD_COLOR ", image.shape[-1])
-        
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
-        
-        
-        # Store the image globally
-        self.sam_image_rgb = image_rgb # 用于 sam 查询物体，必须是 rgb 格式
-        self.origin_image_rgba = image
-        self.processed_img_rgba = image
-        self.masked_img = np.zeros_like(image)
-        self.colorMasks = np.zeros_like(image)
-        self.imgSize = image.shape
-        print("imgSize ", self.imgSize)
-        print("sam_imageSize ",image_rgb.shape)
         
-        # Reset inputs and masks and image ebedding
-        self.imgIsSet = False
-        self.reset_inputs()
-        self.reset_masks()
-        self.queue.clear()
-        self.prev_inputs.clear()
-        torch.cuda.empty_cache()
-        
-        self.init_predictor()
+        return image, image[:, :, :3]
 
-        return "Uploaded image, successfully initialized"
-    
-    def init_predictor(self):
+    def init_predictor(self, key, image_rgb):
+        """ Load the features of an image into the predictor, only called on the worker thread """
+        if self.predictor is None:
+            raise RuntimeError(f"Model is not loaded: {self.model_job.error or self.model_job.status}")
         # Image is set ?
-        if self.imgIsSet == False:
-            self.predictor.set_image(self.sam_image_rgb, image_format="RGB")
-            self.imgIsSet = True
-            print("Image set!")
+        if self.predictor_key != key:
+            with self.metrics.span("embedding_load"):
+                cached = self.embedding_cache.load_predictor(key, self.predictor)
+            if not cached:
+                with self.metrics.span("set_image"):
+                    self.predictor.set_image(image_rgb, image_format="RGB")
+                with self.metrics.span("embedding_store"):
+                    self.embedding_cache.store_predictor(key, self.predictor)
+            self.predictor_key = key
+
+    def embed_job(self, token, key):
+        session = self.sessions.get(token)
+        with session.lock:
+            if session.image_key != key:
+                return {'stale': True}     # another image was uploaded meanwhile
+            image_rgb = session.sam_image_rgb
+        grid = self.tile_grid(image_rgb)
+        if grid is not None:
+            return {'tiles': len(grid)}     # tile embeddings are computed when a prompt needs them
+        self.empty_cache()
+        self.init_predictor(key, image_rgb)
+        return {}
+
+    def empty_cache(self):
+        """ Release the cached GPU memory of the previous image before computing a new embedding """
+        import torch
+        torch.cuda.empty_cache()
+
+    def tile_grid(self, image):
+        """ The TileGrid of an image segmented tile by tile (larger than --tile_size), None otherwise """
+        size = self.args.tile_size
+        if size <= 0 or max(image.shape[:2]) <= size:
+            return None
+        return TileGrid(image.shape, size, self.args.tile_overlap)
+
+    def tile_image(self, key, image, tile):
+        """ (key, image) of a tile, to use instead of those of the whole image """
+        x0, y0, x1, y1 = tile
+        return tile_key(key, tile), image[y0:y1, x0:x1]
+
+    def inference_job(self, token):
+        """ Worker side of an inference click: predict the pending prompts of a session, draw the new masks
+
+        The session is only locked to read the prompts and to store the masks,
+        not while the model runs, so the client can keep adding boxes meanwhile.
+        """
+        session = self.sessions.get(token)
+        with session.lock:
+            if session.origin_image_rgba is None:
+                return {'version': session.frame_version, 'masks': 0}
+            key, image_rgb = session.image_key, session.sam_image_rgb
+            points = np.array(session.points)
+            labels = np.array(session.points_label)
+            boxes = np.array(session.boxes)
+            mask_input = session.logits
+            # The refined logits are those of a single object, several boxes are decoded as separate objects
+            logits = mask_input if session.logits_prompts == (len(points), len(boxes)) and len(boxes) <= 1 else None
+            logits_tile = session.logits_tile
+        if self.tile_grid(image_rgb) is None:
+            self.init_predictor(key, image_rgb)
+        with self.metrics.span("predict"):
+            if logits is not None:
+                # The point refinement already has the logits of exactly these prompts: upsample them
+                # to full resolution, no decoder call
+                new_masks = self.commit_logits(key, image_rgb, logits, logits_tile)
+            else:
+                new_masks = self.inference(key, image_rgb, points, labels, boxes, mask_input)
+
+        with session.lock:
+            if session.image_key != key:
+                return {'stale': True, 'version': session.frame_version, 'masks': 0}
+            # Only the prompts used above are consumed, the ones added meanwhile wait for the next job
+            del session.points[:len(points)]
+            del session.points_label[:len(labels)]
+            del session.boxes[:len(boxes)]
+            session.logits = session.logits_prompts = None
+            session.add_holds(new_masks)
+            # Update masks image to show, only the bounding boxes of the new masks are redrawn
+            session.processed_img_rgba, session.masked_img = self.updateMaskImg(session, new_masks)
+            self.get_colored_masks_image(session)
+            if len(new_masks) > 0:
+                # An inference without a mask changes nothing to undo, and keeps the redo steps
+                # The consumed prompts go with the step: undoing it makes them pending again
+                session.history.push({"kind": "inference", "records": [pack_record(m) for m in new_masks],
+                                      "points": points, "labels": labels, "boxes": boxes})
+                session.bump_frame(session.composite.dirty)
+            elif session.preview_region is not None:
+                session.bump_frame(session.preview_region)  # nothing committed, still erase the preview
+            return {'version': session.frame_version, 'masks': len(new_masks)}
+
+    def refine_job(self, token):
+        """ Worker side of a point click: one low-res decoder call, previewed at the display level
+
+        The logits of the previous prediction are fed back as mask_input, the full
+        resolution mask is only computed when the points are committed by inference_job.
+        """
+        session = self.sessions.get(token)
+        with session.lock:
+            if session.origin_image_rgba is None:
+                return {'version': session.frame_version}
+            key, image_rgb = session.image_key, session.sam_image_rgb
+            points = np.array(session.points, dtype=np.float32).reshape(-1, 2)
+            labels = np.array(session.points_label, dtype=np.int32)
+            # A single pending box is refined together with the points, several boxes are separate objects
+            box = session.boxes[0] if len(session.boxes) == 1 else None
+            prompts = (len(points), len(session.boxes))
+            mask_input, logits_tile = session.logits, session.logits_tile
+        grid = self.tile_grid(image_rgb)
+        tile = None if grid is None or len(points) == 0 else grid.best(prompt_bbox(points, box))
+        if len(points) == 0 or (grid is not None and tile is None):
+            # Prompts wider than a tile are only segmented when they are committed
+            logits = None
+        else:
+            model_key, model_image = key, image_rgb
+            if tile is not None:
+                # The points are refined on one tile, the logits of another one are no mask_input
+                mask_input = mask_input if tile == logits_tile else None
+                model_key, model_image = self.tile_image(key, image_rgb, tile)
+                points = points - tile[:2]
+                box = None if box is None else np.asarray(box) - np.array(tile[:2] * 2)
+            self.init_predictor(model_key, model_image)
+            with self.metrics.span("predict"):
+                logits, scores = self.predict_low_res(model_key, model_image, points, labels, box, mask_input)
+            logits = logits[np.argmax(scores)][None]
+
+        with session.lock:
+            if session.image_key != key or (len(session.points), len(session.boxes)) != prompts:
+                # The prompts changed meanwhile, the refine job queued by that change will run next
+                return {'stale': True, 'version': session.frame_version}
+            session.logits, session.logits_prompts = logits, (None if logits is None else prompts)
+            session.logits_tile = tile
+            preview = None
+            if logits is not None:
+                display = session.composite.origin
+                mask = self.preview_mask(logits, display.shape, session.origin_image_rgba.shape, tile)
+                preview = mask_render.mask_record(mask, "preview")
+            self.show_preview(session, preview)
+            return {'version': session.frame_version}
+
+    def show_preview(self, session, record):
+        """ Draw an uncommitted display-level mask over the composite, the composite is left untouched """
+        if record is None and session.preview_region is None:
+            return
+        frame, region = session.composite.image(), None
+        if record is not None:
+            with self.metrics.span("composite"):
+                frame = session.copy_to_preview(frame)
+                region = mask_render.render_masks(frame, [record])
+        session.processed_img_rgba = frame
+        session.bump_frame(region or session.preview_region, preview=region)
+
+    def job_status(self, job_id):
+        """ GET /jobs/<job_id>?wait=seconds, long-polls until the job is finished or wait expires """
+        job = self.worker.get(job_id)
+        if job is None or job.session_key != g.session_token:
+            return jsonify({'error': 'Unknown job'}), 404
+        wait = min(max(request.args.get('wait', 0, type=float), 0), 30)
+        if wait > 0:
+            job = job.wait(wait)
+        return jsonify(job.to_dict())
+
+    def frame(self):
+        """ The current frame of the session, with the same options as button_click """
+        session = self.session()
+        if session.processed_img_rgba is None:
+            return jsonify({'error': 'No image available'}), 400
+        with session.lock:
+            return self.image_response(session, session.processed_img_rgba, request.get_json(silent=True) or {})
         
     def button_click(self):
-        if self.processed_img_rgba is None:
+        session = self.session()
+        if session.processed_img_rgba is None:
             return jsonify({'error': 'No image available for processing'}), 400
 
         data = request.get_json()
         button_id = data['button_id']
-        image_type = data['image_type']
-        print(f"Button {button_id} clicked， image_type {image_type}")
+        image_type = data.get('image_type')
 
         # Info
         info = {
             'event': 'button_click',
             'data': button_id,
             'image_type': image_type,
+            'options': data,
         }
 
+        if button_id == MODE.INFERENCE:
+            # The model runs on the worker thread. With "async" the job id is returned right
+            # away (poll /jobs/<job_id>, then fetch /frame), otherwise wait for the result here
+            job = self.submit_inference(session)
+            if data.get('async'):
+                return jsonify(job.to_dict()), 202
+            job = job.wait()
+            self.job_spans(job)
+            if job.status == Job.FAILED:
+                return jsonify({'error': job.error}), 500
+
         # Process and return the image
-        return self.process_image(self.processed_img_rgba, info)
+        with session.lock:
+            return self.process_image(session, session.processed_img_rgba, info)
     
     
     def box_receive(self):
-        if self.processed_img_rgba is None:
+        session = self.session()
+        if session.processed_img_rgba is None:
             return jsonify({'error': 'No image available for processing'}), 400
 
         data = request.get_json()
-        self.boxes.append(np.array([
-            data['x1'], data['y1'],
-            data['x2'], data['y2']
-        ], dtype=np.float32))
+        self.add_box(session, data['x1'], data['y1'], data['x2'], data['y2'])
+        return "server received boxes"
 
-        # Add command to queue list
-        self.queue.append("box")
+    def add_box(self, session, x1, y1, x2, y2):
+        with session.lock:
+            box = np.array([x1, y1, x2, y2], dtype=np.float32)
+            session.boxes.append(box)
 
-        return "server received boxes"
+            # Add command to undo list
+            session.history.push({"kind": "box", "box": box})
+            return len(session.boxes)
+
+    def p_point_receive(self):
+        return self.point_receive(1)
+
+    def n_point_receive(self):
+        return self.point_receive(0)
+
+    def point_receive(self, label):
+        """ A positive (label 1) or negative (label 0) point, answered with a low-res preview
+
+        With "async" the refine job id is returned right away, like button_click.
+        """
+        session = self.session()
+        if session.processed_img_rgba is None:
+            return jsonify({'error': 'No image available for processing'}), 400
+
+        data = request.get_json()
+        job = self.add_point(session, data['x'], data['y'], label)
+        if data.get('async'):
+            return jsonify(job.to_dict()), 202
+        job = job.wait()
+        self.job_spans(job)
+        if job.status == Job.FAILED:
+            return jsonify({'error': job.error}), 500
+        with session.lock:
+            return self.image_response(session, session.processed_img_rgba, data)
+
+    def add_point(self, session, x, y, label):
+        """ Add a prompt point, return the refine job that previews it """
+        with session.lock:
+            point = np.array([x, y], dtype=np.float32)
+            session.points.append(point)
+            session.points_label.append(label)
+            session.history.push({"kind": "point", "point": point, "label": label})
+        return self.submit_refine(session)
+
+    def submit_refine(self, session):
+        token = session.token
+        return self.worker.submit(token, "refine", lambda: self.refine_job(token))
+
+    def submit_inference(self, session):
+        token = session.token
+        return self.worker.submit(token, "inference", lambda: self.inference_job(token))
     
-    def process_image(self, image, info):
-        processed_image = image
-        image_type = info["image_type"]
-        
+    def process_image(self, session, image, info):
         if info['event'] == 'button_click':
             id = info['data']
             if (id == MODE.BOXES):
-                self.mode = "box"
-            elif (id == MODE.INFERENCE):
-                print("INFERENCE")
-                points = np.array(self.points)
-                labels = np.array(self.points_label)
-                boxes = np.array(self.boxes)
-                print(f"Points shape {points.shape}", points)
-                print(f"Labels shape {labels.shape}", labels)
-                print(f"Boxes shape {boxes.shape}", boxes)
-                prev_masks_len = len(self.masks)
-                print(f"len masks {prev_masks_len}")
-                processed_image, self.masked_img = self.inference(self.origin_image_rgba, points, labels, boxes)
-                curr_masks_len = len(self.masks)
-                self.get_colored_masks_image()
-                self.processed_img_rgba = processed_image
-                self.prev_inputs.append({
-                    "points": self.points,
-                    "labels": self.points_label,
-                    "boxes": self.boxes
-                })
-                self.reset_inputs()
-                self.queue.append(f"inference-{curr_masks_len - prev_masks_len}")
+                session.mode = "box"
+            elif (id == MODE.P_POINT or id == MODE.N_POINT):
+                session.mode = id
+            elif (id == MODE.UNDO):
+                self.undo(session)
+            elif (id == MODE.REDO):
+                self.redo(session)
         
-        if (image_type == "png"):
-            _, buffer = cv2.imencode('.png', processed_image)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            return jsonify({'image': img_base64, 'image_type': image_type})
+        return self.image_response(session, session.processed_img_rgba, info.get('options', {}))
+
+    def undo(self, session):
+        step = session.history.undo()
+        if step is None:
+            return step
+        if step["kind"] == "box":
+            if len(session.boxes) > 0:
+                session.boxes.pop()
+            self.prompts_changed(session)
+        elif step["kind"] == "point":
+            if len(session.points) > 0:
+                session.points.pop()
+                session.points_label.pop()
+            # The fed back logits already include the removed point, start over from the remaining ones
+            session.logits = session.logits_prompts = None
+            self.prompts_changed(session)
+        elif step["kind"] == "inference":
+            self.delete_holds(session, [packed["id"] for packed in step["records"]])
+            # They were consumed from the front, the prompts added during the inference come after them
+            session.points[:0] = list(step["points"])
+            session.points_label[:0] = step["labels"].tolist()
+            session.boxes[:0] = list(step["boxes"])
+            session.logits = session.logits_prompts = None
+            self.prompts_changed(session)
+        elif step["kind"] == "delete":
+            self.restore_holds(session, [unpack_record(packed) for packed in step["records"]])
+        elif step["kind"] == "import":
+            self.replace_holds(session, [packed["id"] for packed in step["records"]],
+                               [unpack_record(packed) for packed in step["removed"]])
+        return step
+
+    def redo(self, session):
+        step = session.history.redo()
+        if step is None:
+            return step
+        if step["kind"] == "box":
+            session.boxes.append(step["box"])
+            self.prompts_changed(session)
+        elif step["kind"] == "point":
+            session.points.append(step["point"])
+            session.points_label.append(step["label"])
+            self.prompts_changed(session)
+        elif step["kind"] == "inference":
+            # The redone inference consumes its prompts again, those added after it stay pending
+            del session.points[:len(step["points"])]
+            del session.points_label[:len(step["labels"])]
+            del session.boxes[:len(step["boxes"])]
+            session.logits = session.logits_prompts = None
+            self.restore_holds(session, [unpack_record(packed) for packed in step["records"]])
+            self.prompts_changed(session)
+        elif step["kind"] == "delete":
+            self.delete_holds(session, [packed["id"] for packed in step["records"]])
+        elif step["kind"] == "import":
+            self.replace_holds(session, [packed["id"] for packed in step["removed"]],
+                               [unpack_record(packed) for packed in step["records"]])
+        return step
+
+    def delete_holds(self, session, ids):
+        """ Remove holds by id, only the bounding boxes of the removed masks are redrawn """
+        removed = session.remove_holds(ids)
+        if not removed:
+            return removed
+        session.composite.remove(session.masks, removed)
+        self.after_masks_changed(session)
+        return removed
+
+    def delete_step(self, session, ids=None):
+        """ Delete holds by id (default the current selection) as an undoable step, return the removed records """
+        removed = self.delete_holds(session, list(session.selected) if ids is None else ids)
+        if removed:
+            session.history.push({"kind": "delete", "records": [pack_record(m) for m in removed]})
+        return removed
+
+    def restore_holds(self, session, records):
+        """ Put removed holds back at their place in the drawing order """
+        on_top = not session.masks or not records or session.masks[-1]["id"] < min(r["id"] for r in records)
+        session.add_holds(records)
+        if on_top:
+            session.composite.add(records)
+        else:
+            session.composite.insert(session.masks, records)
+        self.after_masks_changed(session)
+
+    def replace_holds(self, session, ids, records):
+        """ Remove holds by id and add records instead, the composite is rebuilt once (mask import, its undo / redo) """
+        removed = session.remove_holds(ids)
+        session.add_holds(records)
+        session.composite.rebuild(session.masks)
+        self.after_masks_changed(session)
+        return removed
+
+    def list_holds(self):
+        """ Every committed hold of the session: id, full-resolution bbox [x, y, w, h] and area, in drawing order """
+        session = self.session()
+        with session.lock:
+            return jsonify({'holds': [hold_info(m) for m in session.masks], 'selected': session.selected})
+
+    def hit_hold(self):
+        """ The hold under a full-resolution point {"x", "y"}, "hold" is null when there is none """
+        session = self.session()
+        if session.holds is None:
+            return jsonify({'error': 'No image available'}), 400
+        data = request.get_json()
+        with session.lock:
+            record = session.holds.hit(data['x'], data['y'])
+            return jsonify({'hold': None if record is None else hold_info(record)})
+
+    def select_hold(self):
+        """ Select the hold under {"x", "y"} (or {"id"}), with "add": true toggle it in the current selection
+
+        Clicking next to every hold clears the selection. The selection is drawn
+        by the client from the returned bboxes, the frame is not re-rendered.
+        """
+        session = self.session()
+        if session.holds is None:
+            return jsonify({'error': 'No image available'}), 400
+        data = request.get_json()
+        with session.lock:
+            if data.get('id') is not None:
+                record = session.holds.get(data['id'])
+            else:
+                record = session.holds.hit(data['x'], data['y'])
+            if not data.get('add'):
+                session.selected = [] if record is None else [record['id']]
+            elif record is not None:
+                if record['id'] in session.selected:
+                    session.selected.remove(record['id'])
+                else:
+                    session.selected.append(record['id'])
+            selected = [hold_info(session.holds.get(i)) for i in session.selected]
+            return jsonify({'hold': None if record is None else hold_info(record), 'selected': selected})
+
+    def delete_hold(self):
+        """ Delete holds, {"ids": [...]} or the current selection, answered with the frame (same options as button_click)
+
+        Only the bounding boxes of the deleted holds are redrawn, the deletion can be undone.
+        """
+        session = self.session()
+        if session.processed_img_rgba is None:
+            return jsonify({'error': 'No image available for processing'}), 400
+        data = request.get_json(silent=True) or {}
+        with session.lock:
+            removed = self.delete_step(session, data.get('ids'))
+            response = self.image_response(session, session.processed_img_rgba, data)
+            response.headers['X-Deleted-Holds'] = ",".join(str(m['id']) for m in removed)
+            return response
+
+    def prompts_changed(self, session):
+        """ Re-run the point preview after an undo / redo of a prompt, the job id goes out as X-Job-Id """
+        if len(session.points) > 0 or session.preview_region is not None:
+            self.show_preview(session, None)
+            g.job_id = self.submit_refine(session).id
+
+    def after_masks_changed(self, session):
+        session.processed_img_rgba, session.masked_img = self.updateMaskImg(session, [])
+        self.get_colored_masks_image(session)
+        session.bump_frame(session.composite.dirty)
+
+    def export(self):
+        """ The masks at full resolution, rendered on demand
+
+        request JSON:
+        view:        "overlay" (default, masks on the wall photo) or "masks" (masks on a transparent image)
+        image_type:  png / jpeg / webp
+        quality:     jpeg / webp quality 1-100
+        """
+        session = self.session()
+        if session.origin_image_rgba is None:
+            return jsonify({'error': 'No image available for export'}), 400
+        options = request.get_json(silent=True) or {}
+        with session.lock, self.metrics.span("export_render"):
+            image = self.render_full_resolution(session, options.get('view', 'overlay'))
+        image_type = negotiate(options.get('image_type'), request.headers.get('Accept'))
+        with self.metrics.span("encode"):
+            body, mimetype = encode_image(image, image_type, options.get('quality'), options.get('png_compression'))
+        return Response(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename="wall.{image_type}"'})
+
+    def export_masks(self):
+        """ The committed masks as run-length encoded JSON, loadable by /masks/import
+
+        request JSON:
+        format:  "webui" (default, as sam/1.json: row-major "<count>F<count>T..." strings)
+                 or "coco" (compressed COCO RLE {"size", "counts"})
+        """
+        session = self.session()
+        if session.origin_image_rgba is None:
+            return jsonify({'error': 'No image available for export'}), 400
+        options = request.get_json(silent=True) or {}
+        fmt = options.get('format', 'webui')
+        if fmt not in ('webui', 'coco'):
+            return jsonify({'error': f'Unknown mask format {fmt}'}), 400
+        with session.lock, self.metrics.span("rle_encode"):
+            doc = rle.dump_masks(session.masks, session.origin_image_rgba.shape, fmt)
+        return Response(json.dumps(doc), mimetype="application/json",
+                        headers={'Content-Disposition': 'attachment; filename="masks.json"'})
+
+    def import_masks(self):
+        """ Replace the masks of the session by those of an RLE JSON document, answered with the frame
+
+        The document (sam/1.json, COCO annotations or /masks/export) is the
+        multipart "file", with the frame options (see image_response) as JSON
+        in the "options" field, or "document" of the request JSON next to the
+        frame options. With "append": true the current masks are kept. The
+        import can be undone.
+        """
+        session = self.session()
+        if session.origin_image_rgba is None:
+            return jsonify({'error': 'No image available for import'}), 400
+        if 'file' in request.files:
+            options = json.loads(request.form.get('options') or '{}')
+            doc = json.loads(request.files['file'].read())
         else:
-            _, buffer = cv2.imencode('.jpg', processed_image)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            return jsonify({'image': img_base64, 'image_type': image_type})
+            options = request.get_json(silent=True) or {}
+            doc = options.get('document')
+        if doc is None:
+            return jsonify({'error': 'No mask document in the request'}), 400
+        with session.lock:
+            key, shape = session.image_key, session.origin_image_rgba.shape
+        # Decoding does not need the session, other requests go on meanwhile
+        try:
+            with self.metrics.span("rle_decode"):
+                records = rle.load_masks(doc, shape)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'error': f'Invalid mask document: {e}'}), 400
+        with session.lock:
+            if session.image_key != key:
+                return jsonify({'error': 'The image changed during the import'}), 409
+            ids = [] if options.get('append') else [m["id"] for m in session.masks]
+            removed = self.replace_holds(session, ids, records)
+            session.history.push({"kind": "import", "records": [pack_record(m) for m in records],
+                                  "removed": [pack_record(m) for m in removed]})
+            response = self.image_response(session, session.processed_img_rgba, options)
+            response.headers['X-Deleted-Holds'] = ",".join(str(m['id']) for m in removed)
+            return response
+
+    def rpc_call(self):
+        """ JSON-RPC 2.0 (rpc.py): a batch of calls run in order, one round trip for a whole interaction
+
+        e.g. the pending boxes, the inference and the new frame:
+        [{"jsonrpc": "2.0", "method": "add_box", "params": {"x1", "y1", "x2", "y2"}, "id": 1}, ...,
+         {"jsonrpc": "2.0", "method": "infer", "id": 3},
+         {"jsonrpc": "2.0", "method": "frame", "params": {"base_version": 7}, "id": 4}]
+        The methods are those of rpc_methods(). A call that fails answers with
+        an error object, the following calls still run. When a frame call sends
+        an image the reply is multipart/form-data (rpc.multipart), the image in
+        the same response as the JSON.
+        """
+        attachments = {}
+        reply = rpc.handle(request.get_data(), self.rpc_methods(self.session(), attachments))
+        if reply is None:
+            return Response(status=204)
+        if attachments:
+            body, content_type = rpc.multipart(reply, attachments)
+            return Response(body, content_type=content_type)
+        return jsonify(reply)
+
+    def rpc_methods(self, session, attachments):
+        """ The JSON-RPC methods on a session, they do what the endpoint of the same name does
+
+        attachments:  {part name: (bytes, mimetype)}, filled with the binary results to send with the reply
+        """
+
+        def require_image():
+            if session.origin_image_rgba is None:
+                raise rpc.RpcError(rpc.SERVER_ERROR, "No image available")
+
+        def finish(job, wait):
+            if not wait:
+                return job.to_dict()
+            job = job.wait()
+            self.job_spans(job)
+            if job.status == Job.FAILED:
+                raise rpc.RpcError(rpc.SERVER_ERROR, job.error, job.to_dict())
+            return job.to_dict()
+
+        def add_box(x1, y1, x2, y2):
+            require_image()
+            return {'boxes': self.add_box(session, x1, y1, x2, y2)}
+
+        def add_point(x, y, label=1, wait=True):
+            """ With wait, the preview is in the frame of a following "frame" call """
+            require_image()
+            return finish(self.add_point(session, x, y, 1 if label else 0), wait)
+
+        def infer(wait=True):
+            require_image()
+            return finish(self.submit_inference(session), wait)
+
+        def history_step(step_fn):
+            require_image()
+            g.job_id = None
+            with session.lock:
+                step = step_fn(session)
+                return {'kind': None if step is None else step['kind'], 'version': session.frame_version,
+                        'job_id': g.job_id}
+
+        def delete_holds(ids=None):
+            require_image()
+            with session.lock:
+                removed = self.delete_step(session, ids)
+                return {'deleted': [m['id'] for m in removed], 'version': session.frame_version}
+
+        def list_holds():
+            with session.lock:
+                return {'holds': [hold_info(m) for m in session.masks], 'selected': session.selected}
+
+        def export(format='webui'):
+            require_image()
+            if format not in ('webui', 'coco'):
+                raise rpc.RpcError(rpc.INVALID_PARAMS, f"Unknown mask format {format}")
+            with session.lock, self.metrics.span("rle_encode"):
+                return rle.dump_masks(session.masks, session.origin_image_rgba.shape, format)
+
+        def frame(base_version=None, image_type=None, quality=None, png_compression=None):
+            """ The frame for a client at base_version, as a binary part of the same response
+
+            Nothing is sent when the client has it already ("unchanged"), the [x, y, w, h]
+            patch "rect" when the client has the previous version, else the whole frame.
+            "part" names the multipart part of the image, the options are those of image_response.
+            """
+            require_image()
+            with session.lock:
+                image = session.processed_img_rgba
+                version, dirty = session.frame_version, session.frame_dirty
+                h, w = image.shape[:2]
+                full_h, full_w = session.origin_image_rgba.shape[:2]
+                result = {'version': version, 'unchanged': base_version == version, 'rect': None,
+                          'size': [w, h], 'full_size': [full_w, full_h]}
+                if result['unchanged']:
+                    return result
+                if base_version is not None and base_version == version - 1 and dirty is not None:
+                    x0, y0, x1, y1 = dirty
+                    image = image[y0:y1, x0:x1]
+                    result['rect'] = [x0, y0, x1 - x0, y1 - y0]
+                image_type = negotiate(image_type, request.headers.get('Accept'))
+                with self.metrics.span("encode"):
+                    body, mimetype = encode_image(image, image_type, quality, png_compression)
+            part = f"frame-{len(attachments)}"
+            attachments[part] = (body, mimetype)
+            result.update(part=part, image_type=image_type)
+            return result
+
+        return {
+            'add_box': add_box,
+            'add_point': add_point,
+            'infer': infer,
+            'undo': lambda: history_step(self.undo),
+            'redo': lambda: history_step(self.redo),
+            'delete_holds': delete_holds,
+            'list_holds': list_holds,
+            'export': export,
+            'frame': frame,
+        }
+
+    def render_full_resolution(self, session, view="overlay"):
+        # The frames sent while editing are rendered at the display level of the pyramid
+        if view == "masks":
+            image = np.zeros_like(session.origin_image_rgba)
+        elif len(session.masks) > 0:
+            image = mask_render.overlay_base(session.origin_image_rgba)
+        else:
+            return session.origin_image_rgba
+        mask_render.render_masks(image, session.masks)
+        return image
+
+    def image_response(self, session, image, options):
+        """ Encode the current frame of a session for the client
+
+        The frame is at the display level of the image pyramid, box coordinates
+        are still sent at full resolution (X-Full-Size).
+
+        options (from the request JSON):
+        response:         "json" (default, base64 image in JSON) or "binary" (raw image body)
+        image_type:       png / jpeg / webp, negotiated from the Accept header when missing
+        quality:          jpeg / webp quality 1-100
+        png_compression:  png zlib level 0-9
+        patch:            with base_version, send only what changed since the frame the client has
+        base_version:     X-Frame-Version of the frame the client shows
+        """
+        image_type = negotiate(options.get('image_type'), request.headers.get('Accept'))
+        version = session.frame_version
+        base_version = options.get('base_version')
+        rect = None
+        if options.get('patch') and base_version is not None:
+            if base_version == version:
+                # The client already shows this frame
+                if options.get('response') == 'binary':
+                    return Response(status=204, headers={'X-Frame-Version': str(version)})
+                return jsonify({'unchanged': True, 'version': version})
+            if base_version == version - 1 and session.frame_dirty is not None:
+                rect = session.frame_dirty
+
+        h, w = image.shape[:2]
+        full_h, full_w = session.origin_image_rgba.shape[:2]
+        if rect is not None:
+            x0, y0, x1, y1 = rect
+            image = image[y0:y1, x0:x1]
+        with self.metrics.span("encode"):
+            body, mimetype = encode_image(image, image_type, options.get('quality'), options.get('png_compression'))
+        patch_rect = None if rect is None else [rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1]]
+
+        if options.get('response') == 'binary':
+            headers = {'X-Frame-Version': str(version), 'X-Image-Size': f"{w},{h}", 'X-Full-Size': f"{full_w},{full_h}"}
+            if patch_rect is not None:
+                headers['X-Patch-Rect'] = ",".join(map(str, patch_rect))
+            return Response(body, mimetype=mimetype, headers=headers)
+        img_base64 = base64.b64encode(body).decode('utf-8')
+        return jsonify({'image': img_base64, 'image_type': image_type, 'version': version,
+                        'size': [w, h], 'full_size': [full_w, full_h], 'rect': patch_rect})
     
     
-    def inference(self, image, points, labels, boxes) -> np.ndarray:
-        points_len, lables_len, boxes_len = len(points), len(labels), len(boxes)
+    def predict_low_res(self, key, image, points, labels, box=None, mask_input=None):
+        """ Prompt encoder + mask decoder only, without upsampling the masks, on the worker thread
+
+        mask_input:  (1, 256, 256) logits of the previous prediction of the same object
+
+        return:
+        (low-res logits (C, 256, 256), predicted IoU scores (C,)), C = 3 for a first single point, else 1
+        """
+        self.init_predictor(key, image)
+        predictor = self.predictor
+        coords = predictor.transform.apply_coords(points, predictor.original_size)[None]
+        if box is not None:
+            box = predictor.transform.apply_boxes(np.asarray(box), predictor.original_size)
+        if mask_input is not None:
+            mask_input = mask_input[None]
+        # Several candidates only help to disambiguate a lone point, as in SamPredictor
+        multimask = mask_input is None and box is None and len(points) == 1
+        low_res, scores = self.decoder.decode(predictor, coords, labels[None], box, mask_input, multimask)
+        return low_res[0].cpu().numpy(), scores[0].cpu().numpy()
+
+    def commit_logits(self, key, image, logits, tile=None):
+        """ Full-resolution mask of the low-res logits of a point refinement, as SamPredictor would upsample them
+
+        tile:  the tile the logits are of, in tiled mode
+        """
+        import torch
+        if tile is not None:
+            key, image = self.tile_image(key, image, tile)
+        self.init_predictor(key, image)
+        predictor = self.predictor
+        with torch.inference_mode():
+            masks = predictor.model.postprocess_masks(
+                torch.as_tensor(logits, dtype=torch.float, device=predictor.device)[None],
+                predictor.input_size, predictor.original_size,
+            )
+        mask = (masks[0, 0] > predictor.model.mask_threshold).cpu().numpy()
+        record = mask_render.mask_record(mask, "positive")
+        if tile is not None:
+            shift_record(record, tile[0], tile[1])
+        return [record] if record is not None else []
+
+    def preview_mask(self, logits, shape, full_shape, tile=None):
+        """ Display-level mask of the low-res logits the predictor just returned, of the whole image or of a tile """
+        img_size = self.predictor.model.image_encoder.img_size
+        if tile is None:
+            return mask_render.logits_mask(logits, self.predictor.input_size, shape, img_size)
+        # The tile at display scale
+        sy, sx = shape[0] / full_shape[0], shape[1] / full_shape[1]
+        x0, x1 = int(round(tile[0] * sx)), int(round(tile[2] * sx))
+        y0, y1 = int(round(tile[1] * sy)), int(round(tile[3] * sy))
+        mask = np.zeros(shape[:2], dtype=bool)
+        mask[y0:y1, x0:x1] = mask_render.logits_mask(logits, self.predictor.input_size, (y1 - y0, x1 - x0), img_size)
+        return mask
+
+    def inference(self, key, image, points, labels, boxes, mask_input=None) -> list:
+        """ Run SAM on the prompts, only called on the worker thread
+
+        mask_input:  low-res logits of a previous prediction of a single object
+
+        return:
+        mask records of the new masks
+        """
+        points_len, boxes_len = len(points), len(boxes)
+        grid = self.tile_grid(image)
+        if grid is not None:
+            if boxes_len > 1:
+                objects = group_prompts(points, labels, boxes)
+            elif boxes_len == 1 or points_len > 0:
+                objects = [{"points": points.reshape(-1, 2), "labels": labels, "box": boxes[0] if boxes_len else None}]
+            else:
+                objects = []
+            return self.tiled_inference(key, image, grid, objects)
+
+        # Multiple Object: one per box, the points go to the box they are in, decoded in chunks
+        if boxes_len > 1:
+            self.init_predictor(key, image)
+            objects = group_prompts(points, labels, boxes)
+            records = predict_objects(self.predictor, objects, self.args.object_batch, self.decoder)
+            return [r for r in records if r is not None]
         
-        print(f"points_len {points_len}; lables_len {lables_len}; boxes_len {boxes_len}; ")
         if (len(points) == len(labels) == 0):
             points = labels = None
         if (len(boxes) == 0):
             boxes = None
         
-        self.init_predictor()
-        
-        if ((boxes_len == 1) or (points_len > 0 and boxes_len <= 1)):
-            masks, scores, logits = self.predictor.predict(
+        new_masks = []
+        if ((boxes_len == 1) or (points_len > 0)):
+            self.init_predictor(key, image)
+            masks, scores, logits = self.decoder.predict(
+                self.predictor,
                 point_coords=points,
                 point_labels=labels,
                 box=boxes,
-                multimask_output=True,
+                mask_input=mask_input,
+                multimask_output=mask_input is None,
             )
-            print(f"predict len(masks)={len(masks)}  len(scores)={len(scores)}  len(logits)={len(logits)} ")
-            print(f"masks shape: {masks.shape}")  # 打印masks的维度 (3, 2013, 1125)
-            print(f"scores shape: {scores.shape}")  # 打印scores的维度 (3,)
-            print(f"logits shape: {logits.shape}")  # 打印logits的维度 (3, 256, 256)
+            # masks (3, H, W), scores (3,), logits (3, 256, 256)
             max_idx = np.argmax(scores)
-            self.masks.append({
-                "mask": masks[max_idx], # mask 不关心颜色，所以是一个W*H 二维矩阵，大小等于图片输出的大小
-                "opt": "positive"
-            })
-        # Multiple Object
-        elif (boxes_len > 1):
-            boxes = torch.tensor(boxes, device=self.predictor.device)
-            transformed_boxes = self.predictor.transform.apply_boxes_torch(boxes, image.shape[:2])
-            masks, scores, logits = self.predictor.predict_torch(
-                point_coords=None,
-                point_labels=None,
-                boxes=transformed_boxes,
-                multimask_output=False,
-            )
-            masks = masks.detach().cpu().numpy()
-            scores = scores.detach().cpu().numpy()
-            max_idxs = np.argmax(scores, axis=1)
-            print(f"output mask shape: {masks.shape}")  # (batch_size) x (num_predicted_masks_per_input) x H x W
-            for i in range(masks.shape[0]):
-                self.masks.append({
-                    "mask": masks[i][max_idxs[i]],
-                    "opt": "positive"
-                })
-        # Update masks image to show
-        overlayImage, maskedImage = self.updateMaskImg(self.origin_image_rgba, self.masks)
-        # overlayImage, maskedImage = self.updateMaskImg(overlayImage, maskedImage, [self.brushMask])
-
-        return overlayImage, maskedImage
-
-
-    def get_colored_masks_image(self):
-        masks = self.masks
-        # 创建一个与原始图像大小相同的黑色背景图像
-        darkImg = np.zeros_like(self.origin_image_rgba)
-        image = darkImg.copy()
-
-        np.random.seed(0)
-        if (len(masks) == 0):
-            self.colorMasks = image
-            return image
-        for mask in masks:
-            if mask['opt'] == "negative":
-                image = self.clearMaskWithOriginImg(darkImg, image, mask['mask'])
-            else:
-                image = self.overlay_mask(image, mask['mask'], 1)
+            # mask 不关心颜色，所以是一个W*H 二维矩阵，大小等于图片输出的大小; 只保存 bbox 内的部分
+            new_masks.append(mask_render.mask_record(masks[max_idx], "positive"))
+        return [record for record in new_masks if record is not None]
 
-        self.colorMasks = image
-        return image
+    def tiled_inference(self, key, image, grid, objects) -> list:
+        """ inference() of a tiled image: each object is segmented on the tile that contains its prompts
 
-    def updateMaskImg(self, image, masks):
+        The prompts of an object wider than every tile are cut along the tiles
+        they cover, the masks of the pieces are unioned. The tiles are visited
+        one after the other, only their embeddings are computed (or loaded).
+        """
+        parts = {}      # tile -> [(object index, prompts in the tile frame)]
+        for i, obj in enumerate(objects):
+            bbox = prompt_bbox(obj["points"], obj["box"])
+            best = grid.best(bbox)
+            for tile in [best] if best is not None else grid.covering(bbox):
+                part = to_tile(obj, tile)
+                if part["box"] is not None or np.any(part["labels"] == 1):
+                    parts.setdefault(tile, []).append((i, part))
+        pieces = [[] for _ in objects]
+        for tile, tile_parts in parts.items():
+            self.init_predictor(*self.tile_image(key, image, tile))
+            records = predict_objects(self.predictor, [part for _, part in tile_parts], self.args.object_batch,
+                                      self.decoder)
+            for (i, _), record in zip(tile_parts, records):
+                if record is not None:
+                    pieces[i].append(shift_record(record, tile[0], tile[1]))
+        return [union_records(p) for p in pieces if p]
 
-        if (len(masks) == 0 or masks[0] is None):
-            print(masks)
-            return image, np.zeros_like(image)
-        
-        
-        image = image * 1 # 创建新的对象
-        image[:, :, 3] = image[:, :, 3] * 0.5 # 表示只操作RGBA图像的Alpha通道（第4个通道）
-        image = image.astype(dtype=np.uint8) # 确保数据仍然是8位无符号整数格式
-        # 创建一个与图像大小相同的空白mask
-        union_mask = np.zeros_like(image)[:, :, 0]
-        print(f"union_mask = {union_mask.shape}")
-        np.random.seed(0)
-        for i in range(len(masks)):
-            image = self.overlay_mask(image, masks[i]['mask'], i)
-            # union_mask = np.bitwise_or(union_mask, masks[i]['mask'])
-            union_mask = np.bitwise_or(union_mask, masks[i]['mask'])
-        
-        # Cut out objects using union mask
-        # 使用union_mask从原始图像中裁剪出目标区域
-        # masked_image = self.origin_image_rgba * union_mask[:, :, np.newaxis]
-        
-        return image, union_mask
 
+    def get_colored_masks_image(self, session):
+        # 黑色背景上的 mask 图, 和 overlay 一起增量更新
+        if session.composite.colored is None:
+            session.colorMasks = mask_render.zeros_view(session.composite.origin.shape)
+        else:
+            session.colorMasks = session.composite.colored
+        return session.colorMasks
 
-    # Function to overlay a mask on an image
-    def overlay_mask(
-        self, 
-        image: np.ndarray, 
-        mask: np.ndarray, 
-        index: int, 
-    ) -> np.ndarray:
-        """ Draw mask on origin image
+    def updateMaskImg(self, session, new_masks=None):
+        """ Draw masks on the session's composite, all masks of a call in one batched pass
 
-        parameters:
-        image:  Origin image
-        mask:   Mask that have same size as image
-        color:  Mask's color in BGR
-        alpha:  Transparent ratio from 0.0-1.0
+        new_masks:  masks just appended to session.masks, None to redraw all of session.masks
 
         return:
-        blended: masked image
+        (overlay image, union mask)
         """
-        # Blend the image and the mask using the alpha value
-        # if random_color:
-        #     color = np.random.random(3)
-        # else:
-        #     color = np.array([30/255, 144/255, 255/255])    # BGR
-        # color = np.array([(0x5F)/255, (0x9E)/255, (0xE4)/255])    # BGR #5F9FE4
-        # color = np.array([0x5F, 0x9E, 0xE4])    # BGR #5F9FE4  #E49E60
-        # mask = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
-        # mask = mask * 2
-        # mask = mask.astype(dtype=np.uint8)
-        # blended = cv2.add(image, mask)
-        # blended = cv2.bitwise_or(image, mask)
-        # 将匹配位置的透明度设置为 255（完全不透明）
-        h, w = mask.shape[-2:]
-        mask = mask.reshape(h, w, 1)
-        self.IncreaseSaturationBrightness(image, mask, index)
-        # self.AddNumText(image, mask, index)
-        return image
-    
-    def IncreaseSaturationBrightness(self, image, mask, index):
-        # Convert the image's RGB channels to HSV
-        rgb = image[:, :, :3]
-        hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
-        # Create a boolean mask for pixels where mask > 0
-        mask_bool = mask[:, :, 0] > 0
-        # Increase saturation and brightness in masked regions by a factor of 1.2
-        hsv[mask_bool, 1] = np.clip(hsv[mask_bool, 1].astype(np.float32) * 1.2, 0, 255).astype(np.uint8)
-        hsv[mask_bool, 2] = np.clip(hsv[mask_bool, 2].astype(np.float32) * 1.2, 0, 255).astype(np.uint8)
-        # Convert back to RGB and update the image's RGB channels
-        image[:, :, :3] = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
-        # Set alpha to fully opaque in the masked areas
-        image[:, :, 3] = np.where(mask[:, :, 0] > 0, 255, image[:, :, 3])
-        
-        # Convert the mask to a binary image for contour detection
-        mask_uint8 = (mask[:, :, 0] * 255).astype(np.uint8)
-        contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # Highlight the boundaries of the mask using a bright magenta color
-        cv2.drawContours(image, contours, -1, color=(255, 0, 255, 255), thickness=2)
-    
+        composite = session.composite
+        with self.metrics.span("composite"):
+            if new_masks is None:
+                composite.rebuild(session.masks)
+            elif len(new_masks) > 0:
+                composite.add(new_masks)
+        if composite.union is None:
+            return composite.image(), mask_render.zeros_view(composite.image().shape[:2])
+        return composite.image(), composite.union
+
+
     def AddNumText(self, image, mask, index):
-        mask_uint8 = (mask[:, :, 0] * 255).astype(np.uint8)
+        h, w = image.shape[:2]
+        mask_uint8 = (mask_render.full_mask(mask, image.shape) * 255).astype(np.uint8)
         # Compute center of mass of the mask for placing the index text
         M = cv2.moments(mask_uint8)
         if M["m00"] != 0:
@@ -395,24 +1131,9 @@ class Web_App:
         return image
     
     
-    def clearMaskWithOriginImg(self, originImage, image, mask):
-        originImgPart = originImage * np.invert(mask)[:, :, np.newaxis]
-        image = image * mask[:, :, np.newaxis]
-        image = cv2.add(image, originImgPart)
-        return image
-
-    def reset_inputs(self):
-        self.points = []
-        self.points_label = []
-        self.boxes = []
-    
-    def reset_masks(self):
-        self.masks = []
-        self.masked_img = np.zeros_like(self.origin_image_rgba)
-        self.colorMasks = np.zeros_like(self.origin_image_rgba)
-    
     def run(self, debug=True):
-        self.app.run(debug=debug, port=8990)
+        # threaded: requests of different sessions are served concurrently
+        self.app.run(debug=debug, port=8990, threaded=True)
         
 if __name__ == '__main__':
     args = parser().parse_args()
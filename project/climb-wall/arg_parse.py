@@ -1,4 +1,5 @@
 import argparse
+import os
 
 def parser():
     parser = argparse.ArgumentParser(
@@ -8,6 +9,12 @@ def parser():
     parser.add_argument("--checkpoint", type=str, default="/Users/tiankonguse-m3/project/github/segment-anything/checkpoint/sam_vit_h_4b8939.pth")
     parser.add_argument("--device", type=str, default="cpu")
     parser.add_argument("--model_type", type=str, default="vit_h")
+    parser.add_argument(
+        "--checkpoint_mmap",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Memory-map .pth checkpoints instead of reading them whole (.safetensors always are).",
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -17,4 +24,48 @@ def parser():
             "of PNGs per image or a single json with COCO-style masks."
         ),
     )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "embeddings"),
+        help="Directory of the on-disk image embedding cache, empty string to keep it in memory only.",
+    )
+    parser.add_argument("--embedding_cache_items", type=int, default=8, help="Embeddings kept in memory (LRU).")
+    parser.add_argument("--embedding_cache_mb", type=int, default=2048, help="Size cap of the on-disk embedding cache.")
+    parser.add_argument(
+        "--session_dir",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "sessions"),
+        help="Directory idle sessions are spilled to, empty string to drop them instead.",
+    )
+    parser.add_argument("--max_sessions", type=int, default=16, help="Sessions kept in memory.")
+    parser.add_argument("--session_idle_minutes", type=int, default=30, help="Spill sessions idle for longer than this.")
+    parser.add_argument("--session_expire_hours", type=int, default=24, help="Delete spilled sessions older than this.")
+    parser.add_argument(
+        "--display_size",
+        type=int,
+        default=1600,
+        help="Long side of the preview frames, the largest pyramid level that fits is used. 0 for full resolution.",
+    )
+    parser.add_argument(
+        "--object_batch",
+        type=int,
+        default=4,
+        help="Objects (boxes) decoded per mask decoder call when a click has several, bounds the peak memory.",
+    )
+    parser.add_argument(
+        "--decoder_onnx",
+        type=str,
+        default="",
+        help="Mask decoder exported by decoder_backend.py (optionally int8), run with onnxruntime. Empty for torch.",
+    )
+    parser.add_argument("--decoder_threads", type=int, default=0, help="onnxruntime threads of --decoder_onnx, 0 for all cores.")
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=0,
+        help="Segment images larger than this tile by tile (full-resolution pixels, see tiles.py). 0 for whole images.",
+    )
+    parser.add_argument("--tile_overlap", type=int, default=256, help="Overlap of neighbouring tiles in pixels.")
+    parser.add_argument("--history_mb", type=int, default=64, help="Memory budget of the undo / redo history of a session.")
     return parser
\ No newline at end of file
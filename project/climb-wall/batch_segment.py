@@ -0,0 +1,304 @@
+""" Segment a whole directory of wall photos without the web UI
+
+    python batch_segment.py --input photos/ --output masks/ --checkpoint model/sam_vit_h_4b8939.pth
+    python batch_segment.py --input photos/ --output masks.json ...
+
+The work is pipelined in three stages so that every core stays busy:
+
+1. decode:       a thread pool reads and decodes the next images ahead of time
+2. inference:    the main thread runs the image encoder and the mask decoder
+                 (torch already spreads one image over all cores)
+3. post-process: the same thread pool removes small regions, runs the final
+                 NMS and encodes / writes the masks of the previous images
+
+Each queue is bounded, so at most a few images are held in memory at once.
+Results are streamed to --output as soon as an image is done.
+
+With --tile_size, images larger than a tile (panoramas) are segmented tile by
+tile at full resolution (tiles.py), one tile embedding at a time, and the
+pieces of the holds cut by the seams are merged.
+"""
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.amg import area_from_rle, box_xyxy_to_xywh, rle_to_mask
+
+import rle
+from arg_parse import parser
+from model_loader import build_sam
+from tiles import TileGrid, merge_seams, shift_record
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+CSV_HEADER = [
+    "id", "area", "bbox_x0", "bbox_y0", "bbox_w", "bbox_h",
+    "point_input_x", "point_input_y", "predicted_iou", "stability_score",
+    "crop_box_x0", "crop_box_y0", "crop_box_w", "crop_box_h",
+]
+
+
+def batch_parser():
+    p = parser()
+    p.description = "Segment every photo of a directory with SamAutomaticMaskGenerator"
+    p.add_argument("--input", type=str, required=True, help="Directory of images (or a single image).")
+    p.add_argument("--workers", type=int, default=os.cpu_count(), help="Threads for decoding and post-processing.")
+    p.add_argument("--prefetch", type=int, default=2, help="Images decoded / post-processed ahead of the model.")
+    p.add_argument("--skip_existing", action="store_true", help="Skip images already written to the --output folder.")
+    p.add_argument("--points_per_side", type=int, default=32)
+    p.add_argument("--points_per_batch", type=int, default=64)
+    p.add_argument("--pred_iou_thresh", type=float, default=0.88)
+    p.add_argument("--stability_score_thresh", type=float, default=0.95)
+    p.add_argument("--box_nms_thresh", type=float, default=0.7)
+    p.add_argument("--crop_n_layers", type=int, default=0)
+    p.add_argument("--min_mask_region_area", type=int, default=0)
+    return p
+
+
+def list_images(path):
+    if os.path.isfile(path):
+        return [path]
+    names = sorted(n for n in os.listdir(path) if n.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(path, n) for n in names]
+
+
+def decode_image(path):
+    # cv2 releases the GIL while decoding, so several images decode in parallel
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read image {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def postprocess(generator, mask_data):
+    """ The CPU tail of SamAutomaticMaskGenerator.generate(), run off the model thread
+
+    return:
+    list of dicts like generate(output_mode="uncompressed_rle")
+    """
+    if generator.min_mask_region_area > 0:
+        mask_data = generator.postprocess_small_regions(
+            mask_data,
+            generator.min_mask_region_area,
+            max(generator.box_nms_thresh, generator.crop_nms_thresh),
+        )
+    records = []
+    for i in range(len(mask_data["rles"])):
+        rle = mask_data["rles"][i]
+        records.append({
+            "segmentation": rle,
+            "area": area_from_rle(rle),
+            "bbox": box_xyxy_to_xywh(mask_data["boxes"][i]).tolist(),
+            "predicted_iou": float(mask_data["iou_preds"][i]),
+            "point_coords": [mask_data["points"][i].tolist()],
+            "stability_score": float(mask_data["stability_score"][i]),
+            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][i]).tolist(),
+        })
+    return records
+
+
+class FolderWriter:
+    """ One folder per image: <id>.png per mask and a metadata.csv, as segment_anything's scripts/amg.py
+
+    Images are independent, so everything is written by the worker pool in encode().
+    """
+
+    def __init__(self, output):
+        self.output = output
+        os.makedirs(output, exist_ok=True)
+
+    def folder(self, path):
+        return os.path.join(self.output, os.path.splitext(os.path.basename(path))[0])
+
+    def done(self, path):
+        return os.path.exists(os.path.join(self.folder(path), "metadata.csv"))
+
+    def encode(self, path, shape, records):
+        folder = self.folder(path)
+        os.makedirs(folder, exist_ok=True)
+        rows = []
+        for i, record in enumerate(records):
+            mask = rle_to_mask(record["segmentation"])
+            cv2.imwrite(os.path.join(folder, f"{i}.png"), mask.astype(np.uint8) * 255)
+            rows.append([
+                str(i), record["area"], *record["bbox"],
+                *record["point_coords"][0], record["predicted_iou"], record["stability_score"],
+                *record["crop_box"],
+            ])
+        # metadata.csv is written last, its presence marks the image as done
+        tmp_path = os.path.join(folder, "metadata.csv.tmp")
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(rows)
+        os.replace(tmp_path, os.path.join(folder, "metadata.csv"))
+
+    def write(self, encoded):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonWriter:
+    """ A single json file with COCO-style (RLE) masks, appended image by image
+
+    {"images": [{"file": ..., "width": ..., "height": ..., "masks": [...]}, ...]}
+
+    The worker pool serializes the entries, the main thread only appends them in order.
+    """
+
+    def __init__(self, output):
+        self.f = open(output, "w")
+        self.f.write('{"images": [\n')
+        self.count = 0
+
+    def done(self, path):
+        return False
+
+    def encode(self, path, shape, records):
+        return json.dumps({"file": os.path.basename(path), "width": shape[1], "height": shape[0], "masks": records})
+
+    def write(self, encoded):
+        self.f.write((",\n" if self.count else "") + encoded)
+        self.f.flush()
+        self.count += 1
+
+    def close(self):
+        self.f.write("\n]}\n")
+        self.f.close()
+
+
+def post_stage(generator, writer, path, shape, mask_data):
+    records = postprocess(generator, mask_data)
+    return len(records), writer.encode(path, shape, records)
+
+
+def generate_tiled(generator, image, grid):
+    """ _generate_masks() of every tile of the grid, one after the other: [(tile, mask data)] """
+    results = []
+    for tile in grid.tiles:
+        x0, y0, x1, y1 = tile
+        results.append((tile, generator._generate_masks(image[y0:y1, x0:x1])))
+    return results
+
+
+def postprocess_tiled(generator, shape, tiles_data):
+    """ postprocess() of every tile, the masks in the frame of the whole image and merged across the seams """
+    pieces = []
+    for tile, mask_data in tiles_data:
+        x0, y0, x1, y1 = tile
+        for entry in postprocess(generator, mask_data):
+            piece = rle.decode_record(np.asarray(entry["segmentation"]["counts"]), (y1 - y0, x1 - x0))
+            if piece is not None:
+                piece["tile"], piece["entry"] = tile, entry
+                pieces.append(shift_record(piece, x0, y0))
+    records = []
+    for hold in merge_seams(pieces):
+        # The scores and the input point are those of the first piece
+        entry, (tx0, ty0, _, _) = hold["entry"], hold["tile"]
+        x0, y0, x1, y1 = hold["bbox"]
+        cx, cy, cw, ch = entry["crop_box"]
+        records.append(dict(
+            entry,
+            segmentation={"size": list(shape[:2]), "counts": rle.encode_record(hold, shape).tolist()},
+            area=int(np.count_nonzero(hold["mask"])),
+            bbox=[x0, y0, x1 - x0, y1 - y0],
+            point_coords=[[px + tx0, py + ty0] for px, py in entry["point_coords"]],
+            crop_box=[cx + tx0, cy + ty0, cw, ch],
+        ))
+    return records
+
+
+def post_stage_tiled(generator, writer, path, shape, tiles_data):
+    records = postprocess_tiled(generator, shape, tiles_data)
+    return len(records), writer.encode(path, shape, records)
+
+
+def load_generator(args):
+    print(f"Loading model {args.model_type} on {args.device}...")
+    sam = build_sam(args.model_type, args.checkpoint, args.device, mmap=args.checkpoint_mmap)
+    return SamAutomaticMaskGenerator(
+        sam,
+        points_per_side=args.points_per_side,
+        points_per_batch=args.points_per_batch,
+        pred_iou_thresh=args.pred_iou_thresh,
+        stability_score_thresh=args.stability_score_thresh,
+        box_nms_thresh=args.box_nms_thresh,
+        crop_n_layers=args.crop_n_layers,
+        min_mask_region_area=args.min_mask_region_area,
+        output_mode="uncompressed_rle",
+    )
+
+
+def run(args):
+    if not args.output:
+        raise SystemExit("--output is required: a directory, or a file name ending in .json")
+    generator = load_generator(args)
+    writer = JsonWriter(args.output) if args.output.endswith(".json") else FolderWriter(args.output)
+    paths = list_images(args.input)
+    if args.skip_existing:
+        paths = [p for p in paths if not writer.done(p)]
+    print(f"{len(paths)} images to segment")
+
+    pool = ThreadPoolExecutor(max_workers=max(args.workers, 1))
+    decoding = deque()      # (path, future of the decoded image)
+    writing = deque()       # (path, future of (mask count, encoded output))
+    todo = iter(paths)
+
+    def prefetch():
+        while len(decoding) < args.prefetch:
+            path = next(todo, None)
+            if path is None:
+                return
+            decoding.append((path, pool.submit(decode_image, path)))
+
+    def drain(limit):
+        # Written in input order, so the json output is deterministic
+        while len(writing) > limit or (writing and writing[0][1].done()):
+            path, future = writing.popleft()
+            count, encoded = future.result()
+            writer.write(encoded)
+            print(f"{path}: {count} masks")
+
+    start = time.time()
+    done = 0
+    try:
+        prefetch()
+        while decoding:
+            path, future = decoding.popleft()
+            prefetch()
+            try:
+                image = future.result()
+            except Exception as e:
+                print(f"Skip {path}: {e}")
+                continue
+            tiled = args.tile_size > 0 and max(image.shape[:2]) > args.tile_size
+            with torch.inference_mode():
+                if tiled:
+                    mask_data = generate_tiled(generator, image, TileGrid(image.shape, args.tile_size, args.tile_overlap))
+                else:
+                    mask_data = generator._generate_masks(image)
+            stage = post_stage_tiled if tiled else post_stage
+            writing.append((path, pool.submit(stage, generator, writer, path, image.shape, mask_data)))
+            del image, mask_data
+            done += 1
+            drain(args.prefetch)
+        drain(0)
+    finally:
+        pool.shutdown(wait=True)
+        writer.close()
+    elapsed = time.time() - start
+    print(f"Segmented {done} images in {elapsed:.1f}s ({elapsed / max(done, 1):.2f}s per image)")
+
+
+if __name__ == '__main__':
+    run(batch_parser().parse_args())
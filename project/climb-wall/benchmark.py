@@ -0,0 +1,252 @@
+""" Benchmark of the climb-wall request pipeline, without the model
+
+    python benchmark.py                     # run and compare with benchmark_baseline.json
+    python benchmark.py --save_baseline     # run and store the results as the new baseline
+    python benchmark.py --quick             # smaller images / fewer masks, for a quick check
+
+Web_App is driven through Flask's test client. SamPredictor is replaced by
+StubPredictor, which returns a deterministic ellipse inside each box prompt, so
+the suite runs on CPU without torch or a checkpoint and every run draws the
+same masks. For every image size and mask count it times:
+
+    decode     Web_App.decode_image        (upload_image)
+    upload     the whole /upload_image request
+    composite  Web_App.updateMaskImg       (per inference)
+    colored    Web_App.get_colored_masks_image
+    encode     Web_App.image_response      (process_image -> png)
+    inference  the whole /button_click inference request
+    full_frame /button_click of the whole frame, not a patch
+
+The medians are compared with the baseline: a stage is a regression when it
+is slower than baseline * (1 + tolerance) and by more than --min_ms.
+Baselines depend on the machine, save one on the machine you compare on.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import app as app_module                # noqa: E402
+from arg_parse import parser            # noqa: E402
+
+BASELINE = os.path.join(HERE, "benchmark_baseline.json")
+SIZES = [(768, 1024), (2013, 1125), (3024, 4032)]      # (h, w): small, the phone photo of the logs, 12MP
+MASK_COUNTS = [1, 20, 100]
+QUICK_SIZES = [(768, 1024), (2013, 1125)]
+QUICK_MASK_COUNTS = [1, 20]
+SEED = 0
+
+
+class StubPredictor:
+    """ Deterministic stand-in for SamPredictor: the mask of a box is the ellipse inscribed in it """
+
+    def __init__(self):
+        self.shape = None
+
+    def set_image(self, image, image_format="RGB"):
+        self.shape = image.shape[:2]
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None, multimask_output=True):
+        h, w = self.shape
+        mask = np.zeros((h, w), dtype=np.uint8)
+        x0, y0, x1, y1 = np.asarray(box, dtype=np.float32).reshape(-1)[:4]
+        center = (int((x0 + x1) / 2), int((y0 + y1) / 2))
+        axes = (max(int((x1 - x0) / 2), 1), max(int((y1 - y0) / 2), 1))
+        cv2.ellipse(mask, center, axes, 0, 0, 360, 1, -1)
+        count = 3 if multimask_output else 1
+        masks = np.repeat(mask.astype(bool)[None], count, axis=0)
+        scores = np.linspace(0.9, 0.5, count)
+        return masks, scores, np.zeros((count, 256, 256), dtype=np.float32)
+
+
+class BenchApp(app_module.Web_App):
+    """ Web_App with StubPredictor and timers around the stages """
+
+    STAGES = {
+        "decode": "decode_image",
+        "composite": "updateMaskImg",
+        "colored": "get_colored_masks_image",
+        "encode": "image_response",
+    }
+
+    def __init__(self, args):
+        self.timings = defaultdict(list)
+        super().__init__(args)
+        for stage, name in self.STAGES.items():
+            setattr(self, name, self.timed(stage, getattr(self, name)))
+
+    def loadModel(self):
+        self.predictor = StubPredictor()
+        return {}
+
+    def empty_cache(self):
+        # No torch, no GPU memory to release
+        pass
+
+    def init_predictor(self, key, image_rgb):
+        # No embedding to compute or cache
+        if self.predictor_key != key:
+            self.predictor.set_image(image_rgb)
+            self.predictor_key = key
+
+    def timed(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.timings[stage].append(time.perf_counter() - start)
+        return wrapper
+
+
+def make_image(h, w, rng):
+    """ A smooth, photo-like image: random colors blurred, so png / jpeg sizes are realistic """
+    small = (rng.random((max(h // 16, 1), max(w // 16, 1), 3)) * 255).astype(np.uint8)
+    image = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(-8, 9, size=image.shape)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def random_boxes(h, w, count, rng):
+    """ Hold-sized boxes, 2% - 8% of the short side """
+    side = min(h, w)
+    sizes = rng.uniform(0.02, 0.08, size=(count, 2)) * side
+    x0 = rng.uniform(0, w - sizes[:, 0])
+    y0 = rng.uniform(0, h - sizes[:, 1])
+    return np.stack([x0, y0, x0 + sizes[:, 0], y0 + sizes[:, 1]], axis=1)
+
+
+def run_scenario(web, h, w, mask_count, rng):
+    web.timings.clear()
+    requests = defaultdict(list)
+    client = web.app.test_client()
+    png = cv2.imencode(".png", make_image(h, w, rng))[1].tobytes()
+
+    start = time.perf_counter()
+    r = client.post("/upload_image", data={"image": (io.BytesIO(png), "wall.png")})
+    requests["upload"].append(time.perf_counter() - start)
+    client.get(f"/jobs/{r.get_json()['job_id']}?wait=30")
+
+    frame_options = {"response": "binary", "image_type": "png", "patch": True}
+    r = client.post("/button_click", json=dict(frame_options, button_id="box"))
+    version = int(r.headers["X-Frame-Version"])
+    for box in random_boxes(h, w, mask_count, rng):
+        client.post("/box_receive", json=dict(zip(["x1", "y1", "x2", "y2"], box.tolist())))
+        start = time.perf_counter()
+        r = client.post("/button_click", json=dict(frame_options, button_id="inference", base_version=version))
+        requests["inference"].append(time.perf_counter() - start)
+        version = int(r.headers["X-Frame-Version"])
+
+    start = time.perf_counter()
+    client.post("/button_click", json={"button_id": "box", "response": "binary", "image_type": "png"})
+    requests["full_frame"].append(time.perf_counter() - start)
+
+    timings = dict(web.timings)
+    timings.update(requests)
+    # image_response also ran for the initial and the full frame, keep the per-inference ones
+    timings["encode"] = timings["encode"][1:-1] or timings["encode"]
+    return {stage: summarize(values) for stage, values in sorted(timings.items())}
+
+
+def summarize(values):
+    values = np.asarray(values) * 1000
+    return {
+        "median_ms": round(float(np.median(values)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "count": int(len(values)),
+    }
+
+
+def run(sizes, mask_counts, display_size):
+    args = parser().parse_args([
+        "--checkpoint", "", "--embedding_cache_dir", "", "--session_dir", "",
+        "--display_size", str(display_size),
+    ])
+    app_module.args = args
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        web = BenchApp(args)
+        web.model_job.wait()
+    for h, w in sizes:
+        for mask_count in mask_counts:
+            name = f"{w}x{h}/{mask_count}masks"
+            rng = np.random.default_rng(SEED)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name] = run_scenario(web, h, w, mask_count, rng)
+            stages = results[name]
+            print(f"{name:<22}" + "  ".join(f"{s} {v['median_ms']:.1f}ms" for s, v in stages.items()))
+    web.worker.stop()
+    return results
+
+
+def compare(results, baseline, tolerance, min_ms):
+    """ Print the comparison, return the list of regressions """
+    regressions = []
+    for name, stages in results.items():
+        for stage, value in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if base is None:
+                continue
+            now, before = value["median_ms"], base["median_ms"]
+            ratio = now / before if before > 0 else float("inf")
+            slower = now > before * (1 + tolerance) and now - before > min_ms
+            if slower:
+                regressions.append((name, stage, before, now))
+            if slower or (ratio < 1 - tolerance and before - now > min_ms):
+                print(f"{'REGRESSION' if slower else 'faster':<10} {name:<22} {stage:<10} "
+                      f"{before:.1f}ms -> {now:.1f}ms ({ratio:.2f}x)")
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the climb-wall request pipeline with a stub predictor")
+    p.add_argument("--baseline", type=str, default=BASELINE)
+    p.add_argument("--save_baseline", action="store_true", help="Store the results as the baseline.")
+    p.add_argument("--quick", action="store_true", help="Only the smaller sizes and mask counts.")
+    p.add_argument("--display_size", type=int, default=1600)
+    p.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown of a median.")
+    p.add_argument("--min_ms", type=float, default=2.0, help="Slowdowns below this are noise.")
+    p.add_argument("--output", type=str, default=None, help="Also write the results to this json file.")
+    a = p.parse_args()
+
+    results = run(QUICK_SIZES if a.quick else SIZES, QUICK_MASK_COUNTS if a.quick else MASK_COUNTS, a.display_size)
+    report = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpus": os.cpu_count(), "opencv": cv2.__version__, "numpy": np.__version__},
+        "display_size": a.display_size,
+        "results": results,
+    }
+    if a.output:
+        with open(a.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if a.save_baseline:
+        with open(a.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {a.baseline}")
+        return 0
+    if not os.path.exists(a.baseline):
+        print(f"No baseline at {a.baseline}, run with --save_baseline first")
+        return 0
+    with open(a.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("display_size") != a.display_size:
+        print(f"Baseline was run with --display_size {baseline.get('display_size')}, not comparing")
+        return 0
+    regressions = compare(results, baseline["results"], a.tolerance, a.min_ms)
+    print(f"{len(regressions)} regressions against {a.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,30 @@
+import contextlib
+import io
+
+import cv2
+import numpy as np
+import pytest
+
+import app as app_module
+import benchmark
+from arg_parse import parser
+
+
+@pytest.fixture
+def web():
+    args = parser().parse_args(["--checkpoint", "", "--embedding_cache_dir", "", "--session_dir", ""])
+    app_module.args = args
+    with contextlib.redirect_stdout(io.StringIO()):
+        web = benchmark.BenchApp(args)
+        web.model_job.wait()
+    yield web
+    web.worker.stop()
+
+
+@pytest.fixture
+def client(web):
+    client = web.app.test_client()
+    png = cv2.imencode(".png", benchmark.make_image(240, 320, np.random.default_rng(0)))[1].tobytes()
+    r = client.post("/upload_image", data={"image": (io.BytesIO(png), "wall.png")})
+    client.get(f"/jobs/{r.get_json()['job_id']}?wait=30")
+    return client
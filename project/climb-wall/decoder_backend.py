@@ -0,0 +1,235 @@
+""" Mask decoder backends: the prompt encoder + mask decoder part of SAM
+
+The image encoder always runs in torch and its embedding is cached
+(embedding_cache.py), only the cheap part that runs on every click is
+pluggable:
+
+- TorchDecoder (default): SAM's own prompt_encoder + mask_decoder
+- OnnxDecoder: the same two modules exported to ONNX, optionally quantized to
+  int8, run by onnxruntime on the CPU. Export once with
+
+    python decoder_backend.py --checkpoint model/sam_vit_h_4b8939.pth --model_type vit_h \
+        --output model/sam_vit_h_decoder.onnx --quantize
+
+  and start the server with --decoder_onnx model/sam_vit_h_decoder.quant.onnx
+
+Both return the low-resolution (256x256) logits as torch tensors, upsampling
+to the image resolution stays in torch (model.postprocess_masks), so only the
+best mask of an object is ever upsampled.
+
+torch, onnx and onnxruntime are imported lazily, like everywhere on the web server side.
+"""
+import os
+
+import numpy as np
+
+LOW_RES = 256
+
+
+def load_decoder(path="", threads=0):
+    """ OnnxDecoder of an exported model, TorchDecoder when path is empty """
+    if not path:
+        return TorchDecoder()
+    return OnnxDecoder(path, threads)
+
+
+class DecoderBackend:
+    name = None
+
+    def decode(self, predictor, coords, labels, boxes=None, mask_input=None, multimask=False):
+        """ Low-res masks of B objects with the same prompt layout
+
+        predictor:   a SamPredictor with the image set, its features are the image embedding
+        coords:      (B, N, 2) points already transformed to the input frame (predictor.transform), N may be 0
+        labels:      (B, N) 1 / 0
+        boxes:       (B, 4) boxes in the input frame, or None
+        mask_input:  (B, 1, 256, 256) logits of a previous prediction, or None
+        multimask:   3 candidates per object instead of 1
+
+        return:
+        (low-res logits (B, C, 256, 256), predicted IoU (B, C)), torch tensors on predictor.device
+        """
+        raise NotImplementedError
+
+    def predict(self, predictor, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True):
+        """ SamPredictor.predict() of one object through this decoder, same arguments and results """
+        import torch
+        coords = np.zeros((1, 0, 2), dtype=np.float32)
+        labels = np.zeros((1, 0), dtype=np.int32)
+        if point_coords is not None:
+            coords = predictor.transform.apply_coords(np.asarray(point_coords, dtype=np.float32),
+                                                      predictor.original_size)[None]
+            labels = np.asarray(point_labels, dtype=np.int32)[None]
+        if box is not None:
+            box = predictor.transform.apply_boxes(np.asarray(box, dtype=np.float32), predictor.original_size)
+            box = box.reshape(1, 4)
+        if mask_input is not None:
+            mask_input = np.asarray(mask_input, dtype=np.float32)[None]
+        low_res, scores = self.decode(predictor, coords, labels, box, mask_input, multimask_output)
+        with torch.inference_mode():
+            masks = predictor.model.postprocess_masks(low_res, predictor.input_size, predictor.original_size)
+            masks = masks > predictor.model.mask_threshold
+        return masks[0].cpu().numpy(), scores[0].cpu().numpy(), low_res[0].cpu().numpy()
+
+
+class TorchDecoder(DecoderBackend):
+    name = "torch"
+
+    def decode(self, predictor, coords, labels, boxes=None, mask_input=None, multimask=False):
+        import torch
+        model = predictor.model
+        device = predictor.device
+        point_input = box_input = None
+        if coords.shape[1] > 0:
+            point_input = (torch.as_tensor(coords, dtype=torch.float, device=device),
+                           torch.as_tensor(labels, dtype=torch.int, device=device))
+        if boxes is not None:
+            box_input = torch.as_tensor(boxes, dtype=torch.float, device=device)
+        if mask_input is not None:
+            mask_input = torch.as_tensor(mask_input, dtype=torch.float, device=device)
+        with torch.inference_mode():
+            sparse, dense = model.prompt_encoder(points=point_input, boxes=box_input, masks=mask_input)
+            return model.mask_decoder(
+                image_embeddings=predictor.features,
+                image_pe=model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse,
+                dense_prompt_embeddings=dense,
+                multimask_output=multimask,
+            )
+
+    def predict(self, predictor, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True):
+        return predictor.predict(point_coords=point_coords, point_labels=point_labels, box=box,
+                                 mask_input=mask_input, multimask_output=multimask_output)
+
+
+class OnnxDecoder(DecoderBackend):
+    """ An exported decoder (export_decoder()) run by onnxruntime on the CPU
+
+    The exported graph returns the 4 masks of SAM's mask decoder (the single
+    mask, then the 3 candidates), the right ones are picked here as in
+    MaskDecoder.forward(). The embedding is copied to numpy once per image.
+    """
+    name = "onnx"
+
+    def __init__(self, path, threads=0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("pip install onnxruntime to use --decoder_onnx")
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.features = None        # (features tensor, its numpy copy)
+        print(f"Decoder {path} ({onnxruntime.__version__}, {threads or 'default'} threads)")
+
+    def embedding(self, predictor):
+        if self.features is None or self.features[0] is not predictor.features:
+            self.features = (predictor.features, predictor.features.cpu().numpy().astype(np.float32, copy=False))
+        return self.features[1]
+
+    def decode(self, predictor, coords, labels, boxes=None, mask_input=None, multimask=False):
+        import torch
+        count = len(coords)
+        coords = np.asarray(coords, dtype=np.float32).reshape(count, -1, 2)
+        labels = np.asarray(labels, dtype=np.float32).reshape(count, -1)
+        # Sparse prompts as SAM's prompt encoder builds them: a box is its two corners with
+        # the labels 2 and 3, without a box the points are padded with a "not a point"
+        if boxes is None:
+            extra = np.zeros((count, 1, 2), dtype=np.float32)
+            extra_labels = np.full((count, 1), -1, dtype=np.float32)
+        else:
+            extra = np.asarray(boxes, dtype=np.float32).reshape(count, 2, 2)
+            extra_labels = np.tile(np.array([[2, 3]], dtype=np.float32), (count, 1))
+        if mask_input is None:
+            mask_input = np.zeros((count, 1, LOW_RES, LOW_RES), dtype=np.float32)
+            has_mask = np.zeros(1, dtype=np.float32)
+        else:
+            mask_input = np.asarray(mask_input, dtype=np.float32).reshape(count, 1, LOW_RES, LOW_RES)
+            has_mask = np.ones(1, dtype=np.float32)
+        masks, scores = self.session.run(None, {
+            "image_embeddings": self.embedding(predictor),
+            "point_coords": np.concatenate([coords, extra], axis=1),
+            "point_labels": np.concatenate([labels, extra_labels], axis=1),
+            "mask_input": mask_input,
+            "has_mask_input": has_mask,
+        })
+        picked = slice(1, None) if multimask else slice(0, 1)
+        device = predictor.device
+        return (torch.from_numpy(np.ascontiguousarray(masks[:, picked])).to(device),
+                torch.from_numpy(np.ascontiguousarray(scores[:, picked])).to(device))
+
+
+def export_decoder(sam, output, quantize=False, opset=17):
+    """ Export the prompt encoder + mask decoder of a Sam model to ONNX, return the path of the model to load
+
+    With quantize, the weights are also quantized to int8 (dynamic quantization)
+    into <output>.quant.onnx, which is returned.
+    """
+    import torch
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    class LowResDecoder(SamOnnxModel):
+        """ SamOnnxModel without the upsampling and the mask selection: the 4 low-res masks and their scores """
+
+        def forward(self, image_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+            sparse = self._embed_points(point_coords, point_labels)
+            dense = self._embed_masks(mask_input, has_mask_input)
+            return self.model.mask_decoder.predict_masks(
+                image_embeddings=image_embeddings,
+                image_pe=self.model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse,
+                dense_prompt_embeddings=dense,
+            )
+
+    model = LowResDecoder(sam, return_single_mask=False).eval()
+    dim = sam.prompt_encoder.embed_dim
+    size = sam.prompt_encoder.image_embedding_size
+    inputs = {
+        "image_embeddings": torch.randn(1, dim, *size, dtype=torch.float),
+        "point_coords": torch.randint(0, 1024, (2, 3, 2), dtype=torch.float),
+        "point_labels": torch.randint(0, 4, (2, 3), dtype=torch.float),
+        "mask_input": torch.randn(2, 1, 4 * size[0], 4 * size[1], dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+    }
+    dynamic_axes = {
+        "point_coords": {0: "objects", 1: "num_points"},
+        "point_labels": {0: "objects", 1: "num_points"},
+        "mask_input": {0: "objects"},
+        "masks": {0: "objects"},
+        "iou_predictions": {0: "objects"},
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(inputs.values()), output,
+            input_names=list(inputs), output_names=["masks", "iou_predictions"],
+            dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, dynamo=False,
+        )
+    print(f"Wrote {output}")
+    if not quantize:
+        return output
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantized = os.path.splitext(output)[0] + ".quant.onnx"
+    quantize_dynamic(output, quantized, per_channel=False, reduce_range=False, weight_type=QuantType.QUInt8)
+    print(f"Wrote {quantized}")
+    return quantized
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from model_loader import build_sam
+
+    p = argparse.ArgumentParser(description="Export the SAM mask decoder to ONNX for --decoder_onnx")
+    p.add_argument("--checkpoint", type=str, required=True)
+    p.add_argument("--model_type", type=str, default="vit_h")
+    p.add_argument("--output", type=str, required=True, help="Path of the .onnx model.")
+    p.add_argument("--quantize", action="store_true", help="Also write an int8 <output>.quant.onnx.")
+    p.add_argument("--opset", type=int, default=17)
+    a = p.parse_args()
+    export_decoder(build_sam(a.model_type, a.checkpoint), a.output, a.quantize, a.opset)
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def image_key(image: np.ndarray, prefix: str = "") -> str:
+    """ Content hash of decoded pixels
+
+    The key only depends on what SAM will see (shape, dtype and pixel values),
+    so re-uploading the same wall photo under another name or container format
+    hits the same cache entry.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{prefix}|{image.shape}|{image.dtype}|".encode())
+    if image.flags.c_contiguous:
+        h.update(image.data)
+    else:
+        # A view (e.g. the RGB channels of the RGBA upload): hash it in row blocks, same digest
+        # as the contiguous copy without making it
+        rows = max((4 << 20) // max(image[:1].nbytes, 1), 1)
+        for start in range(0, len(image), rows):
+            h.update(np.ascontiguousarray(image[start:start + rows]).data)
+    return f"{prefix}-{h.hexdigest()}" if prefix else h.hexdigest()
+
+
+class EmbeddingCache:
+    """ Cache of SamPredictor image embeddings
+
+    A small in-memory LRU sits in front of an on-disk store. Every entry is
+    written through to disk, and the disk store is pruned (least recently used
+    first) once it grows past max_disk_bytes.
+    """
+
+    SUFFIX = ".pt"
+
+    def __init__(self, cache_dir=None, max_items=8, max_disk_bytes=2 << 30):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.SUFFIX)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        import torch     # lazily, the web server starts before torch is loaded
+        try:
+            state = torch.load(path, map_location="cpu", weights_only=True)
+        except Exception as e:
+            print(f"Drop broken embedding cache file {path}: {e}")
+            os.remove(path)
+            return None
+        os.utime(path)  # mtime is the LRU clock of the disk store
+        self._remember(key, state)
+        return state
+
+    def put(self, key, state):
+        self._remember(key, state)
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        import torch
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        self.prune()
+
+    def _remember(self, key, state):
+        with self.lock:
+            self.memory[key] = state
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def prune(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.SUFFIX):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def memory_bytes(self):
+        with self.lock:
+            states = list(self.memory.values())
+        return sum(t.element_size() * t.nelement() for state in states for t in state.values() if hasattr(t, "nelement"))
+
+    def disk_bytes(self):
+        if not self.cache_dir:
+            return 0
+        with os.scandir(self.cache_dir) as it:
+            return sum(e.stat().st_size for e in it if e.name.endswith(self.SUFFIX))
+
+    # SamPredictor helpers
+    def store_predictor(self, key, predictor):
+        self.put(key, {
+            "features": predictor.features.detach().cpu(),
+            "original_size": tuple(predictor.original_size),
+            "input_size": tuple(predictor.input_size),
+        })
+
+    def load_predictor(self, key, predictor) -> bool:
+        """ Restore the features of a cached image into predictor, skip the image encoder """
+        state = self.get(key)
+        if state is None:
+            return False
+        predictor.reset_image()
+        predictor.features = state["features"].to(predictor.device)
+        predictor.original_size = tuple(state["original_size"])
+        predictor.input_size = tuple(state["input_size"])
+        predictor.is_image_set = True
+        return True
@@ -0,0 +1,92 @@
+from collections import deque
+
+import numpy as np
+
+
+def pack_record(record):
+    """ Mask record -> bit-packed copy, 1 bit per pixel of its bounding box """
+    return {
+        "bbox": record["bbox"],
+        "bits": np.packbits(record["mask"].ravel()),
+        "opt": record["opt"],
+        "id": record.get("id"),
+        "area": record.get("area"),
+    }
+
+
+def unpack_record(packed):
+    x0, y0, x1, y1 = packed["bbox"]
+    mask = np.unpackbits(packed["bits"], count=(y1 - y0) * (x1 - x0)).reshape(y1 - y0, x1 - x0).astype(bool)
+    record = {"bbox": packed["bbox"], "mask": mask, "opt": packed["opt"]}
+    if packed.get("id") is not None:
+        record["id"], record["area"] = packed["id"], packed["area"]
+    return record
+
+
+def step_nbytes(step):
+    nbytes = 64     # dict and bookkeeping, so that a flood of tiny steps is bounded too
+    for packed in step.get("records", []) + step.get("removed", []):
+        nbytes += packed["bits"].nbytes + 64
+    for key in ("box", "point", "boxes", "points", "labels"):
+        if key in step:
+            nbytes += step[key].nbytes
+    return nbytes
+
+
+class EditHistory:
+    """ Undo / redo stacks of editing steps, bounded by a byte budget instead of a step count
+
+    A step is a dict with a "kind":
+    - {"kind": "box", "box": array}: a box prompt was added
+    - {"kind": "point", "point": array, "label": 1 / 0}: a positive / negative point prompt was added
+    - {"kind": "inference", "records": [pack_record(...)], "points": array, "labels": array, "boxes": array}:
+      masks were appended to session.masks, the pending prompts they were predicted from were consumed
+    - {"kind": "delete", "records": [pack_record(...)]}: holds were deleted from session.masks
+    - {"kind": "import", "records": [...], "removed": [...]}: imported masks replaced the removed holds
+
+    The budget covers both stacks. When it is exceeded the oldest undo steps
+    are forgotten first, then the farthest redo steps.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.undo_steps = deque()
+        self.redo_steps = deque()      # the next step to redo is the last one
+        self.nbytes = 0
+
+    def push(self, step):
+        step["nbytes"] = step_nbytes(step)
+        self.undo_steps.append(step)
+        self.nbytes += step["nbytes"]
+        for dropped in self.redo_steps:
+            self.nbytes -= dropped["nbytes"]
+        self.redo_steps.clear()
+        self.trim()
+
+    def undo(self):
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return step
+
+    def redo(self):
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return step
+
+    def trim(self):
+        while self.nbytes > self.max_bytes and self.undo_steps:
+            self.nbytes -= self.undo_steps.popleft()["nbytes"]
+        while self.nbytes > self.max_bytes and self.redo_steps:
+            self.nbytes -= self.redo_steps.popleft()["nbytes"]
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.undo_steps)
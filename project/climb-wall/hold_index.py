@@ -0,0 +1,65 @@
+class HoldIndex:
+    """ Uniform grid over the full-resolution image: cell -> ids of the holds whose bbox overlaps it
+
+    A hold is a committed mask record with an "id". Ids grow with the drawing
+    order, so when holds overlap the one drawn on top has the largest id.
+    A hit test only looks at the holds of one cell and reads one mask pixel
+    of each, whatever the number of holds on the wall.
+    """
+
+    def __init__(self, shape, cell=128):
+        self.height, self.width = shape[:2]
+        self.cell = cell
+        self.grid = {}          # (cx, cy) -> set of hold ids
+        self.holds = {}         # id -> record
+
+    def cells(self, bbox):
+        x0, y0, x1, y1 = bbox
+        for cy in range(y0 // self.cell, (y1 - 1) // self.cell + 1):
+            for cx in range(x0 // self.cell, (x1 - 1) // self.cell + 1):
+                yield cx, cy
+
+    def add(self, record):
+        self.holds[record["id"]] = record
+        for key in self.cells(record["bbox"]):
+            self.grid.setdefault(key, set()).add(record["id"])
+
+    def remove(self, hold_id):
+        record = self.holds.pop(hold_id, None)
+        if record is None:
+            return None
+        for key in self.cells(record["bbox"]):
+            ids = self.grid.get(key)
+            if ids is not None:
+                ids.discard(hold_id)
+                if not ids:
+                    del self.grid[key]
+        return record
+
+    def clear(self):
+        self.grid.clear()
+        self.holds.clear()
+
+    def get(self, hold_id):
+        return self.holds.get(hold_id)
+
+    def hit(self, x, y):
+        """ The topmost hold whose mask covers the full-resolution pixel (x, y), None when there is none """
+        x, y = int(x), int(y)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        for hold_id in sorted(self.grid.get((x // self.cell, y // self.cell), ()), reverse=True):
+            record = self.holds[hold_id]
+            x0, y0, x1, y1 = record["bbox"]
+            if x0 <= x < x1 and y0 <= y < y1 and record["mask"][y - y0, x - x0]:
+                return record
+        return None
+
+    def __len__(self):
+        return len(self.holds)
+
+
+def hold_info(record):
+    """ JSON description of a hold, bbox as [x, y, w, h] at full resolution """
+    x0, y0, x1, y1 = record["bbox"]
+    return {"id": record["id"], "bbox": [x0, y0, x1 - x0, y1 - y0], "area": record["area"]}
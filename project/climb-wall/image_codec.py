@@ -0,0 +1,51 @@
+import cv2
+
+
+# image_type -> (cv2 extension, mimetype)
+FORMATS = {
+    "png": (".png", "image/png"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "jpg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+}
+DEFAULT_QUALITY = 90
+DEFAULT_PNG_COMPRESSION = 1     # 0-9, zlib level: 1 is several times faster than 6 for ~the same size
+
+
+def negotiate(image_type=None, accept=None):
+    """ Pick an image_type from the request, else from the Accept header, else png """
+    if image_type in FORMATS:
+        return image_type
+    if accept:
+        for candidate in ("webp", "jpeg", "png"):
+            if FORMATS[candidate][1] in accept:
+                return candidate
+    return "png"
+
+
+def encode_image(image, image_type="png", quality=None, png_compression=None):
+    """ Encode an RGBA (OpenCV channel order) image
+
+    image_type:       png / jpeg / webp
+    quality:          1-100 for jpeg and webp (webp above 100 is lossless)
+    png_compression:  0-9 zlib level for png
+
+    return:
+    (encoded bytes, mimetype)
+    """
+    ext, mimetype = FORMATS[image_type]
+    params = []
+    if ext == ".png":
+        level = DEFAULT_PNG_COMPRESSION if png_compression is None else int(png_compression)
+        params = [cv2.IMWRITE_PNG_COMPRESSION, min(max(level, 0), 9)]
+    elif ext == ".jpg":
+        # JPEG has no alpha channel
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        params = [cv2.IMWRITE_JPEG_QUALITY, min(max(int(quality or DEFAULT_QUALITY), 1), 100)]
+    elif ext == ".webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, min(max(int(quality or DEFAULT_QUALITY), 1), 101)]
+    ok, buffer = cv2.imencode(ext, image, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {image_type}")
+    return buffer.tobytes(), mimetype
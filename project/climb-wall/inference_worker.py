@@ -0,0 +1,186 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+
+
+class Job:
+    """ A unit of model work queued on the InferenceWorker
+
+    status: queued -> running -> done / failed, or queued -> superseded when a
+    newer job of the same session and kind replaced it before it started.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SUPERSEDED = "superseded"
+
+    def __init__(self, session_key, kind, fn):
+        self.id = uuid.uuid4().hex
+        self.session_key = session_key
+        self.kind = kind
+        self.fn = fn
+        self.status = self.QUEUED
+        self.result = None
+        self.error = None
+        self.superseded_by = None       # the Job that runs instead of this one
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.spans = []                 # (stage, seconds) recorded while fn ran, see metrics.py
+        self.event = threading.Event()
+
+    @property
+    def final(self):
+        """ The job that really runs, following the chain of superseding jobs """
+        job = self
+        while job.superseded_by is not None:
+            job = job.superseded_by
+        return job
+
+    def wait(self, timeout=None):
+        """ Wait for the job (or the job that superseded it) to finish, return that job """
+        deadline = None if timeout is None else time.time() + timeout
+        job = self
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            job.event.wait(remaining)
+            if job.superseded_by is None or (deadline is not None and time.time() >= deadline):
+                return job
+            job = job.superseded_by
+
+    def to_dict(self):
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "queued_seconds": round((self.started or time.time()) - self.created, 3),
+        }
+        if self.started is not None and self.finished is not None:
+            data["run_seconds"] = round(self.finished - self.started, 3)
+        if self.spans:
+            timings = data["timings_ms"] = {}
+            for stage, seconds in self.spans:
+                timings[stage] = round(timings.get(stage, 0) + seconds * 1000, 1)
+        if self.error is not None:
+            data["error"] = self.error
+        if self.superseded_by is not None:
+            data["superseded_by"] = self.superseded_by.id
+        if isinstance(self.result, dict):
+            data.update(self.result)
+        return data
+
+
+class InferenceWorker:
+    """ The only thread that touches the model
+
+    Request handlers submit jobs and return right away (or wait on them), so a
+    slow inference never blocks the threads serving uploads and other clicks.
+    A job still queued when its session submits another job of the same kind
+    is superseded: only the latest one runs.
+
+    With a metrics.Metrics registry, the spans of a job are collected into
+    job.spans and the queue / run times are exported per job kind.
+    """
+
+    def __init__(self, max_finished=256, name="inference-worker", metrics=None):
+        self.max_finished = max_finished
+        self.metrics = metrics
+        if metrics is not None:
+            self.job_seconds = metrics.histogram("job_seconds", "Time jobs spent queued / running.", ["kind", "phase"])
+            self.jobs_total = metrics.counter("jobs_total", "Finished jobs by final status.", ["kind", "status"])
+            metrics.gauge("queue_length", "Jobs waiting for the inference worker.", self.queue_length)
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.pending = {}               # (session_key, kind) -> queued Job
+        self.jobs = OrderedDict()       # job id -> Job, the finished ones are trimmed to max_finished
+        self.finished = deque()
+        self.current = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, session_key, kind, fn):
+        """ Queue fn() to run on the worker thread, return its Job """
+        job = Job(session_key, kind, fn)
+        with self.cond:
+            old = self.pending.pop((session_key, kind), None)
+            if old is not None:
+                self.queue.remove(old)
+                old.status = Job.SUPERSEDED
+                old.superseded_by = job
+                old.fn = None
+                self._finish(old)
+            self.pending[(session_key, kind)] = job
+            self.queue.append(job)
+            self.jobs[job.id] = job
+            self.cond.notify()
+        return job
+
+    def get(self, job_id):
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def run(self, session_key, kind, fn, timeout=None):
+        """ submit() and wait, for callers that need the result now """
+        return self.submit(session_key, kind, fn).wait(timeout)
+
+    def has_jobs(self, session_key):
+        """ Whether a job of the session is queued or running """
+        with self.cond:
+            return (any(key == session_key for key, _ in self.pending)
+                    or (self.current is not None and self.current.session_key == session_key))
+
+    def queue_length(self):
+        with self.cond:
+            return len(self.queue)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _finish(self, job):
+        # Caller holds self.cond
+        job.finished = job.finished or time.time()
+        if self.metrics is not None:
+            self.jobs_total.inc(kind=job.kind, status=job.status)
+            if job.started is not None:
+                self.job_seconds.observe(job.started - job.created, kind=job.kind, phase="queued")
+                self.job_seconds.observe(job.finished - job.started, kind=job.kind, phase="run")
+        job.event.set()
+        self.finished.append(job.id)
+        while len(self.finished) > self.max_finished:
+            self.jobs.pop(self.finished.popleft(), None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                job = self.queue.popleft()
+                self.pending.pop((job.session_key, job.kind), None)
+                job.status = Job.RUNNING
+                job.started = time.time()
+                self.current = job
+            spans = nullcontext() if self.metrics is None else self.metrics.collect_spans(job.spans)
+            try:
+                with spans:
+                    job.result = job.fn()
+                status = Job.DONE
+            except Exception as e:
+                print(f"Job {job.kind} {job.id[:8]} failed: {e!r}")
+                job.error = str(e) or repr(e)
+                status = Job.FAILED
+            with self.cond:
+                job.status = status
+                job.fn = None
+                self.current = None
+                job.finished = time.time()
+                self._finish(job)
@@ -0,0 +1,402 @@
+import cv2
+import numpy as np
+
+
+CONTOUR_COLOR = (255, 0, 255, 255)  # bright magenta outline
+CONTOUR_THICKNESS = 2
+CONTOUR_PAD = CONTOUR_THICKNESS     # findContours ignores the 1px image border, drawContours spills 1px out
+BOOST = 1.2                         # saturation / brightness factor of highlighted pixels
+SIMD_BLOCK = 256                    # pixels, multiple of every cvtColor vector width
+# HSV -> HSV after one boost: H unchanged, S / V with the same float32 arithmetic as boosting them directly
+_levels = np.arange(256, dtype=np.uint8)
+_boosted = np.clip(_levels.astype(np.float32) * BOOST, 0, 255).astype(np.uint8)
+BOOST_LUT = np.stack([_levels, _boosted, _boosted], axis=-1).reshape(1, 256, 3)
+
+
+RGB_BITS = np.array([255, 255, 255, 0], dtype=np.uint8).view(np.uint32)[0]   # RGB bytes of an RGBA word
+
+
+def mask_record(mask, opt="positive"):
+    """ Full-frame boolean mask -> {"bbox": (x0, y0, x1, y1), "mask": cropped mask, "opt": opt}
+
+    bbox is half-open, "mask" only covers the bbox. Returns None for an empty mask.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    x0, y0, x1, y1 = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+    return {
+        "bbox": (x0, y0, x1, y1),
+        "mask": np.ascontiguousarray(mask[y0:y1, x0:x1], dtype=bool),
+        "opt": opt,
+    }
+
+
+def full_mask(record, shape):
+    mask = np.zeros(shape[:2], dtype=bool)
+    x0, y0, x1, y1 = record["bbox"]
+    mask[y0:y1, x0:x1] = record["mask"]
+    return mask
+
+
+def scale_record(record, scale, shape):
+    """ Mask record of a full-resolution image -> record of a reduced level of it
+
+    scale:  (x, y) factor from full-resolution to level coordinates
+    shape:  shape of the level
+    """
+    x0, y0, x1, y1 = record["bbox"]
+    sx, sy = scale
+    h, w = shape[:2]
+    dx0, dy0 = min(int(x0 * sx), w - 1), min(int(y0 * sy), h - 1)
+    dx1, dy1 = max(min(int(np.ceil(x1 * sx)), w), dx0 + 1), max(min(int(np.ceil(y1 * sy)), h), dy0 + 1)
+    # INTER_AREA averages the covered pixels, a level pixel is in the mask when at least half of it is
+    coverage = cv2.resize(record["mask"].astype(np.uint8) * 255, (dx1 - dx0, dy1 - dy0), interpolation=cv2.INTER_AREA)
+    return {"bbox": (dx0, dy0, dx1, dy1), "mask": coverage >= 128, "opt": record["opt"]}
+
+
+def logits_mask(logits, input_size, shape, image_size=1024, threshold=0.0):
+    """ SAM low-res mask logits -> boolean mask of an image of the given shape
+
+    logits cover the padded image_size x image_size model input, of which only
+    input_size (h, w) holds the resized image. One bilinear resize of that
+    part, cheap enough for every click when shape is the display level.
+    """
+    lh, lw = logits.shape[-2:]
+    h = int(np.ceil(input_size[0] * lh / image_size))
+    w = int(np.ceil(input_size[1] * lw / image_size))
+    resized = cv2.resize(np.ascontiguousarray(logits.reshape(lh, lw)[:h, :w], dtype=np.float32),
+                         (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+    return resized > threshold
+
+
+def padded_bbox(bbox, shape, pad=CONTOUR_PAD):
+    x0, y0, x1, y1 = bbox
+    h, w = shape[:2]
+    return max(x0 - pad, 0), max(y0 - pad, 0), min(x1 + pad, w), min(y1 + pad, h)
+
+
+def boost_pixels(pixels):
+    """ Increase saturation and brightness of an (N, 3) array of RGB pixels by BOOST, (N, 3) RGB result
+
+    OpenCV's HSV2RGB rounds differently in its SIMD body and its scalar tail, so
+    the pixels are padded to a whole number of SIMD blocks: the result of a pixel
+    then only depends on its value, not on where it sits in the batch.
+    """
+    n = len(pixels)
+    buf = np.zeros((n + (-n % SIMD_BLOCK), 3), dtype=np.uint8)
+    buf[:n] = pixels[:, :3]
+    # One SIMD_BLOCK per row, so that OpenCV can also split the work across threads
+    hsv = cv2.cvtColor(buf.reshape(-1, SIMD_BLOCK, 3), cv2.COLOR_RGB2HSV)
+    hsv = cv2.LUT(hsv, BOOST_LUT)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB).reshape(-1, 3)[:n]
+
+
+def mask_contours(record, shape):
+    """ External contours of a mask, relative to padded_bbox(record["bbox"]) """
+    x0, y0, x1, y1 = record["bbox"]
+    px0, py0, px1, py1 = padded_bbox(record["bbox"], shape)
+    mask_uint8 = np.zeros((py1 - py0, px1 - px0), dtype=np.uint8)
+    mask_uint8[y0 - py0:y1 - py0, x0 - px0:x1 - px0] = record["mask"] * 255
+    contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contours
+
+
+def render_masks(image, records, region=None):
+    """ Draw a list of masks on an RGBA image in place, in one pass
+
+    Pixel-identical to drawing the masks one after another (boost the masked
+    pixels, make them opaque, outline the mask in magenta), but every mask is
+    only visited once and each pixel only goes through the HSV conversion for
+    the boosts it really gets:
+
+    - a pixel on the outline of mask i ends up as magenta boosted once for
+      every later mask that covers it,
+    - any other pixel is boosted once for every mask that covers it.
+
+    The original renderer (Web_App.IncreaseSaturationBrightness) converted the
+    whole image to HSV and back once per mask, which moves every pixel by a few
+    levels each time. Pixels here are only converted when they are boosted, so
+    the result differs from it by that drift (see test_mask_render.py).
+
+    records:  mask records in drawing order
+    region:   (x0, y0, x1, y1) to redraw, by default the padded bbox of all masks
+
+    return:
+    the redrawn region, None when there is nothing to draw
+    """
+    if region is None:
+        for record in records:
+            region = union_bbox(region, padded_bbox(record["bbox"], image.shape))
+        if region is None:
+            return None
+    rx0, ry0, rx1, ry1 = region
+    view = image[ry0:ry1, rx0:rx1]
+    after = np.zeros(view.shape[:2], dtype=np.uint16)     # masks drawn after the current one
+    boosts = np.zeros(view.shape[:2], dtype=np.uint16)
+    outlined = np.zeros(view.shape[:2], dtype=bool)
+    for record in reversed(records):
+        padded = padded_bbox(record["bbox"], image.shape)
+        sub = intersect_bbox(padded, region)
+        if sub is None:
+            continue
+        sx0, sy0, sx1, sy1 = sub
+        local = (slice(sy0 - ry0, sy1 - ry0), slice(sx0 - rx0, sx1 - rx0))
+        # Drawn on the whole padded bbox: OpenCV clips lines to the canvas, which can move their pixels
+        outline = np.zeros((padded[3] - padded[1], padded[2] - padded[0]), dtype=np.uint8)
+        cv2.drawContours(outline, mask_contours(record, image.shape), -1, color=1, thickness=CONTOUR_THICKNESS)
+        outline = outline[sy0 - padded[1]:sy1 - padded[1], sx0 - padded[0]:sx1 - padded[0]]
+        # Only the last outline drawn over a pixel counts
+        new = (outline > 0) & ~outlined[local]
+        outlined[local] |= new
+        np.copyto(boosts[local], after[local], where=new)
+
+        sub = intersect_bbox(record["bbox"], region)
+        if sub is None:
+            continue
+        x0, y0 = record["bbox"][:2]
+        sx0, sy0, sx1, sy1 = sub
+        after[sy0 - ry0:sy1 - ry0, sx0 - rx0:sx1 - rx0] += record["mask"][sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0]
+
+    # Gather the touched pixels bbox by bbox, never scanning the whole region
+    rw = rx1 - rx0
+    seen = np.zeros(view.shape[:2], dtype=bool)
+    local_idx, image_idx = [], []
+    for record in records:
+        sub = intersect_bbox(padded_bbox(record["bbox"], image.shape), region)
+        if sub is None:
+            continue
+        sx0, sy0, sx1, sy1 = sub
+        local = (slice(sy0 - ry0, sy1 - ry0), slice(sx0 - rx0, sx1 - rx0))
+        touched = (outlined[local] | (after[local] > 0)) & ~seen[local]
+        seen[local] |= touched
+        ly, lx = np.nonzero(touched)
+        local_idx.append((ly + (sy0 - ry0)) * rw + (lx + (sx0 - rx0)))
+        image_idx.append((ly + sy0) * image.shape[1] + (lx + sx0))
+    if len(local_idx) == 0:
+        return region
+    local_idx, image_idx = np.concatenate(local_idx), np.concatenate(image_idx)
+
+    # One uint32 per RGBA pixel makes the gather / scatter cheap
+    words = image.view(np.uint32).reshape(-1)
+    pixels = words[image_idx].view(np.uint8).reshape(-1, 4)
+    on_outline = outlined.reshape(-1)[local_idx]
+    covered = after.reshape(-1)[local_idx]
+    counts = np.where(on_outline, boosts.reshape(-1)[local_idx], covered)
+    pixels[on_outline] = CONTOUR_COLOR
+    pixels[:, 3] = np.where(covered > 0, 255, pixels[:, 3])
+    # Black stays black, no need to convert it (the colored-masks image is mostly black)
+    rgb_nonzero = (pixels.view(np.uint32).reshape(-1) & RGB_BITS) != 0
+    todo = np.flatnonzero((counts > 0) & rgb_nonzero)
+    for level in range(1, int(counts.max(initial=0)) + 1):
+        if level > 1:
+            todo = todo[counts[todo] >= level]
+        if len(todo) == 0:
+            break
+        pixels[todo, :3] = boost_pixels(pixels[todo])
+    words[image_idx] = pixels.view(np.uint32).reshape(-1)
+    return region
+
+
+def records_from_stack(masks, opt="positive"):
+    """ (N, H, W) boolean stack -> mask records, empty masks dropped """
+    return [r for r in (mask_record(mask, opt) for mask in masks) if r is not None]
+
+
+def records_from_labels(labels, opt="positive"):
+    """ (H, W) label map, 0 = background, label i drawn before label i+1 -> mask records """
+    ys, xs = np.nonzero(labels)
+    if len(ys) == 0:
+        return []
+    values = labels[ys, xs]
+    order = np.argsort(values, kind="stable")
+    values, ys, xs = values[order], ys[order], xs[order]
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    y0s, y1s = np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts) + 1
+    x0s, x1s = np.minimum.reduceat(xs, starts), np.maximum.reduceat(xs, starts) + 1
+    records = []
+    for value, x0, y0, x1, y1 in zip(values[starts], x0s, y0s, x1s, y1s):
+        x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+        records.append({
+            "bbox": (x0, y0, x1, y1),
+            "mask": labels[y0:y1, x0:x1] == value,
+            "opt": opt,
+        })
+    return records
+
+
+def overlay_base(origin, out=None):
+    """ Origin image with its alpha channel halved, the background of the overlay
+
+    out:  array of the shape of origin to write into (e.g. a region of the overlay), allocated when None
+    """
+    if out is None:
+        out = np.empty_like(origin)
+    out[:, :, :3] = origin[:, :, :3]
+    # alpha * 0.5 truncated to uint8, without the float copy
+    np.right_shift(origin[:, :, 3], 1, out=out[:, :, 3])
+    return out
+
+
+def zeros_view(shape, dtype=np.uint8):
+    """ Read-only all-zero array of any shape backed by a single element, for placeholder images """
+    return np.broadcast_to(np.zeros(1, dtype=dtype), shape)
+
+
+class MaskComposite:
+    """ Persistent overlay, colored-masks image and union mask of one image
+
+    Adding masks only updates the pixels inside each new mask's bounding box, so
+    the cost of an inference does not grow with the number of masks already drawn.
+
+    origin may be a reduced level of the image (see pyramid.py): records are
+    always given at full resolution (full_shape) and scaled down once, when
+    they are first drawn.
+
+    The buffers are only allocated by the first add(), and kept after reset()
+    (or handed over from the composite of the previous image, spare) to be
+    reused by the next one.
+    """
+
+    def __init__(self, origin, full_shape=None, spare=None):
+        self.origin = origin
+        self.full_shape = origin.shape if full_shape is None else full_shape
+        self.scale = (origin.shape[1] / self.full_shape[1], origin.shape[0] / self.full_shape[0])
+        self.scaled = {}        # id(full-resolution record) -> (record, record at the scale of origin)
+        self.overlay = None     # origin with masks highlighted, alpha halved elsewhere
+        self.colored = None     # masks highlighted on a transparent black image
+        self.union = None       # uint8 0/1 union of all masks
+        self.dirty = None       # padded bbox touched by the last add(), (x0, y0, x1, y1)
+        self.spare = spare      # (overlay, colored, union) buffers to reuse
+
+    def reset(self):
+        if self.overlay is not None:
+            self.spare = (self.overlay, self.colored, self.union)
+        self.overlay = self.colored = self.union = self.dirty = None
+        self.scaled.clear()
+
+    def buffers(self):
+        """ The buffers held, in use or spare, for the composite of the next image """
+        return self.spare if self.overlay is None else (self.overlay, self.colored, self.union)
+
+    def allocate(self):
+        spare, self.spare = self.spare, None
+        if spare is not None and spare[0].shape == self.origin.shape:
+            self.overlay, self.colored, self.union = spare
+            self.colored.fill(0)
+            self.union.fill(0)
+        else:
+            self.overlay = np.empty_like(self.origin)
+            self.colored = np.zeros_like(self.origin)
+            self.union = np.zeros(self.origin.shape[:2], dtype=np.uint8)
+        overlay_base(self.origin, out=self.overlay)
+
+    def image(self):
+        return self.origin if self.overlay is None else self.overlay
+
+    def view(self, records):
+        """ records at the scale of origin """
+        if self.scale == (1.0, 1.0):
+            return records
+        scaled = []
+        for record in records:
+            hit = self.scaled.get(id(record))
+            if hit is None or hit[0] is not record:
+                hit = self.scaled[id(record)] = (record, scale_record(record, self.scale, self.origin.shape))
+            scaled.append(hit[1])
+        return scaled
+
+    def nbytes(self):
+        """ Bytes of the buffers held besides origin: overlay, colored, union (in use or spare) and the scaled masks """
+        buffers = self.buffers() or ()
+        return sum(b.nbytes for b in buffers) + sum(scaled["mask"].nbytes for _, scaled in list(self.scaled.values()))
+
+    def forget(self, records):
+        for record in records:
+            self.scaled.pop(id(record), None)
+
+    def add(self, records):
+        records = self.view(records)
+        if self.overlay is None:
+            self.allocate()
+        dirty = render_masks(self.overlay, records)
+        render_masks(self.colored, records, dirty)
+        for record in records:
+            x0, y0, x1, y1 = record["bbox"]
+            self.union[y0:y1, x0:x1] |= record["mask"]
+        self.dirty = dirty
+        return dirty
+
+    def redraw(self, records, region):
+        """ Redraw region from the origin image, records are all masks of the image in drawing order """
+        records = self.view(records)
+        x0, y0, x1, y1 = region
+        overlay_base(self.origin[y0:y1, x0:x1], out=self.overlay[y0:y1, x0:x1])
+        self.colored[y0:y1, x0:x1] = 0
+        self.union[y0:y1, x0:x1] = 0
+        touching = [r for r in records if intersect_bbox(padded_bbox(r["bbox"], self.origin.shape), region)]
+        render_masks(self.overlay, touching, region)
+        render_masks(self.colored, touching, region)
+        for record in touching:
+            sub = intersect_bbox(record["bbox"], region)
+            if sub is None:
+                continue
+            sx0, sy0, sx1, sy1 = sub
+            rx0, ry0 = record["bbox"][:2]
+            self.union[sy0:sy1, sx0:sx1] |= record["mask"][sy0 - ry0:sy1 - ry0, sx0 - rx0:sx1 - rx0]
+        self.dirty = region
+        return region
+
+    def remove(self, records, removed):
+        """ Erase the removed masks, records are the masks that are left
+
+        Only the bounding boxes of the removed masks are redrawn.
+        """
+        if len(records) == 0:
+            self.reset()
+            return None
+        region = None
+        for record in self.view(removed):
+            region = union_bbox(region, padded_bbox(record["bbox"], self.origin.shape))
+        self.forget(removed)
+        if region is None:
+            self.dirty = None
+            return None
+        return self.redraw(records, region)
+
+    def insert(self, records, inserted):
+        """ Draw masks put back in the middle of the drawing order, records are all masks including them
+
+        Only the bounding boxes of the inserted masks are redrawn.
+        """
+        if self.overlay is None:
+            return self.add(records)
+        region = None
+        for record in self.view(inserted):
+            region = union_bbox(region, padded_bbox(record["bbox"], self.origin.shape))
+        if region is None:
+            self.dirty = None
+            return None
+        return self.redraw(records, region)
+
+    def rebuild(self, records):
+        self.reset()
+        if len(records) > 0:
+            self.add(records)
+            self.dirty = (0, 0, self.origin.shape[1], self.origin.shape[0])
+
+
+def intersect_bbox(a, b):
+    x0, y0, x1, y1 = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
+
+
+def union_bbox(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
@@ -0,0 +1,196 @@
+""" Request spans and Prometheus metrics, without the prometheus_client dependency
+
+    with metrics.span("encode"):
+        ...
+
+times a stage of the current request (or inference job): the duration goes to
+the climb_stage_seconds{stage=...} histogram and to the span list the current
+thread collects into, which ends up in the Server-Timing header of the response.
+Metrics.render() is the text exposition format served on GET /metrics.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a cached-embedding click to a vit_h image encoder run on CPU
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(v)}" for key, v in values]
+
+
+class Gauge(Metric):
+    """ Read when scraped: fn() returns a number, or {label values tuple: number} """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def collect(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(v)}" for key, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.series = {}        # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        with self.lock:
+            series = sorted((key, list(values)) for key, values in self.series.items())
+        lines = []
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                le = format_labels(self.labels, key, [("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {values[-2]!r}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {values[-1]}")
+        return lines
+
+
+class Metrics:
+    """ Registry of the metrics of a Web_App, and the span recorder """
+
+    def __init__(self, prefix="climb"):
+        self.prefix = prefix
+        self.metrics = []
+        self.local = threading.local()
+        self.stage_seconds = self.histogram("stage_seconds", "Duration of a request / job stage.", ["stage"])
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(f"{self.prefix}_{name}", help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(f"{self.prefix}_{name}", help, labels))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self.add(Gauge(f"{self.prefix}_{name}", help, fn, labels))
+
+    def bind_spans(self, spans):
+        """ Spans recorded by this thread are appended to spans from now on (None to stop), returns spans """
+        self.local.spans = spans
+        return spans
+
+    @contextmanager
+    def collect_spans(self, spans):
+        """ bind_spans() for a block, the outer binding is restored afterwards """
+        outer = getattr(self.local, "spans", None)
+        self.bind_spans(spans)
+        try:
+            yield spans
+        finally:
+            self.bind_spans(outer)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        self.stage_seconds.observe(seconds, stage=stage)
+        spans = getattr(self.local, "spans", None)
+        if spans is not None:
+            spans.append((stage, seconds))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.collect()
+            except Exception as e:
+                # A broken gauge must not hide all the other metrics
+                print(f"Metric {metric.name} failed: {e!r}")
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def server_timing(spans):
+    """ Server-Timing header value of a span list, the durations of a repeated stage are summed """
+    totals = {}
+    for stage, seconds in spans:
+        totals[stage] = totals.get(stage, 0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
@@ -0,0 +1,77 @@
+""" Fast SAM checkpoint loading
+
+The stock sam_model_registry[...] builder randomly initializes every weight and
+then reads the whole checkpoint into memory before copying it over. Here the
+model is built on the "meta" device (no memory, no init) and the checkpoint
+tensors are assigned directly:
+
+- .pth files are loaded memory-mapped (torch.load(mmap=True)), pages are read
+  from disk on first use
+- .safetensors files are memory-mapped too and need no unpickling, convert once
+  with:   python model_loader.py --checkpoint model/sam_vit_h_4b8939.pth
+
+torch and segment_anything are imported lazily so that the web server can
+bind its port before they are loaded.
+"""
+import os
+import time
+
+# Sam.pixel_mean / pixel_std are non-persistent buffers, they are not in the checkpoints
+PIXEL_MEAN = [123.675, 116.28, 103.53]
+PIXEL_STD = [58.395, 57.12, 57.375]
+SAFETENSORS_SUFFIX = ".safetensors"
+
+
+def load_state_dict(checkpoint, mmap=True):
+    import torch
+    if checkpoint.endswith(SAFETENSORS_SUFFIX):
+        try:
+            from safetensors.torch import load_file
+        except ImportError:
+            raise ImportError("pip install safetensors to load .safetensors checkpoints")
+        return load_file(checkpoint, device="cpu")
+    return torch.load(checkpoint, map_location="cpu", mmap=mmap, weights_only=True)
+
+
+def build_sam(model_type, checkpoint=None, device="cpu", mmap=True):
+    """ sam_model_registry[model_type](checkpoint).to(device), without initializing the weights twice """
+    import torch
+    from segment_anything import sam_model_registry
+
+    start = time.time()
+    if not checkpoint:
+        sam = sam_model_registry[model_type](checkpoint=None)
+    else:
+        state = load_state_dict(checkpoint, mmap)
+        with torch.device("meta"):
+            sam = sam_model_registry[model_type](checkpoint=None)
+        sam.load_state_dict(state, assign=True)
+        sam.register_buffer("pixel_mean", torch.tensor(PIXEL_MEAN).view(-1, 1, 1), False)
+        sam.register_buffer("pixel_std", torch.tensor(PIXEL_STD).view(-1, 1, 1), False)
+    sam.eval()
+    sam.to(device=device)
+    print(f"Built {model_type} from {checkpoint or 'random weights'} in {time.time() - start:.2f}s")
+    return sam
+
+
+def convert_checkpoint(checkpoint, output=None):
+    """ .pth -> .safetensors next to it (or at output) """
+    import torch
+    from safetensors.torch import save_file
+
+    output = output or os.path.splitext(checkpoint)[0] + SAFETENSORS_SUFFIX
+    state = torch.load(checkpoint, map_location="cpu", weights_only=True)
+    # safetensors refuses tensors sharing memory, and wants them contiguous
+    save_file({k: v.contiguous().clone() for k, v in state.items()}, output)
+    print(f"Wrote {output}")
+    return output
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(description="Convert a SAM .pth checkpoint to .safetensors for fast loading")
+    p.add_argument("--checkpoint", type=str, required=True)
+    p.add_argument("--output", type=str, default=None)
+    a = p.parse_args()
+    convert_checkpoint(a.checkpoint, a.output)
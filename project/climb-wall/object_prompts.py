@@ -0,0 +1,102 @@
+""" Several objects in one inference: prompt grouping and chunked mask decoding
+
+An inference click with more than one box segments one object per box. The
+points of the click are given to the box that contains them (the smallest one
+when boxes are nested). Points outside every box form one more object
+together, when at least one of them is positive.
+
+Objects are decoded in chunks of objects with the same prompt layout (number
+of points, box or not), so no padding changes what SAM sees. Each mask is then
+upsampled on its own and cropped to its bounding box before it leaves the
+device. Peak memory is the decoder activations of one chunk (--object_batch)
+plus one full-resolution mask, whatever the number of boxes.
+
+torch is imported lazily, like everywhere on the web server side.
+"""
+import numpy as np
+
+
+def group_prompts(points, labels, boxes):
+    """ Split the prompts of a click into objects
+
+    points:  (N, 2) full-resolution points, labels (N,) 1 / 0
+    boxes:   (B, 4) full-resolution x0, y0, x1, y1
+
+    return:
+    list of {"points": (n, 2) float32, "labels": (n,) int32, "box": (4,) float32 or None}, boxes first, in order
+    """
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    labels = np.asarray(labels, dtype=np.int32).reshape(-1)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    owner = np.full(len(points), -1)
+    if len(boxes) > 0 and len(points) > 0:
+        inside = ((points[:, None, 0] >= boxes[None, :, 0]) & (points[:, None, 0] <= boxes[None, :, 2]) &
+                  (points[:, None, 1] >= boxes[None, :, 1]) & (points[:, None, 1] <= boxes[None, :, 3]))
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        smallest = np.argmin(np.where(inside, areas[None], np.inf), axis=1)
+        owner = np.where(inside.any(axis=1), smallest, -1)
+    objects = [
+        {"points": points[owner == i], "labels": labels[owner == i], "box": box}
+        for i, box in enumerate(boxes)
+    ]
+    outside = owner == -1
+    if np.any(labels[outside] == 1):
+        objects.append({"points": points[outside], "labels": labels[outside], "box": None})
+    return objects
+
+
+def mask_record_torch(mask, opt="positive"):
+    """ mask_render.mask_record() of a (H, W) bool tensor, only the bbox crop is copied to the CPU """
+    import torch
+    rows = torch.nonzero(mask.any(dim=1)).flatten()
+    if len(rows) == 0:
+        return None
+    cols = torch.nonzero(mask.any(dim=0)).flatten()
+    x0, y0, x1, y1 = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+    return {
+        "bbox": (x0, y0, x1, y1),
+        "mask": np.ascontiguousarray(mask[y0:y1, x0:x1].cpu().numpy(), dtype=bool),
+        "opt": opt,
+    }
+
+
+def predict_objects(predictor, objects, chunk_size=4, decoder=None):
+    """ One mask record per object (None when its mask is empty), in the order of objects
+
+    predictor:  a SamPredictor with the image set
+    decoder:    decoder_backend.DecoderBackend running the mask decoder, TorchDecoder by default
+    """
+    import torch
+    from decoder_backend import TorchDecoder
+    decoder = decoder or TorchDecoder()
+    model = predictor.model
+    groups = {}
+    for i, obj in enumerate(objects):
+        groups.setdefault((len(obj["points"]), obj["box"] is not None), []).append(i)
+
+    records = [None] * len(objects)
+    for (n_points, has_box), indices in groups.items():
+        # Several candidates only help to disambiguate a lone point, as in SamPredictor
+        multimask = n_points == 1 and not has_box
+        for start in range(0, len(indices), max(chunk_size, 1)):
+            chunk = indices[start:start + max(chunk_size, 1)]
+            coords = np.zeros((len(chunk), 0, 2), dtype=np.float32)
+            labels = np.zeros((len(chunk), 0), dtype=np.int32)
+            boxes = None
+            if n_points > 0:
+                coords = predictor.transform.apply_coords(np.stack([objects[i]["points"] for i in chunk]),
+                                                          predictor.original_size)
+                labels = np.stack([objects[i]["labels"] for i in chunk])
+            if has_box:
+                boxes = predictor.transform.apply_boxes(np.stack([objects[i]["box"] for i in chunk]),
+                                                        predictor.original_size)
+            low_res, scores = decoder.decode(predictor, coords, labels, boxes, None, multimask)
+            with torch.inference_mode():
+                best = torch.argmax(scores, dim=1)
+                for j, i in enumerate(chunk):
+                    k = int(best[j])
+                    mask = model.postprocess_masks(low_res[j:j + 1, k:k + 1], predictor.input_size,
+                                                   predictor.original_size)[0, 0] > model.mask_threshold
+                    records[i] = mask_record_torch(mask)
+            del low_res, scores
+    return records
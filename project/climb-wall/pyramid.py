@@ -0,0 +1,44 @@
+import cv2
+
+
+def build_pyramid(image, smallest=256, max_side=0):
+    """ [full, 1/2, 1/4, ...] levels of an image, halved with INTER_AREA until the long side is below smallest
+
+    max_side:  stop at the first level whose long side fits in it (0 = go down to smallest)
+    """
+    levels = [image]
+    while max(levels[-1].shape[:2]) // 2 >= smallest and not (max_side and max(levels[-1].shape[:2]) <= max_side):
+        h, w = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA))
+    return levels
+
+
+def pick_level(levels, max_side):
+    """ The largest level whose long side fits in max_side (0 = full resolution) """
+    if not max_side:
+        return levels[0]
+    for level in levels:
+        if max(level.shape[:2]) <= max_side:
+            return level
+    return levels[-1]
+
+
+class ImagePyramid:
+    """ Resolution pyramid of an uploaded image
+
+    full:     the image as uploaded, what SAM and exports use
+    display:  the level interactive previews are rendered and encoded at
+
+    Only these two levels are kept, the intermediate ones are dropped once the
+    display level is built.
+    """
+
+    def __init__(self, image, display_size=1600):
+        self.full = image
+        self.display = pick_level(build_pyramid(image, max_side=display_size), display_size)
+        self.levels = [image] if self.display is image else [image, self.display]
+
+    @property
+    def scale(self):
+        """ (x, y) factor from full-resolution to display coordinates """
+        return (self.display.shape[1] / self.full.shape[1], self.display.shape[0] / self.full.shape[0])
@@ -0,0 +1,294 @@
+""" Run-length encoded masks, vectorized with numpy
+
+An RLE is an int64 array of run lengths over the flattened image, alternating
+background / mask and starting with background (the first run may be empty),
+as COCO's "counts". COCO flattens column by column (order="F"), the
+segment-anything-webui strings of sam/1.json row by row (order="C").
+
+Two text forms:
+
+- COCO compressed counts ("size": [h, w], "counts": "...") as pycocotools'
+  rleToString / rleFrString: 5 bits per character, runs after the second
+  one delta coded
+- webui strings ("211524F6T1010F..."): each run length followed by F or T,
+  row-major, without the image size
+
+Area, bbox, union and intersection are computed on the runs, without
+decoding. Climb-wall's mask records (bbox + cropped mask, see
+mask_render.mask_record) are encoded from and decoded to their crop only,
+the full image mask is never allocated.
+"""
+import numpy as np
+
+WEBUI_ORDER = "C"
+COCO_ORDER = "F"
+
+
+def from_runs(lengths, values):
+    """ RLE of runs with any values (equal neighbours are merged), starting with background """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    values = np.asarray(values, dtype=bool)
+    if len(lengths) == 0:
+        return np.zeros(1, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    last = np.flatnonzero(values[1:] != values[:-1])
+    counts = np.diff(np.append(ends[last], ends[-1]), prepend=0)
+    if values[0]:
+        counts = np.concatenate([[0], counts])
+    return counts
+
+
+def from_changes(changes, size):
+    """ RLE of a mask of size pixels that is background at 0 and flips at the sorted positions changes """
+    return np.diff(np.asarray(changes, dtype=np.int64), prepend=0, append=size)
+
+
+def encode(mask, order=COCO_ORDER):
+    """ (H, W) bool mask -> RLE """
+    flat = np.asarray(mask, dtype=bool).ravel(order=order)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    if flat.size and flat[0]:
+        changes = np.concatenate([[0], changes])
+    return from_changes(changes, flat.size)
+
+
+def lines_of(shape, order):
+    """ (number of lines, line length) of the flattening order: columns for "F", rows for "C" """
+    h, w = shape[:2]
+    return (w, h) if order == "F" else (h, w)
+
+
+def encode_record(record, shape, order=COCO_ORDER):
+    """ RLE of a mask record over the (H, W) image, from its bbox crop """
+    x0, y0, x1, y1 = record["bbox"]
+    crop = np.asarray(record["mask"], dtype=bool)
+    if order == "F":
+        crop, line0, start = crop.T, x0, y0
+    else:
+        line0, start = y0, x0
+    _, length = lines_of(shape, order)
+    # A background pixel on both sides of every line of the crop: no run crosses a line
+    padded = np.zeros((crop.shape[0], crop.shape[1] + 2), dtype=bool)
+    padded[:, 1:-1] = crop
+    flat = padded.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    line, pos = np.divmod(changes, padded.shape[1])
+    changes = (line0 + line) * length + start + pos - 1
+    # When the crop spans whole lines, a run ending a line and one starting the next are the same run
+    same = changes[1:] == changes[:-1]
+    drop = np.zeros(len(changes), dtype=bool)
+    drop[1:] |= same
+    drop[:-1] |= same
+    size = shape[0] * shape[1]
+    # A run up to the last pixel simply ends with the image
+    drop |= changes == size
+    return from_changes(changes[~drop], size)
+
+
+def decode(counts, shape, order=COCO_ORDER):
+    """ RLE -> (H, W) bool mask """
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape(shape[:2], order=order)
+
+
+def mask_runs(counts):
+    """ (starts, ends) of the non-empty mask runs, ends exclusive """
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    starts, ends = starts[1::2], ends[1::2]
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def area(counts):
+    return int(np.sum(counts[1::2]))
+
+
+def bbox(counts, shape, order=COCO_ORDER):
+    """ (x0, y0, x1, y1) of the mask, exclusive ends as in mask records, None when it is empty """
+    starts, ends = mask_runs(counts)
+    if len(starts) == 0:
+        return None
+    _, length = lines_of(shape, order)
+    line_s, pos_s = np.divmod(starts, length)
+    line_e, pos_e = np.divmod(ends - 1, length)
+    # A run over several lines covers the whole line length
+    several = line_s != line_e
+    pos0 = int(np.min(np.where(several, 0, pos_s)))
+    pos1 = int(np.max(np.where(several, length - 1, pos_e))) + 1
+    line0, line1 = int(line_s.min()), int(line_e.max()) + 1
+    if order == "F":
+        return line0, pos0, line1, pos1
+    return pos0, line0, pos1, line1
+
+
+def decode_record(counts, shape, order=COCO_ORDER, opt="positive"):
+    """ RLE -> mask record (bbox + cropped mask), only the crop is decoded. None when the mask is empty """
+    box = bbox(counts, shape, order)
+    if box is None:
+        return None
+    x0, y0, x1, y1 = box
+    line0, line1, pos0, pos1 = (x0, x1, y0, y1) if order == "F" else (y0, y1, x0, x1)
+    _, length = lines_of(shape, order)
+    starts, ends = mask_runs(counts)
+    offset = line0 * length
+    # Mask runs are disjoint: +1 where one starts, -1 where it ends
+    delta = np.zeros((line1 - line0) * length + 1, dtype=np.int8)
+    delta[starts - offset] += 1
+    delta[ends - offset] -= 1
+    lines = (np.cumsum(delta[:-1], dtype=np.int8) > 0).reshape(line1 - line0, length)[:, pos0:pos1]
+    mask = np.ascontiguousarray(lines.T if order == "F" else lines)
+    return {"bbox": (x0, y0, x1, y1), "mask": mask, "opt": opt}
+
+
+def combine(a, b, op):
+    """ op(a, b) of two RLEs of the same image, on the runs """
+    ends_a, ends_b = np.cumsum(a), np.cumsum(b)
+    if ends_a[-1] != ends_b[-1]:
+        raise ValueError(f"RLEs of different sizes: {ends_a[-1]} and {ends_b[-1]} pixels")
+    ends = np.union1d(ends_a, ends_b)
+    starts = np.concatenate([[0], ends[:-1]])
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    # The run of a position is the number of runs that end at or before it, odd runs are the mask
+    in_a = np.searchsorted(ends_a, starts, side="right") % 2 == 1
+    in_b = np.searchsorted(ends_b, starts, side="right") % 2 == 1
+    return from_runs(ends - starts, op(in_a, in_b))
+
+
+def merge(a, b):
+    """ Union of two RLEs """
+    return combine(a, b, np.logical_or)
+
+
+def intersect(a, b):
+    """ Intersection of two RLEs """
+    return combine(a, b, np.logical_and)
+
+
+def to_string(counts):
+    """ COCO compressed counts string (pycocotools rleToString) """
+    x = np.asarray(counts, dtype=np.int64).copy()
+    x[3:] -= x[1:-2].copy()
+    chars, valid = [], []
+    active = np.ones(len(x), dtype=bool)
+    while active.any():
+        c = x & 0x1f
+        x = x >> 5
+        more = np.where(c & 0x10, x != -1, x != 0)
+        chars.append(c | (more << 5))
+        valid.append(active)
+        active = active & more
+    chars = np.stack(chars, axis=1)[np.stack(valid, axis=1)] + 48
+    return chars.astype(np.uint8).tobytes().decode("ascii")
+
+
+def from_string(s):
+    """ RLE of a COCO compressed counts string (pycocotools rleFrString) """
+    c = np.frombuffer(s.encode("ascii"), dtype=np.uint8).astype(np.int64) - 48
+    if len(c) == 0:
+        return np.zeros(1, dtype=np.int64)
+    last = (c & 0x20) == 0
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    number = np.cumsum(np.concatenate([[False], last[:-1]]))
+    k = np.arange(len(c)) - starts[number]
+    x = np.add.reduceat((c & 0x1f) << (5 * k), starts)
+    negative = (c[last] & 0x10) != 0
+    x[negative] |= -1 << (5 * (k[last][negative] + 1))
+    counts = x.copy()
+    counts[1::2] = np.cumsum(x[1::2])
+    counts[2::2] = np.cumsum(x[2::2])
+    return counts
+
+
+def to_webui(counts):
+    """ segment-anything-webui string of a row-major RLE, empty runs left out """
+    counts = np.asarray(counts, dtype=np.int64)
+    letters = np.where(np.arange(len(counts)) % 2 == 1, "T", "F")
+    keep = counts > 0
+    return "".join(np.char.add(counts[keep].astype(str), letters[keep]))
+
+
+def from_webui(s):
+    """ Row-major RLE of a segment-anything-webui string """
+    letters = np.frombuffer(s.encode("ascii"), dtype=np.uint8)
+    values = letters[(letters == ord("T")) | (letters == ord("F"))] == ord("T")
+    lengths = np.array(s.replace("T", " ").replace("F", " ").split(), dtype=np.int64)
+    if len(lengths) != len(values):
+        raise ValueError("Not a webui RLE string")
+    return from_runs(lengths, values)
+
+
+def is_webui(s):
+    return isinstance(s, str) and len(s) > 0 and s[-1] in "TF" and s[0].isdigit()
+
+
+def segmentation_counts(segmentation, shape):
+    """ (RLE, order) of a "segmentation" entry, checked against the (H, W) image """
+    h, w = shape[:2]
+    if isinstance(segmentation, dict):
+        size = segmentation.get("size")
+        if size is not None and tuple(size) != (h, w):
+            raise ValueError(f"Mask of size {size} on an image of size {[h, w]}")
+        counts = segmentation["counts"]
+        order = COCO_ORDER
+        counts = from_string(counts) if isinstance(counts, str) else np.asarray(counts, dtype=np.int64)
+    elif is_webui(segmentation):
+        counts, order = from_webui(segmentation), WEBUI_ORDER
+    elif isinstance(segmentation, str):
+        counts, order = from_string(segmentation), COCO_ORDER
+    else:
+        raise ValueError(f"Unsupported segmentation {type(segmentation).__name__}, RLE only")
+    if counts.sum() != h * w:
+        raise ValueError(f"Mask of {int(counts.sum())} pixels on an image of {h}x{w}")
+    return counts, order
+
+
+def load_masks(doc, shape):
+    """ Mask records of a JSON document: sam/1.json ({"masks": [...]}), COCO ({"annotations": [...]}) or a list
+
+    Entries without a mask pixel are skipped. The records have no id yet,
+    Session.add_holds() gives them one.
+    """
+    if isinstance(doc, dict):
+        if "width" in doc and "height" in doc and (doc["height"], doc["width"]) != tuple(shape[:2]):
+            raise ValueError(f"Masks of a {doc['width']}x{doc['height']} image")
+        entries = doc.get("masks", doc.get("annotations"))
+        if entries is None:
+            raise ValueError('No "masks" or "annotations" in the document')
+    else:
+        entries = doc
+    records = []
+    for entry in entries:
+        segmentation = entry["segmentation"] if isinstance(entry, dict) else entry
+        counts, order = segmentation_counts(segmentation, shape)
+        record = decode_record(counts, shape, order)
+        if record is not None:
+            records.append(record)
+    return records
+
+
+def dump_masks(records, shape, fmt="webui"):
+    """ JSON document of mask records, loadable by load_masks()
+
+    fmt:  "webui" (as sam/1.json: row-major F / T strings) or "coco" ({"size", "counts"} compressed, column-major)
+    """
+    h, w = shape[:2]
+    masks = []
+    for record in records:
+        x0, y0, x1, y1 = record["bbox"]
+        if fmt == "webui":
+            segmentation = to_webui(encode_record(record, shape, WEBUI_ORDER))
+        elif fmt == "coco":
+            segmentation = {"size": [h, w], "counts": to_string(encode_record(record, shape, COCO_ORDER))}
+        else:
+            raise ValueError(f"Unknown mask format {fmt}")
+        area_ = record.get("area")
+        masks.append({
+            "segmentation": segmentation,
+            "bbox": [x0, y0, x1 - x0, y1 - y0],
+            "area": int(np.count_nonzero(record["mask"])) if area_ is None else area_,
+            "id": record.get("id"),
+        })
+    return {"width": w, "height": h, "masks": masks}
@@ -0,0 +1,108 @@
+""" JSON-RPC 2.0 over one HTTP request, without a dependency
+
+    --> [{"jsonrpc": "2.0", "method": "add_box", "params": {"x1": 10, "y1": 10, "x2": 90, "y2": 90}, "id": 1},
+         {"jsonrpc": "2.0", "method": "infer", "id": 2}]
+    <-- [{"jsonrpc": "2.0", "result": {"boxes": 1}, "id": 1},
+         {"jsonrpc": "2.0", "result": {"masks": 1, "version": 3}, "id": 2}]
+
+A batch runs in order, a failed call does not stop the next ones. Calls
+without an "id" are notifications: they run, but get no response. See
+jsonrpc/rpc-v1.md for the protocol (version 1.0, the 2.0 changes are the
+"jsonrpc" member, named params, batches and the error object).
+
+Binary results (images) are not base64 encoded into the JSON: the reply
+then goes out as multipart/form-data, the JSON in the part "rpc", each
+binary in the part a result names (see multipart()).
+"""
+import inspect
+import json
+import uuid
+
+VERSION = "2.0"
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+SERVER_ERROR = -32000       # -32000 to -32099: errors of the methods themselves
+
+
+class RpcError(Exception):
+    """ Raised by a method to answer with an error object instead of a result """
+
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_dict(self):
+        error = {"code": self.code, "message": self.message}
+        if self.data is not None:
+            error["data"] = self.data
+        return error
+
+
+def error_response(error, id=None):
+    return {"jsonrpc": VERSION, "error": error.to_dict(), "id": id}
+
+
+def call(methods, req):
+    """ Run one request object, return its response object (None for a notification) """
+    if not isinstance(req, dict) or req.get("jsonrpc") != VERSION or not isinstance(req.get("method"), str):
+        return error_response(RpcError(INVALID_REQUEST, "Invalid Request"))
+    id = req.get("id")
+    notification = "id" not in req
+    try:
+        fn = methods.get(req["method"])
+        if fn is None:
+            raise RpcError(METHOD_NOT_FOUND, f"Method not found: {req['method']}")
+        params = req.get("params", {})
+        if not isinstance(params, (dict, list)):
+            raise RpcError(INVALID_PARAMS, "params must be an object or an array")
+        args, kwargs = (params, {}) if isinstance(params, list) else ([], params)
+        try:
+            inspect.signature(fn).bind(*args, **kwargs)
+        except TypeError as e:
+            raise RpcError(INVALID_PARAMS, f"Invalid params: {e}")
+        result = fn(*args, **kwargs)
+    except RpcError as e:
+        return None if notification else error_response(e, id)
+    except Exception as e:
+        print(f"RPC {req['method']} failed: {e!r}")
+        return None if notification else error_response(RpcError(INTERNAL_ERROR, "Internal error", repr(e)), id)
+    return None if notification else {"jsonrpc": VERSION, "result": result, "id": id}
+
+
+def handle(body, methods):
+    """ Response (object, array, or None when there is nothing to answer) of a request body
+
+    methods:  {name: callable}, params are passed by name (object) or by position (array)
+    """
+    try:
+        payload = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return error_response(RpcError(PARSE_ERROR, "Parse error"))
+    if isinstance(payload, list):
+        if not payload:
+            return error_response(RpcError(INVALID_REQUEST, "Invalid Request"))
+        responses = [call(methods, req) for req in payload]
+        return [r for r in responses if r is not None] or None
+    return call(methods, payload)
+
+
+def multipart(reply, attachments):
+    """ multipart/form-data body of a reply and of binary attachments, to send them in one response
+
+    attachments:  {part name: (bytes, mimetype)}, the results refer to their part by name
+
+    return:
+    (body, content type)
+    """
+    boundary = uuid.uuid4().hex.encode()
+    parts = [(b'Content-Disposition: form-data; name="rpc"\r\nContent-Type: application/json', json.dumps(reply).encode())]
+    for name, (data, mimetype) in attachments.items():
+        parts.append((f'Content-Disposition: form-data; name="{name}"; filename="{name}"\r\n'
+                      f'Content-Type: {mimetype}'.encode(), data))
+    body = b"".join(b"--" + boundary + b"\r\n" + headers + b"\r\n\r\n" + data + b"\r\n" for headers, data in parts)
+    return body + b"--" + boundary + b"--\r\n", "multipart/form-data; boundary=" + boundary.decode()
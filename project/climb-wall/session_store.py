@@ -0,0 +1,345 @@
+import bisect
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from history import EditHistory
+from hold_index import HoldIndex
+from mask_render import MaskComposite, union_bbox, zeros_view
+from pyramid import ImagePyramid
+
+
+TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+def new_token():
+    return secrets.token_urlsafe(24)
+
+
+def valid_token(token):
+    return bool(token) and TOKEN_RE.match(token) is not None
+
+
+class Session:
+    """ Per-client image state: the uploaded image, prompts, masks and undo list """
+
+    def __init__(self, token, history_bytes=64 << 20, display_size=1600):
+        self.token = token
+        self.display_size = display_size
+        self.lock = threading.RLock()   # one request of this session at a time
+        self.last_access = time.time()
+
+        self.origin_image_rgba = None   # full resolution, what SAM sees and exports use
+        self.pyramid = None             # ImagePyramid of origin_image_rgba
+        self.processed_img_rgba = None  # the frame sent to the client, at the display level
+        self.masked_img = None
+        self.colorMasks = None
+        self.imgSize = None
+        self.sam_image_rgb = None       # view of the color channels of origin_image_rgba
+        self.image_key = None
+        self.composite = None           # MaskComposite of the display level
+        self.frame_version = 0          # bumped whenever processed_img_rgba changes
+        self.frame_dirty = None         # (x0, y0, x1, y1) changed by the last bump, None = whole frame
+        self.preview_region = None      # region of the current frame showing an uncommitted point preview
+        self.preview_frame = None       # buffer the point previews are drawn in, reused by every click
+
+        self.mode = "box"           # p_point / n_point / box
+        self.curr_view = "image"
+        self.history = EditHistory(history_bytes)  # For undo / redo, not spilled to disk
+
+        self.points = []
+        self.points_label = []
+        self.boxes = []
+        self.masks = []                 # mask_render.mask_record dicts, full resolution, sorted by "id"
+        self.holds = None               # HoldIndex of self.masks
+        self.next_hold_id = 1
+        self.selected = []              # ids of the selected holds
+        # Point refinement: low-res (1, 256, 256) logits of the last prediction, fed back as mask_input,
+        # and the (number of points, number of boxes) they were predicted from. Not spilled to disk.
+        self.logits = None
+        self.logits_prompts = None
+        self.logits_tile = None         # the tile the logits are of, in tiled mode (tiles.py)
+
+    def set_image(self, image):
+        self.origin_image_rgba = image
+        self.sam_image_rgb = image[:, :, :3]
+        self.pyramid = ImagePyramid(image, self.display_size)
+        self.processed_img_rgba = self.pyramid.display
+        self.imgSize = image.shape
+        # The buffers of the previous image are reused when the display level has the same size
+        spare = None if self.composite is None else self.composite.buffers()
+        self.composite = MaskComposite(self.pyramid.display, image.shape, spare)
+        self.holds = HoldIndex(image.shape)
+
+    def copy_to_preview(self, frame):
+        """ frame copied into the reused preview buffer """
+        if self.preview_frame is None or self.preview_frame.shape != frame.shape:
+            self.preview_frame = np.empty_like(frame)
+        np.copyto(self.preview_frame, frame)
+        return self.preview_frame
+
+    def add_holds(self, records):
+        """ Insert committed masks into self.masks and the hold index
+
+        New records get the next ids (they are drawn on top), records that
+        already have an id (undo of a delete, redo) go back to their place.
+        """
+        for record in records:
+            if "id" not in record:
+                record["id"] = self.next_hold_id
+                record["area"] = int(np.count_nonzero(record["mask"]))
+                self.next_hold_id += 1
+            self.next_hold_id = max(self.next_hold_id, record["id"] + 1)
+            if self.masks and self.masks[-1]["id"] > record["id"]:
+                ids = [m["id"] for m in self.masks]
+                self.masks.insert(bisect.bisect(ids, record["id"]), record)
+            else:
+                self.masks.append(record)
+            self.holds.add(record)
+
+    def remove_holds(self, ids):
+        """ Remove holds by id, return the removed records in drawing order """
+        ids = set(ids)
+        removed = [m for m in self.masks if m["id"] in ids]
+        if removed:
+            self.masks = [m for m in self.masks if m["id"] not in ids]
+            for record in removed:
+                self.holds.remove(record["id"])
+        self.selected = [i for i in self.selected if i not in ids]
+        return removed
+
+    def bump_frame(self, dirty=None, preview=None):
+        """ processed_img_rgba changed inside dirty (None = everywhere)
+
+        preview: region of the new frame showing an uncommitted preview mask.
+        The preview of the previous frame is always part of the change.
+        """
+        if dirty is not None and self.preview_region is not None:
+            dirty = union_bbox(dirty, self.preview_region)
+        self.frame_version += 1
+        self.frame_dirty = dirty
+        self.preview_region = preview
+
+    def memory_usage(self):
+        """ Approximate bytes held: {"masks": full-resolution masks, "images": image buffers, "history": undo / redo} """
+        images = 0
+        if self.origin_image_rgba is not None:
+            images += sum(level.nbytes for level in self.pyramid.levels)
+            images += self.composite.nbytes()
+            if self.preview_frame is not None:
+                images += self.preview_frame.nbytes
+        return {
+            "masks": sum(m["mask"].nbytes for m in list(self.masks)),
+            "images": images,
+            "history": self.history.nbytes,
+        }
+
+    def touch(self):
+        self.last_access = time.time()
+
+    def reset_inputs(self):
+        self.points = []
+        self.points_label = []
+        self.boxes = []
+        self.logits = None
+        self.logits_prompts = None
+
+    def reset_masks(self):
+        self.masks = []
+        self.holds.clear()
+        self.selected = []
+        self.composite.reset()
+        self.masked_img = zeros_view(self.pyramid.display.shape[:2])
+        self.colorMasks = zeros_view(self.pyramid.display.shape)
+
+    # Spill to / restore from disk
+    def save(self, path):
+        data = {
+            "mode": np.array(self.mode),
+            "frame_version": np.array(self.frame_version),
+        }
+        if self.origin_image_rgba is not None:
+            data["origin_image_rgba"] = self.origin_image_rgba
+            data["image_key"] = np.array(self.image_key)
+            # Cropped masks, bit-packed back to back
+            data["masks"] = np.packbits(np.concatenate([m["mask"].ravel() for m in self.masks] + [np.zeros(0, bool)]))
+            data["masks_bbox"] = np.array([m["bbox"] for m in self.masks], dtype=np.int64).reshape(-1, 4)
+            data["masks_opt"] = np.array([m["opt"] for m in self.masks], dtype=str)
+            data["masks_id"] = np.array([m["id"] for m in self.masks], dtype=np.int64)
+            data["masks_area"] = np.array([m["area"] for m in self.masks], dtype=np.int64)
+            data["boxes"] = np.array(self.boxes, dtype=np.float32).reshape(-1, 4)
+            data["points"] = np.array(self.points, dtype=np.float32).reshape(-1, 2)
+            data["points_label"] = np.array(self.points_label, dtype=np.int32)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, token, path, history_bytes=64 << 20, display_size=1600):
+        session = cls(token, history_bytes, display_size)
+        with np.load(path) as data:
+            session.mode = str(data["mode"])
+            # The frame is rebuilt on restore, never let a client patch its old copy
+            session.frame_version = int(data["frame_version"])
+            session.bump_frame()
+            if "origin_image_rgba" not in data:
+                return session
+            image = data["origin_image_rgba"]
+            session.set_image(image)
+            session.image_key = str(data["image_key"])
+            bboxes = data["masks_bbox"]
+            sizes = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+            bits = np.unpackbits(data["masks"], count=int(sizes.sum())).astype(bool)
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            records = []
+            for i, (x0, y0, x1, y1) in enumerate(bboxes.tolist()):
+                records.append({
+                    "bbox": (x0, y0, x1, y1),
+                    "mask": bits[offsets[i]:offsets[i + 1]].reshape(y1 - y0, x1 - x0),
+                    "opt": str(data["masks_opt"][i]),
+                })
+                if "masks_id" in data:
+                    records[-1]["id"], records[-1]["area"] = int(data["masks_id"][i]), int(data["masks_area"][i])
+            session.add_holds(records)
+            session.boxes = list(data["boxes"])
+            session.points = list(data["points"])
+            session.points_label = data["points_label"].tolist()
+        return session
+
+
+class SessionStore:
+    """ Bounded set of live sessions
+
+    At most max_sessions are kept in memory. Sessions idle for longer than
+    idle_seconds, or the least recently used ones beyond the limit, are spilled
+    to spill_dir and transparently restored on their next request. Spilled
+    files older than expire_seconds are deleted.
+
+    A session for which in_use(token) is true (e.g. it has inference jobs
+    queued or running, which hold the session object while the model runs) is
+    never evicted, so no write can land on an object that was already spilled.
+    """
+
+    SUFFIX = ".npz"
+
+    def __init__(self, spill_dir=None, max_sessions=16, idle_seconds=30 * 60, expire_seconds=24 * 3600,
+                 history_bytes=64 << 20, display_size=1600, on_restore=None, in_use=None):
+        self.spill_dir = spill_dir
+        self.history_bytes = history_bytes
+        self.display_size = display_size
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.expire_seconds = expire_seconds
+        self.on_restore = on_restore
+        self.in_use = in_use
+        self.sessions = OrderedDict()
+        self.spilling = {}                      # token -> session being written to spill_dir
+        self.lock = threading.Lock()
+        self.restore_lock = threading.Lock()    # one restore at a time, a spill file is loaded once
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def _path(self, token):
+        return os.path.join(self.spill_dir, token + self.SUFFIX)
+
+    def _lookup(self, token):
+        # Caller holds self.lock. A session still being spilled is taken back, evict() drops its file
+        session = self.sessions.get(token) or self.spilling.get(token)
+        if session is not None:
+            self.sessions[token] = session
+            self.sessions.move_to_end(token)
+        return session
+
+    def get(self, token):
+        with self.lock:
+            session = self._lookup(token)
+        if session is None:
+            with self.restore_lock:
+                # Another request of the same client may have restored it meanwhile
+                with self.lock:
+                    session = self._lookup(token)
+                if session is None:
+                    session = self._restore(token) or Session(token, self.history_bytes, self.display_size)
+                    with self.lock:
+                        self.sessions[token] = session
+        session.touch()
+        self.evict(keep=token)
+        return session
+
+    def _restore(self, token):
+        if not self.spill_dir:
+            return None
+        path = self._path(token)
+        if not os.path.exists(path):
+            return None
+        try:
+            session = Session.load(token, path, self.history_bytes, self.display_size)
+        except Exception as e:
+            print(f"Drop broken session file {path}: {e}")
+            session = None
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass    # expired meanwhile
+        if session is not None and self.on_restore is not None:
+            self.on_restore(session)
+        return session
+
+    def evict(self, keep=None):
+        """ Spill the idle and least recently used sessions, except keep (the one being handed out) """
+        now = time.time()
+        victims = []
+        with self.lock:
+            for token, session in list(self.sessions.items()):
+                if len(self.sessions) <= self.max_sessions and now - session.last_access <= self.idle_seconds:
+                    continue
+                if token == keep or (self.in_use is not None and self.in_use(token)):
+                    continue
+                victims.append(self.sessions.pop(token))
+                if self.spill_dir:
+                    self.spilling[token] = session
+        if not self.spill_dir:
+            return      # no spill directory: evicted sessions are dropped
+        for session in victims:
+            self.spill(session)
+            with self.lock:
+                del self.spilling[session.token]
+                if session.token in self.sessions:
+                    # A request took it back while it was written, the object in memory is the live one
+                    os.remove(self._path(session.token))
+        if victims:
+            self.expire()
+
+    def spill(self, session):
+        if not self.spill_dir:
+            return
+        with session.lock:
+            session.save(self._path(session.token))
+        print(f"Session {session.token[:8]} spilled to disk")
+
+    def expire(self):
+        if not self.spill_dir:
+            return
+        now = time.time()
+        with os.scandir(self.spill_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX) and now - entry.stat().st_mtime > self.expire_seconds:
+                    os.remove(entry.path)
+
+    def memory_usage(self):
+        """ Session.memory_usage() summed over the sessions in memory """
+        with self.lock:
+            sessions = list(self.sessions.values())
+        total = {"masks": 0, "images": 0, "history": 0}
+        for session in sessions:
+            for kind, nbytes in session.memory_usage().items():
+                total[kind] += nbytes
+        return total
+
+    def __len__(self):
+        return len(self.sessions)
@@ -58,6 +58,10 @@ class Deque {
 const max_deque_len = 1000;
 let mode = "box"; // Default mode is 'point', 'point'/'box'
 let queue = new Deque(max_deque_len); // Undo / do list
+let redoQueue = new Deque(max_deque_len);
+let pendingCalls = []; // JSON-RPC calls (boxes) sent with the next request, see rpcBatch()
+let undoneBoxes = [];
+let undonePoints = [];
 let trackDataNum = new Deque(max_deque_len);
 let lastMouseX = 0;
 let lastMouseY = 0;
@@ -146,8 +150,8 @@ $("#preview").mouseup(function (e) {
             y2: Math.max(startPoint.y, endY)
         };
         var img = $("#preview")[0];
-        var scaleX = img.naturalWidth / img.clientWidth;
-        var scaleY = img.naturalHeight / img.clientHeight;
+        var scaleX = $('#preview').data('originalWidth') / img.clientWidth;
+        var scaleY = $('#preview').data('originalHeight') / img.clientHeight;
         coor_temp = coordinates;
         sendBoundingBoxCoordinates(coordinates);
     }
@@ -175,26 +179,112 @@ $("#preview").mouseup(function (e) {
         // zoomBox.style.display = "none";
         // push to queue (for undo)
         queue.push("box");
+        clearRedo();
+    }
+    if (mode === "p_point" || mode === "n_point") {
+        const x = e.pageX - $(this).offset().left;
+        const y = e.pageY - $(this).offset().top;
+        // Mark the point: green for positive, red for negative
+        const newPoint = document.createElement("div");
+        newPoint.classList.add("point");
+        newPoint.style.position = "absolute";
+        newPoint.style.width = "8px";
+        newPoint.style.height = "8px";
+        newPoint.style.borderRadius = "50%";
+        newPoint.style.pointerEvents = "none";
+        newPoint.style.background = mode === "p_point" ? rgbToCSS(0, 200, 0) : rgbToCSS(220, 0, 0);
+        newPoint.style.left = (x - 4) + "px";
+        newPoint.style.top = (y - 4) + "px";
+        document.getElementById("image-container").appendChild(newPoint);
+        points.push(newPoint);
+        queue.push("point");
+        clearRedo();
+        sendPoint(x, y, mode);
+    }
+    if (mode === "select") {
+        selectHold(e.pageX - $(this).offset().left, e.pageY - $(this).offset().top, e.shiftKey);
     }
     console.log("preview mousedown, mode=" +  mode + ", drawing=" + drawing);
 });
+// Select the hold under a click (shift: add to / remove from the selection), the server hit-tests its hold index
+async function selectHold(x, y, add) {
+    var img = $("#preview")[0];
+    var scaleX = $('#preview').data('originalWidth') / img.clientWidth;
+    var scaleY = $('#preview').data('originalHeight') / img.clientHeight;
+    const response = await fetch("/holds/select", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ x: x * scaleX, y: y * scaleY, add: add }),
+    });
+    if (!response.ok) {
+        console.log("select failed", response.status);
+        return;
+    }
+    showSelectedHolds((await response.json()).selected);
+}
+// Outline the selected holds, bboxes are [x, y, w, h] at full resolution
+function showSelectedHolds(holds) {
+    clearSelectedHolds();
+    var img = $("#preview")[0];
+    var scaleX = img.clientWidth / $('#preview').data('originalWidth');
+    var scaleY = img.clientHeight / $('#preview').data('originalHeight');
+    holds.forEach(hold => {
+        const [x, y, w, h] = hold.bbox;
+        const outline = document.createElement("div");
+        outline.classList.add("hold-selected");
+        outline.style.position = "absolute";
+        outline.style.border = `2px dashed ${rgbToCSS(255, 215, 0)}`;
+        outline.style.pointerEvents = "none";
+        outline.style.left = (x * scaleX) + "px";
+        outline.style.top = (y * scaleY) + "px";
+        outline.style.width = (w * scaleX) + "px";
+        outline.style.height = (h * scaleY) + "px";
+        document.getElementById("image-container").appendChild(outline);
+    });
+}
+function clearSelectedHolds() {
+    document.querySelectorAll("#image-container .hold-selected").forEach(outline => outline.remove());
+}
+// Delete the selected holds, the answer is a patch of their bounding boxes
+async function deleteSelectedHolds() {
+    if (selectedImage === null) {
+        return;
+    }
+    toggleProcessingButtons(true);
+    const [deleted, frame] = await rpcBatch([{ method: "delete_holds" }, frameCall()]);
+    await applyFrameResult(frame);
+    if (deleted && deleted.deleted.length > 0) {
+        queue.push("delete");
+        clearRedo();
+    }
+    clearSelectedHolds();
+    toggleProcessingButtons(false);
+}
+// Each click refines the same object: the server answers with a low-resolution preview
+async function sendPoint(x, y, pointMode) {
+    var img = $("#preview")[0];
+    var scaleX = $('#preview').data('originalWidth') / img.clientWidth;
+    var scaleY = $('#preview').data('originalHeight') / img.clientHeight;
+    const label = pointMode === "p_point" ? 1 : 0;
+    const [, frame] = await rpcBatch([
+        { method: "add_point", params: { x: x * scaleX, y: y * scaleY, label: label } },
+        frameCall(),
+    ]);
+    await applyFrameResult(frame);
+}
 function sendBoundingBoxCoordinates(coordinates) {
     console.log(coordinates);
-    // Send the coordinates to the server
+    // Boxes are not sent one by one: they go to the server with the next interaction, in the same request
+    // The preview may be a reduced level of the image, the server wants full-resolution coordinates
     var img = $("#preview")[0];
-    var scaleX = img.naturalWidth / img.clientWidth;
-    var scaleY = img.naturalHeight / img.clientHeight;
-    $.ajax({
-        url: '/box_receive',
-        type: 'POST',
-        data: JSON.stringify({ 
-            x1: coordinates.x1 * scaleX, y1: coordinates.y1 * scaleY, 
-            x2: coordinates.x2 * scaleX, y2: coordinates.y2 * scaleY, 
-        }),
-        contentType: 'application/json',
-        success: function(response) {
-            console.log(response);
-        }
+    var scaleX = $('#preview').data('originalWidth') / img.clientWidth;
+    var scaleY = $('#preview').data('originalHeight') / img.clientHeight;
+    pendingCalls.push({
+        method: "add_box",
+        params: {
+            x1: coordinates.x1 * scaleX, y1: coordinates.y1 * scaleY,
+            x2: coordinates.x2 * scaleX, y2: coordinates.y2 * scaleY,
+        },
     });
 }
 const container = document.getElementById("image-container");
@@ -224,7 +314,7 @@ $("#inference").click(async function() {
     $("#preview").css("pointer-events", "wait");
     $("#preview").css("cursor", "wait");
 
-    await processButtonClick("inference");
+    const result = await processButtonClick("inference");
     togglePointsAndBoxesVisibility(false);
     console.log("trackDataNum ", trackDataNum.size());
     if (trackDataNum.size() > 0) {
@@ -244,7 +334,11 @@ $("#inference").click(async function() {
     trackDataNum.push(currDataNum);
     console.log("This time inference: ", thisTimeInputNum["p"], thisTimeInputNum["b"]);
     var info = "inference-" + thisTimeInputNum["p"] + "-" + thisTimeInputNum["b"];
-    queue.push(info);
+    // The server only records an inference that produced masks as an undo step
+    if (result && result.masks > 0) {
+        queue.push(info);
+        clearRedo();
+    }
 
     // Enable buttons and mouse events after processing
     toggleProcessingButtons(false);
@@ -254,6 +348,155 @@ $("#inference").click(async function() {
 });
 
 
+$("#undo").click(async function() {
+    if (queue.isEmpty()) {
+        return;
+    }
+    toggleProcessingButtons(true);
+    const step = queue.pop();
+    redoQueue.push(step);
+    if (step === "box" && boxes.length > 0) {
+        const undoneBox = boxes.pop();
+        undoneBox.style.display = "none";
+        undoneBoxes.push(undoneBox);
+    }
+    if (step === "point" && points.length > 0) {
+        const undonePoint = points.pop();
+        undonePoint.style.display = "none";
+        undonePoints.push(undonePoint);
+    }
+    if (step.startsWith("inference-")) {
+        showInferencePrompts(step, true);
+    }
+    clearSelectedHolds();
+    await processButtonClick("undo");
+    toggleProcessingButtons(false);
+});
+
+$("#redo").click(async function() {
+    if (redoQueue.isEmpty()) {
+        return;
+    }
+    toggleProcessingButtons(true);
+    const step = redoQueue.pop();
+    queue.push(step);
+    if (step === "box" && undoneBoxes.length > 0) {
+        const redoneBox = undoneBoxes.pop();
+        redoneBox.style.display = "";
+        boxes.push(redoneBox);
+    }
+    if (step === "point" && undonePoints.length > 0) {
+        const redonePoint = undonePoints.pop();
+        redonePoint.style.display = "";
+        points.push(redonePoint);
+    }
+    if (step.startsWith("inference-")) {
+        showInferencePrompts(step, false);
+    }
+    clearSelectedHolds();
+    await processButtonClick("redo");
+    toggleProcessingButtons(false);
+});
+
+
+// Full-resolution export, the preview is only rendered at display size
+$("#export").click(async function() {
+    if (selectedImage === null) {
+        alert("请先上传一面墙或者从墙列表中选择一面墙.");
+        return;
+    }
+    const response = await fetch("/export", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ view: "overlay", image_type: "png" }),
+    });
+    if (!response.ok) {
+        console.log("export failed", response.status);
+        return;
+    }
+    const url = URL.createObjectURL(await response.blob());
+    const link = document.createElement("a");
+    link.href = url;
+    link.download = "wall.png";
+    link.click();
+    URL.revokeObjectURL(url);
+});
+
+
+// The masks as run-length encoded JSON (the format of sam/1.json)
+$("#export_masks").click(async function() {
+    if (selectedImage === null) {
+        alert("请先上传一面墙或者从墙列表中选择一面墙.");
+        return;
+    }
+    const [doc] = await rpcBatch([{ method: "export", params: { format: "webui" } }]);
+    if (!doc) {
+        return;
+    }
+    const url = URL.createObjectURL(new Blob([JSON.stringify(doc)], { type: "application/json" }));
+    const link = document.createElement("a");
+    link.href = url;
+    link.download = "masks.json";
+    link.click();
+    URL.revokeObjectURL(url);
+});
+// Replace the masks by those of a JSON file, the import is one undo step
+$("#import_masks").click(function() {
+    if (selectedImage === null) {
+        alert("请先上传一面墙或者从墙列表中选择一面墙.");
+        return;
+    }
+    $("#input-masks").click();
+});
+$("#input-masks").change(async function() {
+    const file = this.files[0];
+    this.value = "";
+    if (!file) {
+        return;
+    }
+    toggleProcessingButtons(true);
+    await flushPendingCalls();
+    const form = new FormData();
+    form.append("file", file);
+    form.append("options", JSON.stringify(frameOptions()));
+    const response = await fetch("/masks/import", { method: "POST", body: form });
+    if (!response.ok) {
+        alert("导入失败: " + ((await response.json()).error || response.status));
+    } else {
+        await applyFrameResponse(response);
+        queue.push("import");
+        clearRedo();
+    }
+    clearSelectedHolds();
+    toggleProcessingButtons(false);
+});
+
+// Undoing an inference makes the points and boxes it consumed pending again (step is "inference-<points>-<boxes>"),
+// redoing it consumes them again
+function showInferencePrompts(step, show) {
+    const [p, b] = step.split("-").slice(1).map(Number);
+    const consumed = points.slice(Math.max(points.length - p, 0)).concat(boxes.slice(Math.max(boxes.length - b, 0)));
+    consumed.forEach(element => {
+        $(element).removeData("original-display-style");
+        element.style.display = show ? "" : "none";
+        if (!show) {
+            $(element).data("original-display-style", "block");
+        }
+    });
+    // The next inference counts its prompts from here
+    trackDataNum = new Deque(max_deque_len);
+    trackDataNum.push({"p": points.length - (show ? p : 0), "b": boxes.length - (show ? b : 0)});
+}
+
+function clearRedo() {
+    redoQueue = new Deque(max_deque_len);
+    undoneBoxes.forEach(undoneBox => undoneBox.remove());
+    undoneBoxes = [];
+    undonePoints.forEach(undonePoint => undonePoint.remove());
+    undonePoints = [];
+}
+
+
 function clear_original_display_style() {
     const imageContainer = document.getElementById("image-container");
     const pointsAndBoxes = imageContainer.querySelectorAll(".point, .box");
@@ -310,6 +553,7 @@ function getDefaultDarkImageBase64() {
 
 function readURL(input) {
     clearAllBoxes();
+    frameVersion = null;
 
     if (!input.files || !input.files[0]) {
         return
@@ -337,6 +581,7 @@ function readURL(input) {
     reader.readAsDataURL(input.files[0]);
 
     // Init server after upload image
+    pendingCalls = [];
     var form_data = new FormData();
     form_data.append("image", input.files[0]);
 
@@ -355,6 +600,33 @@ function readURL(input) {
 
 }
 
+$("#button_box").click(function () {
+    SelectBoxModel();
+});
+$("#button4").click(function () {
+    processButtonClick("p_point");
+    toggleSelectedModeButton("button4");
+    mode = "p_point";
+});
+$("#button5").click(function () {
+    processButtonClick("n_point");
+    toggleSelectedModeButton("button5");
+    mode = "n_point";
+});
+$("#button_select").click(function () {
+    toggleSelectedModeButton("button_select");
+    mode = "select";
+});
+$("#delete_hold").click(function () {
+    deleteSelectedHolds();
+});
+$(document).keydown(function (e) {
+    if ((e.key === "Delete" || e.key === "Backspace") && mode === "select" && !$(e.target).is("input")) {
+        e.preventDefault();
+        deleteSelectedHolds();
+    }
+});
+
 function SelectBoxModel(){
     processButtonClick("box");
     toggleSelectedModeButton("button_box");
@@ -362,46 +634,199 @@ function SelectBoxModel(){
     mode = "box";
 }
 
+// The frame shown in #preview is kept in a canvas so that the server can send
+// only the changed rectangle (X-Patch-Rect) instead of the whole image.
+let frameVersion = null;
+const frameCanvas = document.createElement("canvas");
+const frameCtx = frameCanvas.getContext("2d");
+
+function showFrame() {
+    return new Promise(resolve => {
+        frameCanvas.toBlob(function (blob) {
+            const oldSrc = $("#preview").attr("src");
+            $("#preview").attr("src", URL.createObjectURL(blob));
+            if (oldSrc && oldSrc.startsWith("blob:")) {
+                URL.revokeObjectURL(oldSrc);
+            }
+            resolve();
+        });
+    });
+}
+
+// Options of every frame request: binary png, only the changed rectangle
+function frameOptions() {
+    return {
+        image_type: "png",
+        png_compression: 1,
+        response: "binary",
+        patch: true,
+        base_version: frameVersion,
+    };
+}
+
+// Draw a frame response (full frame, patch or 204) into frameCanvas and show it
+async function applyFrameResponse(response) {
+    if (!response.ok) {
+        console.log("frame request failed", response.status);
+        return;
+    }
+    const version = parseInt(response.headers.get("X-Frame-Version"));
+    const fullSize = response.headers.get("X-Full-Size");
+    if (fullSize !== null) {
+        const [fullWidth, fullHeight] = fullSize.split(",").map(Number);
+        $('#preview').data('originalWidth', fullWidth);
+        $('#preview').data('originalHeight', fullHeight);
+    }
+    if (response.status === 204) {  // Frame not modified
+        frameVersion = version;
+        return;
+    }
+    const patchRect = response.headers.get("X-Patch-Rect");
+    await drawFrame(await response.blob(), patchRect === null ? null : patchRect.split(",").map(Number), version);
+}
+
+// The JSON-RPC call that ends a batch: the frame after the other calls, as a binary png patch
+function frameCall() {
+    return { method: "frame", params: { base_version: frameVersion, image_type: "png", png_compression: 1 } };
+}
+
+// Draw the result of a JSON-RPC "frame" call, its image came in the same response (rpcBatch)
+async function applyFrameResult(frame) {
+    if (!frame) {
+        return;
+    }
+    $('#preview').data('originalWidth', frame.full_size[0]);
+    $('#preview').data('originalHeight', frame.full_size[1]);
+    if (frame.image) {
+        await drawFrame(frame.image, frame.rect, frame.version);
+    } else {
+        frameVersion = frame.version;
+    }
+}
+
+// Draw a full frame (rect null) or a patch [x, y, w, h] into frameCanvas and show it
+async function drawFrame(blob, rect, version) {
+    const bitmap = await createImageBitmap(blob);
+    if (rect === null) {
+        frameCanvas.width = bitmap.width;
+        frameCanvas.height = bitmap.height;
+        frameCtx.clearRect(0, 0, bitmap.width, bitmap.height);
+        frameCtx.drawImage(bitmap, 0, 0);
+    } else {
+        const [x, y, w, h] = rect;
+        frameCtx.clearRect(x, y, w, h);
+        frameCtx.drawImage(bitmap, x, y);
+    }
+    frameVersion = version;
+    await showFrame();
+}
+
+// JSON-RPC batch (/rpc): the pending boxes, then calls, run in order in one request. The results
+// of calls in their order, null for a call that failed
+async function rpcBatch(calls) {
+    const batch = pendingCalls.concat(calls).map((call, i) => Object.assign({ jsonrpc: "2.0", id: i }, call));
+    pendingCalls = [];
+    const response = await fetch("/rpc", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(batch),
+    });
+    if (!response.ok) {
+        console.log("rpc failed", response.status);
+        return calls.map(() => null);
+    }
+    // With binary results (frames) the reply is multipart: the JSON in "rpc", each image in the part its result names
+    let replies, form = null;
+    if ((response.headers.get("Content-Type") || "").startsWith("multipart/form-data")) {
+        form = await response.formData();
+        replies = JSON.parse(form.get("rpc"));
+    } else {
+        replies = await response.json();
+    }
+    const results = new Map();
+    (Array.isArray(replies) ? replies : [replies]).forEach(reply => {
+        if (reply.error) {
+            console.log("rpc call failed", batch[reply.id] ? batch[reply.id].method : "", reply.error);
+        }
+        if (form !== null && reply.result && reply.result.part) {
+            reply.result.image = form.get(reply.result.part);
+        }
+        results.set(reply.id, reply.error ? null : reply.result);
+    });
+    const first = batch.length - calls.length;
+    return calls.map((call, i) => results.has(first + i) ? results.get(first + i) : null);
+}
+
+// Send the pending boxes before a request that does not go through /rpc
+async function flushPendingCalls() {
+    if (pendingCalls.length > 0) {
+        await rpcBatch([]);
+    }
+}
+
+// The pending boxes, the inference (waited for on the server) and the new frame in one request
+async function runInference() {
+    const [result, frame] = await rpcBatch([{ method: "infer" }, frameCall()]);
+    await applyFrameResult(frame);
+    return result;
+}
+
+// Long-poll a job of the inference worker, then fetch the new frame
+async function waitJobAndShowFrame(job) {
+    while (job.status === "queued" || job.status === "running" || job.status === "superseded") {
+        const jobId = job.status === "superseded" ? job.superseded_by : job.job_id;
+        const poll = await fetch(`/jobs/${jobId}?wait=10`);
+        if (!poll.ok) {
+            console.log("job poll failed", poll.status);
+            return;
+        }
+        job = await poll.json();
+    }
+    if (job.status === "failed") {
+        console.log("inference failed", job.error);
+        return;
+    }
+    await applyFrameResponse(await fetch("/frame", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(frameOptions()),
+    }));
+}
+
 // Add click event listeners for other buttons
 async function processButtonClick(button_id) {
     if (selectedImage === null) {
         alert("请先上传一面墙或者从墙列表中选择一面墙.");
         return;
     }
-    if (button_id !== null) {
-        const image_jpeg = "jpeg";
-        const image_png= "png";
-        const image_type = image_png;
-        await $.ajax({
-            url: "/button_click",
-            type: "POST",
-            data: JSON.stringify({ 
-                button_id: button_id,
-                image_type: image_type,
-             }),
-            contentType: "application/json",
-            success: function (response) {
-                const image = new Image();
-                if(image_type == image_jpeg){
-                    image.src = "data:image/jpeg;base64," + response.image;
-                }else if(image_type == image_png){
-                    image.src = "data:image/png;base64," + response.image;
-                }else{
-                    alert("unknown image type " + image_type);
-                }
-                image.onload = function () {
-                    $("#preview").attr("src", image.src);
-                    // $('#zoom-image').attr('src', image.src);
-                };
-            },
+    if (button_id === "inference") {
+        return await runInference();
+    } else if (button_id === "undo" || button_id === "redo") {
+        const [step, frame] = await rpcBatch([{ method: button_id }, frameCall()]);
+        await applyFrameResult(frame);
+        // Undo / redo of a point re-runs the preview on the worker
+        if (step && step.job_id) {
+            await waitJobAndShowFrame({ job_id: step.job_id, status: "queued" });
+        }
+    } else if (button_id !== null) {
+        const response = await fetch("/button_click", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify(Object.assign({ button_id: button_id }, frameOptions())),
         });
+        await applyFrameResponse(response);
+        // Undo / redo of a point re-runs the preview on the worker
+        const jobId = response.headers.get("X-Job-Id");
+        if (jobId !== null) {
+            await waitJobAndShowFrame({ job_id: jobId, status: "queued" });
+        }
     }
 }
 
 
 function toggleSelectedModeButton(buttonId) {
     // Remove the 'selected-Mode' class from all Mode buttons
-    $("#button4, #button5, #button_box, #brush").removeClass("selected-view");
+    $("#button4, #button5, #button_box, #button_select, #brush").removeClass("selected-view");
     // Add the 'selected-Mode' class to the clicked Mode button
     $(`#${buttonId}`).addClass("selected-view");
 }
@@ -409,10 +834,13 @@ function toggleSelectedModeButton(buttonId) {
 
 // For drawing bounding boxes
 function clearAllBoxes() {
+    clearSelectedHolds();
     boxes.forEach(box => {
         box.remove();
     });
     boxes.length = 0;
+    points.forEach(point => point.remove());
+    points.length = 0;
     box.style.width = "0px";
     box.style.height = "0px";
     box.style.left = "0px";
@@ -0,0 +1,46 @@
+def rpc(client, method, **params):
+    reply = client.post("/rpc", json={"jsonrpc": "2.0", "method": method, "params": params, "id": 1}).get_json()
+    assert "error" not in reply, reply
+    return reply["result"]
+
+
+def pending(web):
+    session, = web.sessions.sessions.values()
+    return [box.tolist() for box in session.boxes]
+
+
+def holds(client):
+    return [hold["id"] for hold in rpc(client, "list_holds")["holds"]]
+
+
+def test_undo_inference_gives_its_box_back(web, client):
+    box = [40.0, 30.0, 120.0, 90.0]
+    rpc(client, "add_box", x1=40, y1=30, x2=120, y2=90)
+    assert rpc(client, "infer")["masks"] == 1
+    assert pending(web) == [] and len(holds(client)) == 1
+
+    assert rpc(client, "undo")["kind"] == "inference"
+    assert pending(web) == [box] and holds(client) == []
+    assert rpc(client, "undo")["kind"] == "box"
+    assert pending(web) == [] and holds(client) == []
+    assert rpc(client, "redo")["kind"] == "box"
+    assert pending(web) == [box] and holds(client) == []
+    assert rpc(client, "redo")["kind"] == "inference"
+    assert pending(web) == [] and len(holds(client)) == 1
+    assert rpc(client, "redo")["kind"] is None
+
+
+def test_redo_inference_consumes_only_its_boxes(web, client):
+    rpc(client, "add_box", x1=40, y1=30, x2=120, y2=90)
+    rpc(client, "infer")
+    rpc(client, "add_box", x1=150, y1=100, x2=200, y2=150)
+
+    rpc(client, "undo")
+    rpc(client, "undo")
+    assert pending(web) == [[40.0, 30.0, 120.0, 90.0]] and holds(client) == []
+    rpc(client, "redo")
+    rpc(client, "redo")
+    assert pending(web) == [[150.0, 100.0, 200.0, 150.0]] and len(holds(client)) == 1
+    # The pending box is inferred as usual
+    assert rpc(client, "infer")["masks"] == 1
+    assert pending(web) == [] and len(holds(client)) == 2
@@ -0,0 +1,76 @@
+import cv2
+import numpy as np
+import pytest
+
+from mask_render import overlay_base, records_from_stack, render_masks
+
+# The original renderer converted the whole image RGB -> HSV -> RGB once per mask: every pixel,
+# covered or not, drifts by up to this many levels per pass. render_masks only converts the
+# pixels it boosts, so it differs from the original by at most this drift times the number of masks.
+DRIFT_PER_PASS = 6
+
+
+def original_render(image, masks):
+    """ Web_App.updateMaskImg / IncreaseSaturationBrightness as they were before render_masks """
+    image = image * 1
+    image[:, :, 3] = image[:, :, 3] * 0.5
+    image = image.astype(dtype=np.uint8)
+    for mask in masks:
+        mask = mask.reshape(*mask.shape, 1)
+        hsv = cv2.cvtColor(image[:, :, :3], cv2.COLOR_RGB2HSV)
+        mask_bool = mask[:, :, 0] > 0
+        hsv[mask_bool, 1] = np.clip(hsv[mask_bool, 1].astype(np.float32) * 1.2, 0, 255).astype(np.uint8)
+        hsv[mask_bool, 2] = np.clip(hsv[mask_bool, 2].astype(np.float32) * 1.2, 0, 255).astype(np.uint8)
+        image[:, :, :3] = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+        image[:, :, 3] = np.where(mask[:, :, 0] > 0, 255, image[:, :, 3])
+        mask_uint8 = (mask[:, :, 0] * 255).astype(np.uint8)
+        contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(image, contours, -1, color=(255, 0, 255, 255), thickness=2)
+    return image
+
+
+def wall(h, w, rng, gray=False):
+    small = (rng.random((h // 16, w // 16, 3)) * 255).astype(np.uint8)
+    rgb = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+    if gray:
+        rgb = np.repeat(rgb[:, :, :1], 3, axis=2)
+    alpha = rng.integers(0, 256, size=(h, w, 1), dtype=np.uint8)
+    return np.concatenate([rgb, alpha], axis=2)
+
+
+def holds(h, w, count, rng):
+    masks = np.zeros((count, h, w), dtype=np.uint8)
+    for mask in masks:
+        center = (int(rng.integers(10, w - 10)), int(rng.integers(10, h - 10)))
+        axes = (int(rng.integers(4, 40)), int(rng.integers(4, 40)))
+        cv2.ellipse(mask, center, axes, 0, 0, 360, 1, -1)
+    return masks.astype(bool)
+
+
+def render(image, masks):
+    out = overlay_base(image)
+    render_masks(out, records_from_stack(masks))
+    return out
+
+
+@pytest.mark.parametrize("count", [1, 5, 20])
+def test_matches_original_within_hsv_drift(count):
+    rng = np.random.default_rng(count)
+    image, masks = wall(240, 320, rng), holds(240, 320, count, rng)
+    expected, out = original_render(image, masks), render(image, masks)
+
+    assert np.array_equal(out[:, :, 3], expected[:, :, 3])
+    assert np.abs(out.astype(int) - expected.astype(int)).max() <= DRIFT_PER_PASS * count
+
+
+@pytest.mark.parametrize("count", [1, 5, 20])
+def test_matches_original_on_gray_image(count):
+    # Grays go through RGB -> HSV -> RGB unchanged: the outlines, the drawing order and the
+    # number of boosts of every pixel must be the original ones. The magenta of the outlines
+    # comes back as (255, 0, 254) from some of the original's whole-image conversions.
+    rng = np.random.default_rng(count)
+    image, masks = wall(240, 320, rng, gray=True), holds(240, 320, count, rng)
+    expected, out = original_render(image, masks), render(image, masks)
+
+    assert np.array_equal(out[:, :, 3], expected[:, :, 3])
+    assert np.abs(out.astype(int) - expected.astype(int)).max() <= 1
@@ -0,0 +1,44 @@
+import json
+import re
+
+import cv2
+import numpy as np
+
+
+def rpc_batch(client, calls):
+    batch = [dict(call, jsonrpc="2.0", id=i) for i, call in enumerate(calls)]
+    return client.post("/rpc", json=batch)
+
+
+def parts(response):
+    """ {name: bytes} of a multipart/form-data response """
+    boundary = re.search(r"boundary=(\S+)", response.content_type).group(1).encode()
+    found = {}
+    for part in response.data.split(b"--" + boundary)[1:-1]:
+        headers, body = part.strip(b"\r\n").split(b"\r\n\r\n", 1)
+        found[re.search(rb'name="([^"]+)"', headers).group(1).decode()] = body
+    return found
+
+
+def test_frame_patch_comes_in_the_same_response(client):
+    r = rpc_batch(client, [{"method": "frame"}])
+    full = parts(r)
+    frame = json.loads(full["rpc"])[0]["result"]
+    assert frame["rect"] is None and cv2.imdecode(np.frombuffer(full[frame["part"]], np.uint8), -1).shape[:2] == (240, 320)
+
+    r = rpc_batch(client, [{"method": "add_box", "params": {"x1": 40, "y1": 30, "x2": 120, "y2": 90}},
+                           {"method": "infer"},
+                           {"method": "frame", "params": {"base_version": frame["version"]}}])
+    assert r.content_type.startswith("multipart/form-data")
+    patch = parts(r)
+    _, infer, frame = [reply["result"] for reply in json.loads(patch["rpc"])]
+    assert infer["masks"] == 1 and frame["version"] == infer["version"]
+    x, y, w, h = frame["rect"]
+    assert cv2.imdecode(np.frombuffer(patch[frame["part"]], np.uint8), -1).shape[:2] == (h, w)
+
+
+def test_unchanged_frame_is_plain_json(client):
+    version = json.loads(parts(rpc_batch(client, [{"method": "frame"}]))["rpc"])[0]["result"]["version"]
+    r = rpc_batch(client, [{"method": "frame", "params": {"base_version": version}}])
+    assert r.content_type == "application/json"
+    assert r.get_json()[0]["result"]["unchanged"]
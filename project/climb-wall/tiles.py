@@ -0,0 +1,175 @@
+""" Tiled segmentation of images much larger than SAM's 1024 px input
+
+A panorama of a whole wall is split into overlapping tiles of --tile_size
+pixels (full resolution), each tile is a separate SAM image: its embedding
+is computed the first time a prompt needs it and cached like the one of a
+whole image (embedding_cache.py, key <image key>-<tile>), so only the tiles
+that were clicked are ever encoded and at most one of them is held by the
+predictor.
+
+Interactive prompts go to the tile that contains them with the widest margin,
+the overlap lets every hold smaller than it fit in one tile. A box larger than
+a tile is cut along the tiles it covers and the pieces are unioned.
+Automatic (batch) segmentation runs on every tile, the pieces of a hold cut
+by a seam are merged by merge_seams().
+"""
+import numpy as np
+
+# Two masks of different tiles are the same hold when they agree this much where both tiles see the image
+SEAM_OVERLAP = 0.5
+
+
+def axis_starts(length, tile, overlap):
+    """ Evenly spaced tile starts along an axis, neighbours overlap by at least overlap """
+    if length <= tile:
+        return [0]
+    count = int(np.ceil((length - overlap) / (tile - overlap)))
+    return [int(round(s)) for s in np.linspace(0, length - tile, count)]
+
+
+class TileGrid:
+    """ Overlapping tiles (x0, y0, x1, y1) covering a full-resolution image, row by row """
+
+    def __init__(self, shape, tile=1024, overlap=256):
+        self.height, self.width = shape[:2]
+        self.tile = tile
+        self.overlap = min(overlap, tile // 2)
+        tw, th = min(tile, self.width), min(tile, self.height)
+        self.tiles = [
+            (x0, y0, x0 + tw, y0 + th)
+            for y0 in axis_starts(self.height, th, self.overlap)
+            for x0 in axis_starts(self.width, tw, self.overlap)
+        ]
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def margin(self, tile, bbox):
+        """ Distance from bbox to the nearest edge of tile that is not an image edge, < 0 when it sticks out """
+        x0, y0, x1, y1 = tile
+        bx0, by0, bx1, by1 = bbox
+        margins = [
+            bx0 - x0 if x0 > 0 else np.inf,
+            by0 - y0 if y0 > 0 else np.inf,
+            x1 - bx1 if x1 < self.width else np.inf,
+            y1 - by1 if y1 < self.height else np.inf,
+        ]
+        inside = x0 <= bx0 and y0 <= by0 and bx1 <= x1 and by1 <= y1
+        return min(margins) if inside else -1
+
+    def best(self, bbox):
+        """ The tile containing bbox farthest from its seams, None when no tile contains it """
+        margins = [self.margin(tile, bbox) for tile in self.tiles]
+        i = int(np.argmax(margins))
+        return self.tiles[i] if margins[i] >= 0 else None
+
+    def covering(self, bbox):
+        """ Tiles intersecting bbox """
+        bx0, by0, bx1, by1 = bbox
+        return [t for t in self.tiles if t[0] < bx1 and bx0 < t[2] and t[1] < by1 and by0 < t[3]]
+
+
+def tile_key(key, tile):
+    """ Embedding cache key of a tile of the image with key """
+    return f"{key}-{tile[0]}-{tile[1]}-{tile[2]}-{tile[3]}"
+
+
+def prompt_bbox(points, box=None):
+    """ Integer (x0, y0, x1, y1) around the points and the box of an object """
+    corners = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    if box is not None:
+        corners = np.concatenate([corners, np.asarray(box, dtype=np.float32).reshape(2, 2)])
+    x0, y0 = np.floor(corners.min(axis=0)).astype(int)
+    x1, y1 = np.floor(corners.max(axis=0)).astype(int) + 1
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def to_tile(obj, tile):
+    """ The prompts of an object in the frame of tile: points outside it dropped, the box clipped to it """
+    x0, y0, x1, y1 = tile
+    points = np.asarray(obj["points"], dtype=np.float32).reshape(-1, 2)
+    inside = (points[:, 0] >= x0) & (points[:, 0] < x1) & (points[:, 1] >= y0) & (points[:, 1] < y1)
+    box = obj["box"]
+    if box is not None:
+        box = np.clip(np.asarray(box, dtype=np.float32) - [x0, y0, x0, y0], 0, [x1 - x0, y1 - y0] * 2)
+    return {"points": points[inside] - [x0, y0], "labels": np.asarray(obj["labels"])[inside], "box": box}
+
+
+def shift_record(record, dx, dy):
+    """ A mask record of a tile in the frame of the whole image (in place) """
+    if record is not None:
+        x0, y0, x1, y1 = record["bbox"]
+        record["bbox"] = (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+    return record
+
+
+def union_records(records):
+    """ One mask record covering all records, the other fields are those of the first one """
+    if len(records) == 1:
+        return records[0]
+    boxes = np.array([r["bbox"] for r in records])
+    x0, y0 = boxes[:, :2].min(axis=0)
+    x1, y1 = boxes[:, 2:].max(axis=0)
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for r in records:
+        rx0, ry0, rx1, ry1 = r["bbox"]
+        mask[ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0] |= r["mask"]
+    return dict(records[0], bbox=(int(x0), int(y0), int(x1), int(y1)), mask=mask)
+
+
+def crop_to(record, region):
+    """ The mask of record inside region (x0, y0, x1, y1), region must be inside its bbox """
+    x0, y0, x1, y1 = record["bbox"]
+    return record["mask"][region[1] - y0:region[3] - y0, region[0] - x0:region[2] - x0]
+
+
+def intersect(a, b):
+    x0, y0, x1, y1 = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    return (x0, y0, x1, y1) if x0 < x1 and y0 < y1 else None
+
+
+def same_hold(a, b, threshold=SEAM_OVERLAP):
+    """ Whether the masks of two tiles are pieces of one hold: where both tiles see the image they mostly agree """
+    seen = intersect(a["tile"], b["tile"])
+    common = seen and intersect(a["bbox"], b["bbox"])
+    common = common and intersect(common, seen)
+    if not common:
+        return False
+    inter = np.count_nonzero(crop_to(a, common) & crop_to(b, common))
+    if inter == 0:
+        return False
+    area_a = np.count_nonzero(crop_to(a, intersect(a["bbox"], seen)))
+    area_b = np.count_nonzero(crop_to(b, intersect(b["bbox"], seen)))
+    return inter >= threshold * min(area_a, area_b)
+
+
+def merge_seams(records, threshold=SEAM_OVERLAP):
+    """ Union the pieces of holds found in several tiles
+
+    records: full-image mask records with the "tile" they were found in.
+    return:  the merged records, in the order of their first piece
+    """
+    if len(records) < 2:
+        return list(records)
+    parent = list(range(len(records)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    boxes = np.array([r["bbox"] for r in records])
+    tiles = [tuple(r["tile"]) for r in records]
+    for i in range(len(records)):
+        rest = boxes[i + 1:]
+        candidates = np.flatnonzero((rest[:, 0] < boxes[i, 2]) & (rest[:, 2] > boxes[i, 0]) &
+                                    (rest[:, 1] < boxes[i, 3]) & (rest[:, 3] > boxes[i, 1])) + i + 1
+        for j in candidates:
+            if tiles[i] != tiles[j] and find(i) != find(j) and same_hold(records[i], records[j], threshold):
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(records)):
+        groups.setdefault(find(i), []).append(records[i])
+    return [union_records(pieces) for pieces in groups.values()]